@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import shlex
+
+from lib.benchmark import analyzer_benchmark, bm25_benchmark, encode_benchmark, hybrid_benchmark, load_benchmark, scale_benchmark, startup_benchmark, vector_benchmark
+from constants import *
+from lib.tracing import add_profile_arguments, finish_profile, start_profile
+
+def print_timings(name : str, timings : dict[str, float]) -> None:
+    print(f"{name:<12} mean: {timings["mean_ms"]:9.3f} ms  median: {timings["median_ms"]:9.3f} ms  max: {timings["max_ms"]:9.3f} ms  ({timings["queries"]} queries)")
+
+def bm25_command(queries : list[str], limit : int, repeat : int) -> None:
+    report = bm25_benchmark(queries, limit, repeat)
+
+    print_timings("exhaustive", report["exhaustive"])
+    print_timings("postings", report["postings"])
+    print_timings("block_max", report["block_max"])
+    print(f"Speedup (postings):  {report["exhaustive"]["mean_ms"] / report["postings"]["mean_ms"]:.1f}x")
+    print(f"Speedup (block_max): {report["exhaustive"]["mean_ms"] / report["block_max"]["mean_ms"]:.1f}x")
+
+    if report["mismatches"]:
+        print(f"Result mismatches: {report["mismatches"]}")
+
+def load_command(repeat : int) -> None:
+    report = load_benchmark(repeat)
+
+    for name, timings in report.items():
+        print_timings(name, timings)
+
+def vector_command(queries : int, limit : int) -> None:
+    report = vector_benchmark(queries, limit)
+
+    print(f"Scoring {report["chunks"]} chunk embeddings (query encoding excluded)")
+    print_timings("per_row", report["per_row"])
+    print_timings("vectorized", report["vectorized"])
+    print(f"Speedup: {report["per_row"]["mean_ms"] / report["vectorized"]["mean_ms"]:.1f}x")
+
+def hybrid_command(queries : list[str], limit : int, repeat : int, workers : int) -> None:
+    report = hybrid_benchmark(queries, limit, repeat, workers)
+
+    for name, timings in report.items():
+        print_timings(name, timings)
+    print(f"Speedup (concurrent): {report["sequential"]["mean_ms"] / report["concurrent"]["mean_ms"]:.1f}x")
+
+def encode_command(batch_sizes : list[int], workers : list[int], texts : int, stub : bool) -> None:
+    report = encode_benchmark(batch_sizes, workers, texts, stub)
+
+    print(f"Encoding {report["texts"]} chunks per run")
+    for run in report["runs"]:
+        order = "sorted" if run["sorted"] else "unsorted"
+        print(f"workers={run["workers"]:<3} batch={run["batch_size"]:<5} {order:<9} {run["chunks_per_s"]:10.1f} chunks/s  ({run["encode_s"]:.2f} s)")
+
+def analyzer_command(repeat : int) -> None:
+    report = analyzer_benchmark(repeat)
+
+    print(f"Tokenizing {report["documents"]} documents per pass")
+    print_timings("per_call", report["per_call"])
+    print_timings("analyze_many", report["analyze_many"])
+    print_timings("analyze", report["analyze"])
+    print(f"Speedup (analyze_many): {report["per_call"]["mean_ms"] / report["analyze_many"]["mean_ms"]:.1f}x")
+
+    if report["mismatches"]:
+        print(f"Token mismatches: {report["mismatches"]} documents")
+
+def startup_command(commands : list[list[str]], repeat : int) -> None:
+    report = startup_benchmark(commands, repeat)
+
+    for name, stats in report.items():
+        print(name)
+        print_timings("startup", stats["timings"])
+        for module, ms in stats["imports"]:
+            print(f"    import {module:<28} {ms:9.3f} ms")
+
+def scale_command(sizes : list[int], subsystems : list[str], queries : int, seed : int, workdir : str | None, output : str | None) -> None:
+    report = scale_benchmark(sizes, subsystems, queries, seed, workdir)
+
+    if output is None:
+        print(json.dumps(report, indent=2))
+        return
+
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Wrote {output}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search Benchmark CLI")
+    add_profile_arguments(parser)
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    bm25_parser = subparsers.add_parser("bm25", help="Compare exhaustive, posting-list and block-max pruned BM25 scoring")
+    bm25_parser.add_argument("queries", type=str, nargs="*", default=BENCHMARK_QUERIES, help="Queries to benchmark")
+    bm25_parser.add_argument('--limit', type=int, default=LIMIT, help="Optional: number of results per query")
+    bm25_parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT, help="Optional: number of passes over the queries")
+
+    load_parser = subparsers.add_parser("load", help="Time loading the keyword index from disk")
+    load_parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT, help="Optional: number of loads to time")
+
+    vector_parser = subparsers.add_parser("vector", help="Compare per-row and vectorized chunk scoring")
+    vector_parser.add_argument('--queries', type=int, default=BENCHMARK_VECTOR_QUERIES, help="Optional: number of random query vectors")
+    vector_parser.add_argument('--limit', type=int, default=LIMIT, help="Optional: number of results per query")
+
+    hybrid_parser = subparsers.add_parser("hybrid", help="Compare sequential and concurrent retrievers in weighted hybrid search")
+    hybrid_parser.add_argument("queries", type=str, nargs="*", default=BENCHMARK_QUERIES, help="Queries to benchmark")
+    hybrid_parser.add_argument('--limit', type=int, default=LIMIT, help="Optional: number of results per query")
+    hybrid_parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT, help="Optional: number of passes over the queries")
+    hybrid_parser.add_argument('--workers', type=int, default=HYBRID_WORKERS, help="Optional: threads of the concurrent hybrid search")
+
+    encode_parser = subparsers.add_parser("encode", help="Measure embedding build throughput in chunks per second per batch size and worker count")
+    encode_parser.add_argument('--batch-sizes', type=int, nargs="+", default=ENCODE_BENCHMARK_BATCH_SIZES, help="Optional: chunks per model call to measure")
+    encode_parser.add_argument('--workers', type=int, nargs="+", default=[ENCODE_WORKERS], help="Optional: encode process counts to measure, 0 encodes in this process")
+    encode_parser.add_argument('--texts', type=int, default=ENCODE_BENCHMARK_TEXTS, help="Optional: number of chunks encoded per run")
+    encode_parser.add_argument('--stub', action="store_true", help="Optional: use the offline stub encoder and synthetic movies")
+
+    analyzer_parser = subparsers.add_parser("analyzer", help="Compare per-call tokenization with the cached Analyzer")
+    analyzer_parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT, help="Optional: number of passes over the documents")
+
+    startup_parser = subparsers.add_parser("startup", help="Time CLI subcommands from a fresh interpreter and show their slowest imports")
+    startup_parser.add_argument("commands", type=str, nargs="*", help="Optional: commands to time, each one quoted, e.g. \"keyword_search_cli.py bm25search bear\"")
+    startup_parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT, help="Optional: number of runs per command")
+
+    scale_parser = subparsers.add_parser("scale", help="Build and query every subsystem over synthetic corpora of growing size, as JSON")
+    scale_parser.add_argument('--sizes', type=int, nargs="+", default=SCALE_BENCHMARK_SIZES, help="Optional: corpus sizes in movies, e.g. 10000 1000000 10000000")
+    scale_parser.add_argument('--subsystems', choices=SCALE_BENCHMARK_SUBSYSTEMS, nargs="+", default=list(SCALE_BENCHMARK_SUBSYSTEMS), help="Optional: subsystems to measure")
+    scale_parser.add_argument('--queries', type=int, default=SCALE_BENCHMARK_QUERIES, help="Optional: number of synthetic queries per search")
+    scale_parser.add_argument('--seed', type=int, default=SYNTHETIC_SEED, help="Optional: seed of the corpus and queries")
+    scale_parser.add_argument('--workdir', type=str, default=None, help="Optional: keep the corpora and caches in this directory")
+    scale_parser.add_argument('--output', type=str, default=None, help="Optional: write the JSON report to this file instead of stdout")
+
+    args = parser.parse_args()
+    trace = start_profile(args)
+
+    match args.command:
+        case "bm25":
+            bm25_command(args.queries, args.limit, args.repeat)
+        case "load":
+            load_command(args.repeat)
+        case "vector":
+            vector_command(args.queries, args.limit)
+        case "hybrid":
+            hybrid_command(args.queries, args.limit, args.repeat, args.workers)
+        case "encode":
+            encode_command(args.batch_sizes, args.workers, args.texts, args.stub)
+        case "analyzer":
+            analyzer_command(args.repeat)
+        case "startup":
+            startup_command([shlex.split(command) for command in args.commands] or STARTUP_BENCHMARK_COMMANDS, args.repeat)
+        case "scale":
+            scale_command(args.sizes, args.subsystems, args.queries, args.seed, args.workdir, args.output)
+        case _:
+            parser.print_help()
+
+    finish_profile(trace, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,3 +6,89 @@ DEFAULT_SEMANTIC_CHUNK_SIZE = 200
 DEFAULT_CHUNK_OVERLAP = 0
 SCORE_PRECISION = 2
 DEFAULT_ALPHA = 0.5
+BENCHMARK_REPEAT = 3
+BENCHMARK_QUERIES = ["space adventure", "dark knight", "bear", "romantic comedy", "alien invasion", "high school friends"]
+BM25_BLOCK_SIZE = 128
+BM25_PRUNING_EPSILON = 1e-9
+BM25_PRUNING_MIN_POSTINGS = 2048
+COLUMNAR_INDEX_VERSION = 1
+BENCHMARK_VECTOR_QUERIES = 20
+IVF_DEFAULT_NPROBE = 8
+IVF_KMEANS_ITERATIONS = 20
+IVF_TRAIN_POINTS_PER_LIST = 256
+IVF_ASSIGN_BATCH_SIZE = 65536
+IVF_RECALL_NPROBES = [1, 2, 4, 8, 16, 32]
+IVF_RECALL_QUERIES = 100
+QUANTIZATION_MODES = ("float16", "int8", "pq")
+QUANTIZATION_SCORE_BATCH_SIZE = 65536
+QUANTIZATION_RERANK_MIN = 100
+QUANTIZATION_RERANK_FACTOR = 10
+PQ_SUBSPACES = 8
+PQ_CENTROIDS = 256
+PQ_TRAIN_POINTS = 65536
+PQ_KMEANS_ITERATIONS = 15
+EMBEDDING_CACHE_VERSION = 1
+LIVE_INDEX_MERGE_MIN_DOCS = 10000 # delta segment size that triggers a background merge
+LIVE_INDEX_MERGE_DELETED_RATIO = 0.1 # share of tombstoned main documents that triggers one
+ANALYZER_STEM_CACHE_SIZE = 65536
+INDEX_BUILD_SHARDS_PER_WORKER = 4 # more shards than workers evens out uneven shards
+SEARCH_SERVER_HOST = "127.0.0.1"
+SEARCH_SERVER_PORT = 8765
+SEARCH_CLIENT_TIMEOUT = 60.0
+QUERY_CACHE_SIZE = 4096
+QUERY_CACHE_PERSISTENT = False # keep query embeddings in cache/QUERY_CACHE_FILE across restarts; CLIs also take --persist-query-cache
+QUERY_CACHE_UNCASED_MODELS = ("all-MiniLM-L6-v2", "stub-hashed-bow") # models that lowercase their input, so their cache keys can too
+QUERY_CACHE_FILE = "query_embeddings.sqlite"
+SEARCH_BATCH_SIZE = 64 # queries encoded and scored together by the batch searches
+MODEL_DIMENSIONS = {"all-MiniLM-L6-v2": 384} # lets cached embeddings be validated without loading the model
+STARTUP_BENCHMARK_COMMANDS = [
+    ["hybrid_search_cli.py", "normalize", "0.5", "2.3", "1.2"],
+    ["keyword_search_cli.py", "bm25search", "bear"],
+    ["semantic_search_cli.py", "chunk", "A bear goes on a space adventure."],
+    ["semantic_search_cli.py", "search", "bear"],
+]
+STARTUP_BENCHMARK_TOP_IMPORTS = 5
+HYBRID_POOL_SOURCES = ("semantic", "keyword")
+HYBRID_POOL_FROM = "semantic" # dense retrieval gives every query a pool, BM25 only queries with matching terms
+HYBRID_POOL_SIZE = 200
+HYBRID_RECALL_POOL_SIZES = [25, 50, 100, 200, 500, 1000]
+HYBRID_RECALL_QUERIES = 100
+RRF_K = 60
+RRF_PAGE_SIZE = 32 # first page pulled from each ranked stream, doubled on every pull
+RRF_RETRIEVERS = ("keyword", "semantic", "chunked")
+RRF_DEFAULT_RETRIEVERS = ["keyword", "chunked"]
+RRF_FETCH_ALL = 2**62 # "every result" for a full ranking fetch
+HYBRID_WORKERS = 4 # retriever threads of a HybridSearch, shared by all its queries; 0 runs them one after the other
+SYNTHETIC_SEED = 0
+SYNTHETIC_VOCABULARY_SIZE = 50000
+SYNTHETIC_ZIPF_EXPONENT = 1.07 # word frequencies fall off like natural text
+SYNTHETIC_SENTENCES = (2, 8) # sentences per description, inclusive
+SYNTHETIC_SENTENCE_WORDS = (5, 18) # words per sentence, inclusive
+SYNTHETIC_TITLE_WORDS = (1, 4)
+SYNTHETIC_BLOCK_SIZE = 10000 # movies generated per seeded block, so any block can be rebuilt alone
+STUB_ENCODER_MODEL = "stub-hashed-bow" # model name of the offline encoder, keeps its caches apart
+STUB_ENCODER_DIMENSION = 384
+STUB_ENCODER_BUCKETS = 4096 # hashed word buckets, each with a fixed random direction
+SCALE_BENCHMARK_SIZES = [10000, 100000]
+SCALE_BENCHMARK_QUERIES = 200
+SCALE_BENCHMARK_SUBSYSTEMS = ("index_build", "bm25_search", "index_spimi_build", "phrase_search", "embedding_build", "embedding_stream_build", "chunk_search", "weighted_search")
+PROFILE_CAPTURE_MODES = ("cprofile", "tracemalloc")
+PROFILE_CAPTURE_TOP = 25 # functions or allocation sites shown from a capture
+PROFILE_MAX_SPANS = 10000 # individual spans kept by a trace, stage totals keep counting past it
+PROFILE_TRACEMALLOC_FRAMES = 1
+DOCUMENT_STREAM_READ_SIZE = 1 << 20 # characters read at a time when streaming documents out of a JSON file
+EMBEDDING_BUILD_BATCH_SIZE = 256 # chunks encoded and written together by the streaming build
+SPIMI_MEMORY_BUDGET_MB = 256 # estimated posting block size that triggers a flush to disk
+SPIMI_ANALYZE_BATCH = 1024 # documents analyzed together between budget checks
+SPIMI_TERM_OVERHEAD_BYTES = 160 # dict entry, key string and two array headers of a term in a block
+SPIMI_MERGE_BUFFER = 1 << 20 # merged postings buffered before they are appended to the index
+DOCUMENT_STORE_VERSION = 1
+DOCUMENT_STORE_RESULT_FIELDS = ("title", "description") # stored fields fetched for a page of results
+ENCODE_BATCH_SIZE = 32 # texts per model call of an embedding build, the SentenceTransformer default
+ENCODE_WORKERS = 0 # encode processes of an embedding build; 0 encodes in this process
+ENCODE_PREFETCH_WINDOWS = 2 # windows of chunks read ahead of the encoder by the streaming build
+ENCODE_BENCHMARK_TEXTS = 2048
+ENCODE_BENCHMARK_BATCH_SIZES = [16, 32, 64, 128]
+PROXIMITY_BOOST_WEIGHT = 1.0 # BM25 points added when two query terms are adjacent, falling off with distance
+PROXIMITY_BOOST_ALPHA = 0.3 # smaller values make the boost fall off more slowly with distance
+PROXIMITY_RERANK_DEPTH = 100 # BM25 results reranked with the proximity boost
@@ -1,38 +1,92 @@
 import argparse
-import lib.hybrid_search as hybrid_search
+import lib.score_normalization as score_normalization
 
 import os
-import json
 
 from constants import *
+from lib.tracing import add_profile_arguments, finish_profile, start_profile
 
 def normalize(score_list : list[float]) -> list[float]:
-    return hybrid_search.normalize(score_list)
+    return score_normalization.normalize(score_list)
 
-def weighted_search(query : str, alpha : float = DEFAULT_ALPHA, limit : int = LIMIT):
+def weighted_search(query : str, alpha : float = DEFAULT_ALPHA, limit : int = LIMIT, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE, server : str | None = None, pool : int | None = None, pool_from : str = HYBRID_POOL_FROM, workers : int = HYBRID_WORKERS):
 
-    cur_path = os.path.dirname(__file__)
-    movie_path = os.path.join(cur_path, "..", "data", "movies.json") 
+    if server is not None:
+        from lib.search_client import SearchClient
+        results = SearchClient(server).search("hybrid", query, limit, alpha=alpha, ann=ann, nprobe=nprobe, pool=pool, pool_from=pool_from)
+        for rank, doc in enumerate(results, start=1):
+            print_result(rank, doc, doc)
+        return
 
-    with open(movie_path, "r") as mov_file:
-        movies = json.load(mov_file)["movies"]
+    import lib.hybrid_search as hybrid_search # pulls in numpy and the search indexes
 
-    hybrid_class = hybrid_search.HybridSearch(movies)
-    sorted_scores = hybrid_class.weighted_search(query, alpha, limit)
+    hybrid_class = hybrid_search.HybridSearch(open_movies(), workers=workers)
+    if pool is None:
+        sorted_scores = hybrid_class.weighted_search(query, alpha, limit, ann, nprobe)
+    else:
+        sorted_scores = hybrid_class.pooled_search(query, alpha, limit, pool, pool_from, ann, nprobe)
     
-    document_map = {}
-    for doc in hybrid_class.documents:
-        document_map[doc["id"]] = doc
+    documents = hybrid_class.documents.fetch(sorted_scores)
+    for rank, (doc, scores) in enumerate(zip(documents, sorted_scores.values()), start=1):
+        print_result(rank, doc, scores)
+
+def batch_weighted_search(input_path : str, output_path : str, alpha : float = DEFAULT_ALPHA, limit : int = LIMIT, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE) -> None:
+    cur_path = os.path.dirname(__file__)
+    movie_path = os.path.join(cur_path, "..", "data", "movies.json")
+
+    from lib.batch_queries import batch_command
+    from lib.search_server import SearchService
+
+    service = SearchService(movie_path)
+    batch_command(input_path, output_path, lambda queries: service.search_many("hybrid", queries, limit, alpha=alpha, ann=ann, nprobe=nprobe))
+
+def pool_recall(alpha : float = DEFAULT_ALPHA, k : int = LIMIT, n_queries : int = HYBRID_RECALL_QUERIES, pool_sizes : list[int] = HYBRID_RECALL_POOL_SIZES, pool_from : str = HYBRID_POOL_FROM) -> None:
+    import lib.hybrid_search as hybrid_search
+
+    movies = open_movies()
+    step = max(1, len(movies) // n_queries)
+    queries = [movies[position]["title"] for position in range(0, len(movies), step)[:n_queries]]
+
+    with hybrid_search.HybridSearch(movies) as hybrid:
+        report = hybrid.pool_recall(queries, alpha, k, pool_sizes, pool_from)
+
+    print(f"{len(queries)} queries, candidates from {pool_from}")
+    for pool_size, stats in report.items():
+        name = "full" if pool_size == 0 else f"pool={pool_size}"
+        print(f"{name:<12} recall@{k}: {stats["recall"]:.3f}  mean: {stats["mean_ms"]:.3f} ms")
+
+def rrf_search(query : str, k : int = RRF_K, limit : int = LIMIT, retrievers : list[str] = RRF_DEFAULT_RETRIEVERS, streaming : bool = True, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE, workers : int = HYBRID_WORKERS) -> None:
+    import lib.hybrid_search as hybrid_search
 
-    for rank, (movie_id, scores) in enumerate(sorted_scores.items(), start=1):
-        doc = document_map[movie_id]
+    hybrid_class = hybrid_search.HybridSearch(open_movies(), workers=workers)
+    fused = hybrid_class.rrf_search(query, k, limit, retrievers, streaming, ann, nprobe)
+
+    documents = hybrid_class.documents.fetch(fused)
+    for rank, (doc, scores) in enumerate(zip(documents, fused.values()), start=1):
+        ranks = ", ".join(f"{name}: {scores[f"{name}_rank"] or "-"}" for name in retrievers)
         print(f"{rank}. {doc["title"]}")
-        print(f"   Hybrid Score: {scores["hybrid_score"]:.4f}")
-        print(f"   BM25: {scores["keyword_score"]:.4f}, Semantic: {scores["semantic_score"]:.4f}")
+        print(f"   RRF Score: {scores["rrf_score"]:.4f}")
+        print(f"   Ranks: {ranks}")
         print(f"   {doc["description"][:100]}...")
 
+def open_movies():
+    """The movies as a memory-mapped DocumentStore, rewritten from data/movies.json when it changed."""
+    from lib.document_store import load_or_create_document_store
+
+    cur_path = os.path.dirname(__file__)
+    movie_path = os.path.join(cur_path, "..", "data", "movies.json")
+    return load_or_create_document_store(os.path.join(cur_path, "..", "cache", "movies"), movie_path)
+
+def print_result(rank : int, doc : dict, scores : dict[str, float]) -> None:
+    print(f"{rank}. {doc["title"]}")
+    print(f"   Hybrid Score: {scores["hybrid_score"]:.4f}")
+    print(f"   BM25: {scores["keyword_score"]:.4f}, Semantic: {scores["semantic_score"]:.4f}")
+    print(f"   {doc["description"][:100]}...")
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
+    add_profile_arguments(parser)
+    parser.add_argument('--persist-query-cache', action="store_true", help=f"Optional: keep query embeddings in cache/{QUERY_CACHE_FILE} across runs")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     normalize_command = subparsers.add_parser("normalize", help="Normalize a list of floats")
@@ -42,8 +96,44 @@ def main() -> None:
     weighted_search_command.add_argument("query", type=str, help="Query for searching")
     weighted_search_command.add_argument( '--alpha', type=float, default=DEFAULT_ALPHA, help="Optional: alpha (or \"α\") is just a constant that we can use to dynamically control the weighting between the two scores.")
     weighted_search_command.add_argument( '--limit', type=int, default=LIMIT, help="Optional: set a limit on the number of items to process.")
+    weighted_search_command.add_argument( '--ann', action="store_true", help="Optional: use the approximate IVF index for the semantic side.")
+    weighted_search_command.add_argument( '--nprobe', type=int, default=IVF_DEFAULT_NPROBE, help="Optional: number of IVF lists to search with --ann.")
+    weighted_search_command.add_argument( '--pool', type=int, default=None, help="Optional: fuse only this many candidates from one retriever, scored by the other.")
+    weighted_search_command.add_argument( '--pool-from', choices=HYBRID_POOL_SOURCES, default=HYBRID_POOL_FROM, help="Optional: retriever that picks the --pool candidates.")
+    weighted_search_command.add_argument( '--workers', type=int, default=HYBRID_WORKERS, help="Optional: threads the retrievers run on, 0 runs them one after the other.")
+    weighted_search_command.add_argument( '--server', type=str, default=None, help="Optional: send the search to a running search server (host:port or unix:/path).")
+
+    rrf_search_command = subparsers.add_parser("rrf-search", help="Fuse the rankings of several retrievers with Reciprocal Rank Fusion")
+    rrf_search_command.add_argument("query", type=str, help="Query for searching")
+    rrf_search_command.add_argument( '--k', type=int, default=RRF_K, help="Optional: RRF constant, higher values flatten the weight of top ranks.")
+    rrf_search_command.add_argument( '--limit', type=int, default=LIMIT, help="Optional: set a limit on the number of items to process.")
+    rrf_search_command.add_argument( '--retrievers', choices=RRF_RETRIEVERS, nargs="+", default=RRF_DEFAULT_RETRIEVERS, help="Optional: rankings to fuse.")
+    rrf_search_command.add_argument( '--exhaustive', dest="streaming", action="store_false", help="Optional: fuse the full rankings instead of stopping once the top results are settled.")
+    rrf_search_command.add_argument( '--ann', action="store_true", help="Optional: use the approximate IVF index for the chunked ranking.")
+    rrf_search_command.add_argument( '--nprobe', type=int, default=IVF_DEFAULT_NPROBE, help="Optional: number of IVF lists to search with --ann.")
+    rrf_search_command.add_argument( '--workers', type=int, default=HYBRID_WORKERS, help="Optional: threads the retrievers run on, 0 runs them one after the other.")
+
+    pool_recall_command = subparsers.add_parser("pool_recall", help="Measure recall@k and latency of pooled weighted search against the full weighted search")
+    pool_recall_command.add_argument( '--alpha', type=float, default=DEFAULT_ALPHA, help="Optional: weight of the BM25 score against the semantic score.")
+    pool_recall_command.add_argument( '--k', type=int, default=LIMIT, help="Optional: number of results compared per query.")
+    pool_recall_command.add_argument( '--queries', type=int, default=HYBRID_RECALL_QUERIES, help="Optional: number of movie titles used as queries.")
+    pool_recall_command.add_argument( '--pool', type=int, nargs="+", default=HYBRID_RECALL_POOL_SIZES, help="Optional: pool sizes to measure.")
+    pool_recall_command.add_argument( '--pool-from', choices=HYBRID_POOL_SOURCES, default=HYBRID_POOL_FROM, help="Optional: retriever that picks the candidates.")
+
+    batch_search_command = subparsers.add_parser("batch", help="Answer many weighted searches from a JSONL file, writing JSONL results")
+    batch_search_command.add_argument( '--input', type=str, default="-", help="Optional: JSONL file of queries, \"-\" for stdin.")
+    batch_search_command.add_argument( '--output', type=str, default="-", help="Optional: JSONL file for the results, \"-\" for stdout.")
+    batch_search_command.add_argument( '--alpha', type=float, default=DEFAULT_ALPHA, help="Optional: weight of the BM25 score against the semantic score.")
+    batch_search_command.add_argument( '--limit', type=int, default=LIMIT, help="Optional: number of results per query.")
+    batch_search_command.add_argument( '--ann', action="store_true", help="Optional: use the approximate IVF index for the semantic side.")
+    batch_search_command.add_argument( '--nprobe', type=int, default=IVF_DEFAULT_NPROBE, help="Optional: number of IVF lists to search with --ann.")
 
     args = parser.parse_args()
+    trace = start_profile(args)
+    if args.persist_query_cache:
+        from lib.query_cache import enable_persistent_query_cache
+
+        enable_persistent_query_cache()
 
     match args.command:
         case "normalize":
@@ -51,10 +141,18 @@ def main() -> None:
             for score in norm_list:
                 print(f"* {score:.4f}")
         case "weighted-search":
-            weighted_search(args.query, args.alpha, args.limit)
+            weighted_search(args.query, args.alpha, args.limit, args.ann, args.nprobe, args.server, args.pool, args.pool_from, args.workers)
+        case "rrf-search":
+            rrf_search(args.query, args.k, args.limit, args.retrievers, args.streaming, args.ann, args.nprobe, args.workers)
+        case "pool_recall":
+            pool_recall(args.alpha, args.k, args.queries, args.pool, args.pool_from)
+        case "batch":
+            batch_weighted_search(args.input, args.output, args.alpha, args.limit, args.ann, args.nprobe)
         case _:
             parser.print_help()
 
+    finish_profile(trace, args)
+
 
 if __name__ == "__main__":
     main()
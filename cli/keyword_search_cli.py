@@ -3,16 +3,30 @@
 import argparse
 import os
 import json
-import string
-from nltk.stem import PorterStemmer
 
-from lib.keyword_search import InvertedIndex
+from lib.keyword_search import InvertedIndex, convert_pickles_to_columnar
 from constants import *
+from lib.tracing import add_profile_arguments, finish_profile, start_profile
 
-def build_command() -> None:
+def build_command(workers : int = 1, memory_budget_mb : float | None = None, positions : bool = False) -> None:
     inverted_index = InvertedIndex()
-    inverted_index.build()
+    if memory_budget_mb is not None:
+        if positions:
+            raise ValueError("Positions are not supported by the on-disk build (--memory-budget)")
+        inverted_index.build_spimi(memory_budget_mb)
+        stats = inverted_index.build_stats
+        print(f"Indexed {stats["documents"]} documents, {stats["terms"]} terms in {stats["blocks"]} blocks")
+        print(f"Largest block: {stats["peak_block_mb"]:.1f} MB, peak RSS: {stats["peak_rss_mb"]:.1f} MB")
+        return
+
+    inverted_index.build(workers, positions)
     inverted_index.save()
+    if positions:
+        from lib.columnar_index import ColumnarIndex
+
+        sizes = ColumnarIndex(inverted_index.index_path).size_mb()
+        overhead = sizes["positions_mb"] / sizes["postings_mb"] * 100 if sizes["postings_mb"] else 0.0
+        print(f"Postings: {sizes["postings_mb"]:.1f} MB, positions: {sizes["positions_mb"]:.1f} MB (+{overhead:.0f}%)")
     #docs = inverted_index.get_documents("merida")
 
     #print(f"First document for token 'merida' = {docs[0]}")
@@ -56,17 +70,6 @@ def bm25_tf_command(doc_id : int, term : str, k1 : float, b : float) -> float:
 
     return inverted_index.get_bm25_tf(doc_id, term, k1, b)
 
-def clean(dirty_str : str, stop_words : list[str]) -> list[str]:
-    cleaned_str = dirty_str.lower() # Case senesetive
-    cleaned_str = cleaned_str.translate(str.maketrans('', '', string.punctuation)) # Remove punctuations
-    cleaned_str = cleaned_str.split(" ") # Tokenization
-    cleaned_str = [word for word in cleaned_str if word not in stop_words] # Remove stop words
-
-    stemmer = PorterStemmer()
-    cleaned_str = [stemmer.stem(token) for token in cleaned_str] # Stem words
-
-    return cleaned_str
-
 def has_matching_token(query_tokens: list[str], title_tokens: list[str]) -> bool:
     for query_token in query_tokens:
         for title_token in title_tokens:
@@ -80,8 +83,7 @@ def search_command(query : str, limit : int = 5) -> tuple[list[dict], bool, int]
     inverted_index = InvertedIndex()
     inverted_index.load()
 
-    stop_words = inverted_index.get_stopwords()
-    tokens = clean(query, stop_words)
+    tokens = inverted_index.tokenize(query)
     
     movie_matches = []
     
@@ -101,11 +103,25 @@ def search_command(query : str, limit : int = 5) -> tuple[list[dict], bool, int]
 
     return movie_matches, over_limit, total_matches_found
 
-def bm25search_command(query : str, limit : int = 5) -> None:
+def bm25search_command(query : str, limit : int = 5, server : str | None = None, proximity : bool = False) -> None:
+    if server is not None:
+        from lib.search_client import SearchClient
+
+        for i, result in enumerate(SearchClient(server).search("keyword", query, limit)):
+            print(f"{i + 1}. ({result["id"]}) {result["title"]} - Score: {result["score"]:.2f}")
+        return
+
     inverted_index = InvertedIndex()
     inverted_index.load()
     
-    scores = inverted_index.bm25_search(query, limit)
+    if proximity:
+        try:
+            scores = inverted_index.bm25_proximity_search(query, limit)
+        except ValueError as e:
+            print(e) # the index was built without positions
+            return
+    else:
+        scores = inverted_index.bm25_search(query, limit)
     if len(scores) == 0:
         return
 
@@ -130,16 +146,46 @@ def bm25search_command(query : str, limit : int = 5) -> None:
         print(f"{i + 1}. ({doc_id}) {inverted_index.docmap[doc_id]["title"]} - Score: {score:.2f}")
 
 
+def phrase_command(query : str, limit : int = 5, slop : int = 0) -> None:
+    inverted_index = InvertedIndex()
+    inverted_index.load()
+
+    try:
+        scores = inverted_index.phrase_search(query, limit, slop)
+    except ValueError as e:
+        print(e) # the index was built without positions
+        return
+
+    for i, (doc_id, score) in enumerate(scores.items()):
+        print(f"{i + 1}. ({doc_id}) {inverted_index.docmap[doc_id]["title"]} - Score: {score:.2f}")
+
+
+def batch_search_command(input_path : str, output_path : str, limit : int = LIMIT) -> None:
+    cur_path = os.path.dirname(__file__)
+    movie_path = os.path.join(cur_path, "..", "data", "movies.json")
+
+    from lib.batch_queries import batch_command
+    from lib.search_server import SearchService
+
+    service = SearchService(movie_path)
+    batch_command(input_path, output_path, lambda queries: service.search_many("keyword", queries, limit))
+
 def main() -> None:
     trunc_len = 5
 
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
+    add_profile_arguments(parser)
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
     search_parser.add_argument("query", type=str, help="Search query")
 
     build_parser = subparsers.add_parser("build", help="Build and inverted index and save it to file")
+    build_parser.add_argument('--workers', type=int, default=1, help="Optional: number of processes tokenizing the corpus in parallel")
+    build_parser.add_argument('--memory-budget', type=float, default=None, help=f"Optional: build on disk, flushing posting blocks of this many MB (e.g. {SPIMI_MEMORY_BUDGET_MB}), for corpora larger than RAM")
+    build_parser.add_argument('--positions', action="store_true", help="Optional: also store token positions, for phrase search and proximity boosts")
+
+    convert_parser = subparsers.add_parser("convert", help="Convert a pickled index from older versions to the columnar format")
 
     tf_parser = subparsers.add_parser("tf", help="Search term frequency in a document")
     tf_parser.add_argument("doc_id", type=int, help="Document id")
@@ -163,10 +209,21 @@ def main() -> None:
 
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
     bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument('--server', type=str, default=None, help="Optional: send the search to a running search server (host:port or unix:/path)")
+    bm25search_parser.add_argument('--proximity', action="store_true", help="Optional: boost documents where query terms occur close together (needs an index built with --positions)")
+
+    phrase_parser = subparsers.add_parser("phrase", help="Search movies containing the query as a phrase (needs an index built with --positions)")
+    phrase_parser.add_argument("query", type=str, help="Phrase to search for")
+    phrase_parser.add_argument('--slop', type=int, default=0, help="Optional: number of other terms allowed inside the phrase")
+    batch_parser = subparsers.add_parser("batch", help="Answer many BM25 queries from a JSONL file, writing JSONL results")
+    batch_parser.add_argument('--input', type=str, default="-", help="Optional: JSONL file of queries, \"-\" for stdin")
+    batch_parser.add_argument('--output', type=str, default="-", help="Optional: JSONL file for the results, \"-\" for stdout")
+
     parser.add_argument( '--limit', type=int, default=LIMIT, help="Optional: set a limit on the number of items to process."
     )
 
     args = parser.parse_args()
+    trace = start_profile(args)
 
     match args.command:
         case "search":
@@ -181,7 +238,12 @@ def main() -> None:
             print(f"Total found: {total_matches_found}")
 
         case "build":
-            build_command()
+            if args.positions and args.memory_budget is not None:
+                parser.error("--positions is not supported with --memory-budget")
+            build_command(args.workers, args.memory_budget, args.positions)
+
+        case "convert":
+            convert_pickles_to_columnar()
 
         case "tf":
             term_frequency = tf_command(args.doc_id, args.term)
@@ -209,11 +271,21 @@ def main() -> None:
             print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25_tf:.2f}")
 
         case "bm25search":
-            bm25search_command(args.query)
+            if args.proximity and args.server is not None:
+                parser.error("--proximity is not supported with --server")
+            bm25search_command(args.query, server=args.server, proximity=args.proximity)
+
+        case "phrase":
+            phrase_command(args.query, args.limit, args.slop)
+
+        case "batch":
+            batch_search_command(args.input, args.output, args.limit)
 
         case _:
             parser.print_help()
 
+    finish_profile(trace, args)
+
 
 if __name__ == "__main__":
     main()
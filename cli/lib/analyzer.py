@@ -0,0 +1,54 @@
+import string
+from functools import lru_cache
+
+from constants import *
+
+
+class Analyzer:
+    """Turns text into index terms: lowercase, strip punctuation, split on spaces,
+    drop stopwords and Porter-stem.
+
+    Everything that does not depend on the text is prepared once here, and
+    stems are memoized, since the same few thousand words make up most of
+    any corpus and most queries.
+    """
+
+    def __init__(self, stop_words: list[str], stem_cache_size: int = ANALYZER_STEM_CACHE_SIZE) -> None:
+        self.stop_words = frozenset(stop_words)
+        self._punctuation_table = str.maketrans("", "", string.punctuation)
+        from nltk.stem import PorterStemmer # imported here: nltk takes about half a second to import
+        self._stemmer = PorterStemmer()
+        self.stem = lru_cache(maxsize=stem_cache_size)(self._stemmer.stem)
+
+    @classmethod
+    def from_stopwords_file(cls, path: str) -> "Analyzer":
+        with open(path, "r") as stop_words_file:
+            return cls(stop_words_file.read().splitlines())
+
+    def analyze(self, text: str) -> list[str]:
+        stop_words = self.stop_words
+        stem = self.stem
+        words = text.lower().translate(self._punctuation_table).split(" ")
+        return [stem(word) for word in words if word not in stop_words]
+
+    def analyze_many(self, texts: list[str]) -> list[list[str]]:
+        """Analyze a batch of texts, looking each distinct word up in the stem cache only once."""
+        stop_words = self.stop_words
+        table = self._punctuation_table
+        stem = self.stem
+        stems = {}  # word : stem, for this batch
+
+        analyzed = []
+        for text in texts:
+            tokens = []
+            for word in text.lower().translate(table).split(" "):
+                if word in stop_words:
+                    continue
+                try:
+                    tokens.append(stems[word])
+                except KeyError:
+                    stems[word] = stem(word)
+                    tokens.append(stems[word])
+            analyzed.append(tokens)
+
+        return analyzed
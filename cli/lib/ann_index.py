@@ -0,0 +1,107 @@
+import math
+import os
+
+import numpy as np
+
+from constants import *
+
+
+class IVFIndex:
+    """Inverted-file index over unit-length vectors.
+
+    A spherical k-means splits the rows into `n_lists` clusters. A query
+    only scores the rows of its `nprobe` closest clusters, so raising
+    nprobe trades latency for recall.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray) -> None:
+        self.centroids = centroids  # (n_lists, dim), unit length
+        self.list_offsets = list_offsets  # list : first position in list_rows (one extra end entry)
+        self.list_rows = list_rows  # row ids grouped by list, ascending inside each list
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.list_rows)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        n_lists: int | None = None,
+        iterations: int = IVF_KMEANS_ITERATIONS,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        n_rows = len(vectors)
+        if n_lists is None:
+            n_lists = max(1, int(math.sqrt(n_rows)))
+        n_lists = max(1, min(n_lists, n_rows))
+        rng = np.random.default_rng(seed)
+
+        # Train on a sample; a few hundred points per list is plenty for k-means.
+        train_size = min(n_rows, n_lists * IVF_TRAIN_POINTS_PER_LIST)
+        train = vectors[np.sort(rng.choice(n_rows, train_size, replace=False))]
+        centroids = train[rng.choice(train_size, n_lists, replace=False)].astype(np.float32)
+
+        for _ in range(iterations):
+            assignment = _nearest_centroid(train, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, train)
+            counts = np.bincount(assignment, minlength=n_lists)
+
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = train[rng.choice(train_size, int(empty.sum()), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids = (sums / norms).astype(np.float32)
+
+        assignment = _nearest_centroid(vectors, centroids)
+        list_rows = np.argsort(assignment, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+
+        return cls(centroids, list_offsets, list_rows.astype(np.int64))
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_rows"])
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as ann_file:
+            np.savez(
+                ann_file,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_rows=self.list_rows,
+            )
+
+    def candidates(self, query: np.ndarray, nprobe: int = IVF_DEFAULT_NPROBE) -> np.ndarray:
+        """Sorted row ids from the `nprobe` lists whose centroids are closest to `query`."""
+        nprobe = max(1, min(nprobe, self.n_lists))
+        centroid_scores = self.centroids @ query
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        rows = [self.list_rows[self.list_offsets[p] : self.list_offsets[p + 1]] for p in probes]
+        return np.sort(np.concatenate(rows))
+
+
+def _nearest_centroid(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), IVF_ASSIGN_BATCH_SIZE):
+        batch = vectors[start : start + IVF_ASSIGN_BATCH_SIZE]
+        assignment[start : start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignment
+
+
+def recall_at_k(exact: list[list[int]], approximate: list[list[int]], k: int) -> float:
+    """Mean share of each exact top-k that the approximate top-k also found."""
+    if not exact or k <= 0:
+        return 0.0
+    hits = [len(set(e[:k]) & set(a[:k])) / min(k, max(len(e[:k]), 1)) for e, a in zip(exact, approximate)]
+    return sum(hits) / len(hits)
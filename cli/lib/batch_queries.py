@@ -0,0 +1,66 @@
+import json
+import sys
+from collections.abc import Callable, Iterable, Iterator
+from itertools import batched
+from typing import TextIO
+
+from constants import *
+
+
+def read_requests(lines : Iterable[str]) -> Iterator[dict]:
+    """Batch requests from JSONL lines.
+
+    A line is either a JSON string (the query) or an object with a "query"
+    key; any other keys, such as an "id", are copied to the output line.
+    Blank lines are skipped.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+
+        request = json.loads(line)
+        if isinstance(request, str):
+            request = {"query": request}
+        if not isinstance(request, dict) or not isinstance(request.get("query"), str):
+            raise ValueError(f"Line {line_number}: expected a JSON string or an object with a \"query\" string")
+
+        yield request
+
+
+def run_batch(
+    requests : Iterable[dict],
+    search_many : Callable[[list[str]], Iterable[list[dict]]],
+    output : TextIO,
+    batch_size : int = SEARCH_BATCH_SIZE,
+) -> int:
+    """Answer `requests` with `search_many`, one batch at a time, writing one JSONL line per request.
+
+    Lines are flushed as soon as their batch is scored, so results stream
+    out while later queries are still being read. Returns the number of
+    requests answered.
+    """
+    answered = 0
+    for batch in batched(requests, batch_size):
+        results = search_many([request["query"] for request in batch])
+        for request, result in zip(batch, results):
+            output.write(json.dumps({**request, "results": result}) + "\n")
+            answered += 1
+        output.flush()
+
+    return answered
+
+
+def batch_command(input_path : str, output_path : str, search_many : Callable[[list[str]], Iterable[list[dict]]]) -> None:
+    """Run a batch from a JSONL file (or "-" for stdin) into a JSONL file (or "-" for stdout)."""
+    input_file = sys.stdin if input_path == "-" else open(input_path, "r")
+    output_file = sys.stdout if output_path == "-" else open(output_path, "w")
+
+    try:
+        answered = run_batch(read_requests(input_file), search_many, output_file)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+    print(f"Answered {answered} queries", file=sys.stderr)
@@ -0,0 +1,426 @@
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from constants import *
+
+from .analyzer import Analyzer
+from .columnar_index import ColumnarIndex, columnar_index_exists
+from .keyword_search import InvertedIndex
+from .tracing import peak_rss_mb
+
+CLI_PATH = os.path.join(os.path.dirname(__file__), "..")
+DATA_MOVIES_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "data", "movies.json")
+
+
+def load_movies() -> list[dict]:
+    with open(DATA_MOVIES_PATH, "r") as mov_file:
+        return json.load(mov_file)["movies"]
+
+
+def time_queries(search_fn, queries : list[str], repeat : int = BENCHMARK_REPEAT) -> dict[str, float]:
+    timings = [] # seconds per query
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            search_fn(query)
+            timings.append(time.perf_counter() - start)
+
+    return {
+        "queries": len(timings),
+        "mean_ms": statistics.mean(timings) * 1000,
+        "median_ms": statistics.median(timings) * 1000,
+        "max_ms": max(timings) * 1000,
+    }
+
+
+def time_call(fn, repeat : int = BENCHMARK_REPEAT) -> dict[str, float]:
+    timings = [] # seconds per call
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "queries": len(timings),
+        "mean_ms": statistics.mean(timings) * 1000,
+        "median_ms": statistics.median(timings) * 1000,
+        "max_ms": max(timings) * 1000,
+    }
+
+
+def load_benchmark(repeat : int = BENCHMARK_REPEAT) -> dict[str, dict]:
+    report = {"columnar": time_call(lambda: InvertedIndex().load(), repeat)}
+    try:
+        report["pickles"] = time_call(lambda: InvertedIndex().load_pickles(), repeat)
+    except FileNotFoundError:
+        pass # index was never saved in the old format
+
+    return report
+
+
+def bm25_benchmark(queries : list[str], limit : int = LIMIT, repeat : int = BENCHMARK_REPEAT) -> dict[str, dict]:
+    inverted_index = InvertedIndex()
+    inverted_index.load()
+
+    scorer = inverted_index._scorer
+    tokenize = inverted_index.tokenize
+
+    mismatches = [
+        query for query in queries
+        if inverted_index.bm25_search(query, limit) != inverted_index.bm25_search_exhaustive(query, limit)
+        or scorer.top_k(tokenize(query), limit) != scorer.top_k_exhaustive(tokenize(query), limit)
+    ]
+
+    return {
+        "exhaustive": time_queries(lambda q: inverted_index.bm25_search_exhaustive(q, limit), queries, repeat),
+        "postings": time_queries(lambda q: scorer.top_k_exhaustive(tokenize(q), limit), queries, repeat),
+        "block_max": time_queries(lambda q: scorer.top_k(tokenize(q), limit), queries, repeat),
+        "mismatches": mismatches,
+    }
+
+
+def vector_benchmark(queries : int = BENCHMARK_VECTOR_QUERIES, limit : int = LIMIT) -> dict[str, dict]:
+    from . import semantic_search as semsearch
+    from .chunked_sematic_search import ChunkedSemanticSearch
+
+    chunked_semantic_search = ChunkedSemanticSearch()
+    chunked_semantic_search.load_or_create_chunk_embeddings(load_movies())
+    embeddings = chunked_semantic_search.chunk_embeddings
+
+    rng = np.random.default_rng(0)
+    query_vectors = rng.standard_normal((queries, embeddings.shape[1])).astype(embeddings.dtype)
+
+    def per_row(query_vector : np.ndarray) -> None:
+        # The search loop before vectorization: one cosine_similarity call per chunk row.
+        scores = [semsearch.cosine_similarity(query_vector, row) for row in embeddings]
+        mov_score_map = {}
+        for chunk_idx, score in enumerate(scores):
+            movie_idx = chunked_semantic_search.chunk_metadata[chunk_idx]["movie_idx"]
+            if movie_idx not in mov_score_map or score > mov_score_map[movie_idx]:
+                mov_score_map[movie_idx] = score
+        sorted(mov_score_map.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    vectors = iter(query_vectors)
+    per_row_timings = time_call(lambda: per_row(next(vectors)), queries)
+    vectors = iter(query_vectors)
+    vectorized_timings = time_call(lambda: chunked_semantic_search.search_chunks_by_vector(next(vectors), limit), queries)
+
+    return {"chunks": len(embeddings), "per_row": per_row_timings, "vectorized": vectorized_timings}
+
+
+def encode_benchmark(
+    batch_sizes : list[int] = ENCODE_BENCHMARK_BATCH_SIZES,
+    workers : list[int] = [ENCODE_WORKERS],
+    n_texts : int = ENCODE_BENCHMARK_TEXTS,
+    stub : bool = False,
+) -> dict:
+    """Chunks per second of the encode pipeline per worker count and batch size, sorted by length and not.
+
+    Encodes the first `n_texts` movie chunks, or synthetic ones with the
+    offline stub encoder, so the settings can be tuned per machine.
+    """
+    from . import semantic_search as semsearch
+    from .encode_pipeline import EncodePipeline
+
+    if stub:
+        from .synthetic_corpus import StubEncoder, generate_movies
+        model, model_name = StubEncoder(), None
+        movies = generate_movies(n_texts)
+    else:
+        model, model_name = None, semsearch.SemanticSearch().model_name
+        movies = load_movies()
+
+    texts = []
+    for movie in movies:
+        texts += semsearch.semantic_chunk(movie["description"], DEFAULT_SEMANTIC_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP)
+        if len(texts) >= n_texts:
+            break
+    texts = texts[:n_texts]
+
+    def load_model():
+        nonlocal model
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(model_name)
+        return model
+
+    report = {"texts": len(texts), "runs": []}
+    for n_workers in workers:
+        for batch_size in batch_sizes:
+            for sort_by_length in (True, False):
+                with EncodePipeline(load_model, model_name, batch_size, n_workers, sort_by_length) as pipeline:
+                    if n_workers > 0:
+                        pipeline.encode(texts[: batch_size * 2]) # start the pool and load the models untimed
+                        pipeline.stats = {"texts": 0, "batches": 0, "encode_s": 0.0}
+                    pipeline.encode(texts)
+                    report["runs"].append({"workers": n_workers, "batch_size": batch_size, "sorted": sort_by_length, **pipeline.throughput()})
+
+    return report
+
+
+def hybrid_benchmark(queries : list[str], limit : int = LIMIT, repeat : int = BENCHMARK_REPEAT, workers : int = HYBRID_WORKERS) -> dict[str, dict]:
+    """Latency of each retriever alone and of weighted_search run sequentially and concurrently.
+
+    Query embeddings are not cached, so every search pays for the encode.
+    """
+    from .chunked_sematic_search import ChunkedSemanticSearch
+    from .hybrid_search import HybridSearch
+    from .keyword_search import load_or_build_index
+    from .query_cache import QueryEmbeddingCache
+
+    movies = load_movies()
+    chunked_semantic_search = ChunkedSemanticSearch(query_cache=QueryEmbeddingCache(max_size=0))
+    chunked_semantic_search.load_or_create_chunk_embeddings(movies)
+    inverted_index = load_or_build_index()
+    sequential = HybridSearch(movies, chunked_semantic_search, inverted_index, workers=0)
+    chunked_semantic_search.model # built once, before any timing
+
+    with HybridSearch(movies, chunked_semantic_search, inverted_index, workers=workers) as concurrent:
+        return {
+            "keyword": time_queries(lambda q: inverted_index.bm25_search(q, limit * 500), queries, repeat),
+            "chunked": time_queries(lambda q: chunked_semantic_search.search_chunks(q, limit * 500), queries, repeat),
+            "sequential": time_queries(lambda q: sequential.weighted_search(q, DEFAULT_ALPHA, limit), queries, repeat),
+            "concurrent": time_queries(lambda q: concurrent.weighted_search(q, DEFAULT_ALPHA, limit), queries, repeat),
+        }
+
+
+def analyzer_benchmark(repeat : int = BENCHMARK_REPEAT) -> dict[str, dict]:
+    from nltk.stem import PorterStemmer
+
+    inverted_index = InvertedIndex()
+    stop_words = list(inverted_index.analyzer.stop_words)
+    texts = [f"{movie["title"]} {movie["description"]}" for movie in load_movies()]
+
+    def per_call(text : str) -> list[str]:
+        # Tokenization before the Analyzer: new table, stemmer and stopword list scan per call.
+        words = text.lower().translate(str.maketrans("", "", string.punctuation)).split(" ")
+        words = [word for word in words if word not in stop_words]
+        stemmer = PorterStemmer()
+        return [stemmer.stem(word) for word in words]
+
+    analyzer = Analyzer(stop_words)
+    mismatches = sum(per_call(text) != tokens for text, tokens in zip(texts, analyzer.analyze_many(texts)))
+
+    return {
+        "documents": len(texts),
+        "per_call": time_call(lambda: [per_call(text) for text in texts], repeat),
+        # A fresh Analyzer per pass, as in a build, and a warm one, as for queries
+        "analyze_many": time_call(lambda: Analyzer(stop_words).analyze_many(texts), repeat),
+        "analyze": time_call(lambda: [analyzer.analyze(text) for text in texts], repeat),
+        "mismatches": mismatches,
+    }
+
+
+def startup_benchmark(commands : list[list[str]] = STARTUP_BENCHMARK_COMMANDS, repeat : int = BENCHMARK_REPEAT) -> dict[str, dict]:
+    """Wall time of each CLI command in a fresh interpreter, and its slowest top-level imports.
+
+    Each command is a CLI script name followed by its arguments, run from
+    the cli directory. Import times come from one extra run with
+    `python -X importtime`.
+    """
+    report = {}
+    for command in commands:
+        args = [sys.executable, *command]
+
+        def run() -> None:
+            subprocess.run(args, cwd=CLI_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+        timings = time_call(run, repeat)
+        traced = subprocess.run(
+            [sys.executable, "-X", "importtime", *command], cwd=CLI_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        report[" ".join(command)] = {"timings": timings, "imports": top_level_imports(traced.stderr)}
+
+    return report
+
+
+def top_level_imports(importtime_log : str, top : int = STARTUP_BENCHMARK_TOP_IMPORTS) -> list[tuple[str, float]]:
+    """(module, cumulative ms) of the slowest imports made directly by the program, from `-X importtime` output."""
+    imports = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        if name.startswith(" ") and not name.startswith("  "): # nested imports are indented further
+            try:
+                imports.append((name.strip(), int(cumulative) / 1000))
+            except ValueError:
+                pass # the header line
+
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:top]
+
+
+def latency_stats(timings : list[float]) -> dict[str, float]:
+    """Percentile latencies in ms and single-threaded throughput, from per-query seconds."""
+    ms = np.asarray(timings) * 1000
+    return {
+        "queries": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+        "qps": float(len(ms) / (ms.sum() / 1000)) if ms.sum() > 0 else 0.0,
+    }
+
+
+def scale_stage(stage : str, workdir : str, n_queries : int = SCALE_BENCHMARK_QUERIES, seed : int = SYNTHETIC_SEED) -> dict:
+    """One subsystem of `scale_benchmark`, over the corpus in `workdir`; run in a fresh process.
+
+    Build stages time building (and saving) from scratch. Search stages
+    load what the builds left in `workdir`, building it untimed if missing,
+    and time every query after one warm-up query.
+    """
+    from .chunked_sematic_search import ChunkedSemanticSearch
+    from .query_cache import QueryEmbeddingCache
+    from .synthetic_corpus import STUB_ENCODER_MODEL, StubEncoder, synthetic_queries
+
+    movies_path = os.path.join(workdir, "movies.json")
+    cache_path = os.path.join(workdir, "cache")
+    queries = synthetic_queries(n_queries, seed)
+
+    def inverted_index() -> InvertedIndex:
+        idx = InvertedIndex(movies_path, cache_path)
+        if columnar_index_exists(idx.index_path):
+            idx.load()
+        else:
+            idx.build()
+            idx.save()
+        return idx
+
+    def movies() -> list[dict]:
+        with open(movies_path, "r") as mov_file:
+            return json.load(mov_file)["movies"]
+
+    def chunked_search() -> ChunkedSemanticSearch:
+        # Uncached queries, so every search pays for its encode
+        return ChunkedSemanticSearch(STUB_ENCODER_MODEL, query_cache=QueryEmbeddingCache(max_size=0), model=StubEncoder(), cache_path=cache_path)
+
+    def searches(search_fn) -> dict:
+        start = time.perf_counter()
+        search_fn(queries[0])
+        first_query_ms = (time.perf_counter() - start) * 1000
+
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            search_fn(query)
+            timings.append(time.perf_counter() - start)
+        return {"first_query_ms": first_query_ms, **latency_stats(timings)}
+
+    report = {}
+    match stage:
+        case "index_build":
+            idx = InvertedIndex(movies_path, cache_path)
+            report["build_s"] = time_call(idx.build, 1)["mean_ms"] / 1000
+            report["save_s"] = time_call(idx.save, 1)["mean_ms"] / 1000
+        case "index_spimi_build":
+            idx = InvertedIndex(movies_path, cache_path)
+            report["build_s"] = time_call(idx.build_spimi, 1)["mean_ms"] / 1000
+            report["blocks"] = idx.build_stats["blocks"]
+        case "phrase_search":
+            # Its own cache, so the positions never reach the other stages' index
+            idx = InvertedIndex(movies_path, os.path.join(workdir, "positional_cache"))
+            report["build_s"] = time_call(lambda: idx.build(positions=True), 1)["mean_ms"] / 1000
+            idx.save()
+            idx.load()
+            report.update(ColumnarIndex(idx.index_path).size_mb())
+            report.update(searches(lambda query: idx.phrase_search(query, LIMIT)))
+            report["proximity"] = searches(lambda query: idx.bm25_proximity_search(query, LIMIT))
+        case "bm25_search":
+            idx = inverted_index()
+            report.update(searches(lambda query: idx.bm25_search(query, LIMIT)))
+        case "embedding_build":
+            documents = movies()
+            chunked_semantic_search = chunked_search()
+            report["build_s"] = time_call(lambda: chunked_semantic_search.build_chunk_embeddings(documents), 1)["mean_ms"] / 1000
+            report["chunks"] = len(chunked_semantic_search.chunk_metadata)
+        case "embedding_stream_build":
+            chunked_semantic_search = chunked_search()
+            report["build_s"] = time_call(lambda: chunked_semantic_search.stream_chunk_embeddings(movies_path, resume=False), 1)["mean_ms"] / 1000
+            report["chunks"] = chunked_semantic_search.rebuild_stats["rows"]
+        case "chunk_search":
+            chunked_semantic_search = chunked_search()
+            chunked_semantic_search.load_or_create_chunk_embeddings(movies())
+            report.update(searches(lambda query: chunked_semantic_search.search_chunks(query, LIMIT)))
+        case "weighted_search":
+            from .hybrid_search import HybridSearch
+
+            documents = movies()
+            chunked_semantic_search = chunked_search()
+            chunked_semantic_search.load_or_create_chunk_embeddings(documents)
+            with HybridSearch(documents, chunked_semantic_search, inverted_index()) as hybrid:
+                report.update(searches(lambda query: hybrid.weighted_search(query, DEFAULT_ALPHA, LIMIT)))
+        case _:
+            raise ValueError(f"Unknown subsystem: {stage}, expected one of {SCALE_BENCHMARK_SUBSYSTEMS}")
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def scale_benchmark(
+    sizes : list[int] = SCALE_BENCHMARK_SIZES,
+    subsystems : list[str] = SCALE_BENCHMARK_SUBSYSTEMS,
+    n_queries : int = SCALE_BENCHMARK_QUERIES,
+    seed : int = SYNTHETIC_SEED,
+    workdir : str | None = None,
+) -> dict:
+    """Build and query every subsystem over synthetic corpora of each size, as a JSON-ready report.
+
+    Each subsystem runs in its own fresh interpreter, so its peak RSS is its
+    own and search stages load from disk as the CLIs do. Embeddings come
+    from the offline StubEncoder. Corpora and caches live under `workdir`
+    (kept) or a temporary directory (removed).
+    """
+    from .synthetic_corpus import write_movies
+
+    report = {"environment": benchmark_environment(), "seed": seed, "queries": n_queries, "sizes": {}}
+    root = workdir or tempfile.mkdtemp(prefix="scale-benchmark-")
+    try:
+        for n_docs in sizes:
+            size_dir = os.path.join(root, str(n_docs))
+            os.makedirs(size_dir, exist_ok=True)
+            start = time.perf_counter()
+            corpus_bytes = write_movies(os.path.join(size_dir, "movies.json"), n_docs, seed)
+            results = {"corpus": {"docs": n_docs, "bytes": corpus_bytes, "generate_s": time.perf_counter() - start}}
+
+            for stage in subsystems:
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    results[stage] = executor.submit(scale_stage, stage, size_dir, n_queries, seed).result()
+
+            report["sizes"][str(n_docs)] = results
+    finally:
+        if workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return report
+
+
+def benchmark_environment() -> dict:
+    """What a run needs to be compared with another: commit, interpreter and machine."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=CLI_PATH, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
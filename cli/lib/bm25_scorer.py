@@ -0,0 +1,254 @@
+import heapq
+import math
+from collections import Counter
+from typing import NamedTuple
+
+import numpy as np
+
+from constants import *
+
+
+class DictPostings:
+    """Posting lists over the dicts that InvertedIndex builds and pickles.
+
+    Documents are addressed by ordinal (their position in `doc_ids`) so the
+    scorer can keep per-document statistics in flat lists.
+    """
+
+    deleted = frozenset()  # ordinals of removed documents, see SegmentedPostings
+
+    def __init__(
+        self,
+        index: dict[str, set[int]],
+        term_frequencies: dict[int, Counter],
+        doc_lengths: dict[int, int],
+        doc_ids: list[int],
+    ) -> None:
+        self.doc_ids = doc_ids  # ordinal : doc_id
+        self.doc_lengths = [doc_lengths[doc_id] for doc_id in doc_ids]
+        self._ordinals = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        self._index = index
+        self._term_frequencies = term_frequencies
+        self._postings = {}  # term : (ordinals, tfs), filled on first use
+
+    def ordinal(self, doc_id: int) -> int:
+        return self._ordinals[doc_id]
+
+    def terms(self) -> list[str]:
+        return list(self._index)
+
+    def doc_freq(self, term: str) -> int:
+        return len(self._index.get(term, ()))
+
+    def postings(self, term: str) -> tuple[list[int], list[int]]:
+        try:
+            return self._postings[term]
+        except KeyError:
+            pass
+
+        ordinals = sorted(self._ordinals[doc_id] for doc_id in self._index.get(term, ()))
+        tfs = [self._term_frequencies[self.doc_ids[o]][term] for o in ordinals]
+        self._postings[term] = (ordinals, tfs)
+
+        return ordinals, tfs
+
+
+class BM25Scorer:
+    """Scores queries by walking only the posting lists of the query terms.
+
+    Collection statistics (N, avgdl and the per-document length norm) are
+    computed once here instead of on every `get_bm25` call. `postings` is a
+    DictPostings, a ColumnarIndex or a view over live segments; ordinals in
+    its `deleted` set count towards neither N nor avgdl.
+    """
+
+    def __init__(self, postings: DictPostings, k1: float = BM25_K1, b: float = BM25_B) -> None:
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.ordinal_count = len(postings.doc_ids)
+        self.deleted = postings.deleted
+        self.doc_count = self.ordinal_count - len(self.deleted)
+        doc_lengths = np.asarray(postings.doc_lengths, dtype=np.int64)
+        total_length = int(doc_lengths.sum())
+        if self.deleted:
+            total_length -= int(doc_lengths[list(self.deleted)].sum())
+        self.avg_doc_length = 0.0
+        if self.doc_count > 0:
+            self.avg_doc_length = total_length / self.doc_count
+        if self.avg_doc_length > 0:
+            self._norms = 1 - b + b * (doc_lengths / self.avg_doc_length)
+        else:
+            self._norms = np.ones(self.ordinal_count)
+        self.length_norms = self._norms.tolist()
+        self._idfs = {}  # term : BM25 IDF
+        self._impacts = {}  # term : _TermImpacts
+
+    def length_norm(self, doc_length: int, b: float | None = None) -> float:
+        b = self.b if b is None else b
+        if self.avg_doc_length <= 0:
+            return 1.0
+        return 1 - b + b * (doc_length / self.avg_doc_length)
+
+    def idf(self, term: str) -> float:
+        try:
+            return self._idfs[term]
+        except KeyError:
+            pass
+
+        doc_freq = self.postings.doc_freq(term)
+        idf = math.log((self.doc_count - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+        self._idfs[term] = idf
+
+        return idf
+
+    def term_score(self, tf: int, ordinal: int, idf: float) -> float:
+        k1 = self.k1
+        return (tf * (k1 + 1)) / (tf + k1 * self.length_norms[ordinal]) * idf
+
+    def score(self, tokens: list[str]) -> dict[int, float]:
+        scores = {}  # ordinal : BM25 score
+        for token in tokens:
+            idf = self.idf(token)
+            ordinals, tfs = self.postings.postings(token)
+            if isinstance(ordinals, np.ndarray):
+                ordinals, tfs = ordinals.tolist(), tfs.tolist()
+            for ordinal, tf in zip(ordinals, tfs):
+                term_score = self.term_score(tf, ordinal, idf)
+                try:
+                    scores[ordinal] += term_score
+                except KeyError:
+                    scores[ordinal] = term_score
+
+        return scores
+
+    def score_ordinals(self, tokens: list[str], ordinals: np.ndarray) -> np.ndarray:
+        """BM25 scores of just the given documents, found by binary search in each posting list."""
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        scores = np.zeros(len(ordinals))
+        for token in tokens:
+            term_impacts = self.term_impacts(token)
+            positions = np.searchsorted(term_impacts.ordinals, ordinals)
+            positions[positions == len(term_impacts.ordinals)] = 0
+            hits = np.flatnonzero(term_impacts.ordinals[positions] == ordinals) if len(term_impacts.ordinals) else positions[:0]
+            scores[hits] += term_impacts.scores[positions[hits]]
+
+        return scores
+
+    def term_impacts(self, term: str) -> "_TermImpacts":
+        """Per-posting scores of the term plus their maxima per block of documents."""
+        try:
+            return self._impacts[term]
+        except KeyError:
+            pass
+
+        ordinals, tfs = self.postings.postings(term)
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        tfs = np.asarray(tfs, dtype=np.float64)
+        k1 = self.k1
+        scores = (tfs * (k1 + 1)) / (tfs + k1 * self._norms[ordinals]) * self.idf(term)
+
+        blocks = ordinals // BM25_BLOCK_SIZE
+        block_ids, block_starts = np.unique(blocks, return_index=True)
+        if len(scores):
+            block_max = np.maximum.reduceat(scores, block_starts)
+        else:
+            block_max = scores
+        block_ends = np.append(block_starts[1:], len(ordinals))
+        impacts = _TermImpacts(ordinals, scores, block_ids, block_max, block_starts, block_ends)
+        self._impacts[term] = impacts
+
+        return impacts
+
+    def top_k(self, tokens: list[str], limit: int) -> list[tuple[int, float]]:
+        """Block-max top-k: only blocks whose score bound can beat the heap are scored.
+
+        Documents are grouped into fixed blocks of ordinals. Each term keeps
+        the maximum score it contributes inside every block, so a block's
+        upper bound is the sum of those maxima. Blocks are visited from the
+        highest bound down and the walk stops once no remaining block can
+        enter the top-k, which gives the exhaustive result exactly.
+        """
+        impacts = {term: self.term_impacts(term) for term in set(tokens)}
+
+        # Nothing to skip when every matching document makes the cut anyway,
+        # and short lists are cheaper to walk than to prune.
+        total_postings = sum(len(i.ordinals) for i in impacts.values())
+        if limit <= 0 or total_postings <= max(limit, BM25_PRUNING_MIN_POSTINGS):
+            return self.top_k_exhaustive(tokens, limit)
+
+        n_blocks = -(-self.ordinal_count // BM25_BLOCK_SIZE)
+        upper_bounds = np.zeros(n_blocks)
+        spans = {}  # term : (posting start per block, posting end per block)
+        for token in tokens:
+            term_impacts = impacts[token]
+            upper_bounds[term_impacts.block_ids] += term_impacts.block_max
+            if token not in spans:
+                starts = np.zeros(n_blocks, dtype=np.int64)
+                ends = np.zeros(n_blocks, dtype=np.int64)
+                starts[term_impacts.block_ids] = term_impacts.block_starts
+                ends[term_impacts.block_ids] = term_impacts.block_ends
+                spans[token] = (starts.tolist(), ends.tolist())
+
+        heap = []  # (score, -ordinal), ties go to the lower ordinal
+        block_scores = np.zeros(BM25_BLOCK_SIZE)
+        for block in np.argsort(-upper_bounds, kind="stable").tolist():
+            upper_bound = upper_bounds[block]
+            if upper_bound <= 0:
+                break
+            if len(heap) >= limit and upper_bound + BM25_PRUNING_EPSILON < heap[0][0]:
+                break
+
+            # Sum in query order so scores are bit-identical to exhaustive scoring.
+            base = block * BM25_BLOCK_SIZE
+            block_scores[:] = 0.0
+            for token in tokens:
+                lo = spans[token][0][block]
+                hi = spans[token][1][block]
+                if lo < hi:
+                    term_impacts = impacts[token]
+                    block_scores[term_impacts.ordinals[lo:hi] - base] += term_impacts.scores[lo:hi]
+
+            candidates = block_scores > 0
+            if len(heap) >= limit:
+                candidates &= block_scores >= heap[0][0]
+            for offset in np.flatnonzero(candidates):
+                entry = (float(block_scores[offset]), -(base + int(offset)))
+                if len(heap) < limit:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+        best = [(-neg_ordinal, score) for score, neg_ordinal in sorted(heap, reverse=True)]
+        return self.finalize(tokens, best, limit)
+
+    def top_k_exhaustive(self, tokens: list[str], limit: int) -> list[tuple[int, float]]:
+        scores = self.score(tokens)
+        best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return self.finalize(tokens, best, limit)
+
+    def finalize(
+        self, tokens: list[str], best: list[tuple[int, float]], limit: int
+    ) -> list[tuple[int, float]]:
+        # Exhaustive scoring gave every document a score, so when fewer than
+        # `limit` documents match we pad with zero scores in document order.
+        if tokens and len(best) < limit:
+            seen = {ordinal for ordinal, _ in best}
+            for ordinal in range(self.ordinal_count):
+                if len(best) >= limit:
+                    break
+                if ordinal not in seen and ordinal not in self.deleted:
+                    best.append((ordinal, 0.0))
+
+        doc_ids = self.postings.doc_ids
+        return [(int(doc_ids[ordinal]), float(score)) for ordinal, score in best]
+
+
+
+class _TermImpacts(NamedTuple):
+    ordinals: np.ndarray  # sorted document ordinals
+    scores: np.ndarray  # BM25 score of the term in each document
+    block_ids: np.ndarray  # blocks holding at least one posting
+    block_max: np.ndarray  # highest score inside each of those blocks
+    block_starts: np.ndarray  # first posting of each of those blocks
+    block_ends: np.ndarray  # one past the last posting of each of those blocks
@@ -1,39 +1,74 @@
 import json
 import os
+import time
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
 
 import numpy as np
 from constants import *
-from sentence_transformers import SentenceTransformer
 
 from . import semantic_search as semsearch
+from .ann_index import IVFIndex, recall_at_k
+from .document_stream import iter_documents
+from .embedding_cache import CorpusHash, EmbeddingManifest, content_hash, finish_staged_embeddings, invalidate_embeddings, load_previous, make_manifest, open_embeddings, save_embeddings
+from .quantization import rerank_candidates
+from .query_cache import QueryEmbeddingCache
+from .tracing import span, traced
 
 
 class ChunkedSemanticSearch(semsearch.SemanticSearch):
-    def __init__(self, model_name="all-MiniLM-L6-v2") -> None:
-        super().__init__(model_name)
+    def __init__(self, model_name="all-MiniLM-L6-v2", quantization: str | None = None, rerank: bool = True, query_cache: QueryEmbeddingCache | None = None, model=None, cache_path: str | None = None) -> None:
+        super().__init__(model_name, quantization, rerank, query_cache, model, cache_path)
         self.chunk_embeddings = None
         self.chunk_metadata = []
+        self._inverse_chunk_norms = None # 1 / length of every chunk row, 0 for all-zero rows
+        self.quantized_chunk_embeddings = None
+        self._chunk_movie_idx = None # movie_idx of every chunk row
+        self._chunk_offsets = None # first chunk row of every movie segment
+        self.ann_index = None # IVFIndex, only loaded for approximate searches
         self._embeddings_path = os.path.join(self._cache_path, "chunk_embeddings.npy")
         self._metadata_path = os.path.join(self._cache_path, "chunk_metadata.json")
+        self._ann_path = os.path.join(self._cache_path, "chunk_ivf.npz")
 
-    def build_chunk_embeddings(self, documents: list[dict]) -> None:
-        self.documents = documents
-        for doc in self.documents:
-            self.document_map[doc["id"]] = doc
+    @traced("chunked.build")
+    def build_chunk_embeddings(self, documents: Sequence[dict]) -> None:
+        self._set_documents(documents)
 
-        all_chunks = []
+        manifest = self.__chunks_manifest(documents)
+        previous = load_previous(self._embeddings_path, manifest)
+        params = (DEFAULT_SEMANTIC_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP)
+
+        self.chunk_metadata = []
+        all_chunks = [] # chunk text, or None where a row is copied from the previous cache
+        old_rows = []
+        row_hashes = []
+        document_rows = []
 
         for doc_idx, doc in enumerate(self.documents):
             if doc["description"] == "":
                 continue
 
-            chunks = semsearch.semantic_chunk(
-                text_block=doc["description"],
-                max_chunk_size=DEFAULT_SEMANTIC_CHUNK_SIZE,
-                overlap=DEFAULT_CHUNK_OVERLAP
-            )
+            doc_hash = content_hash(doc["description"], *params)
+            if previous is not None and doc_hash in previous.documents:
+                # Unchanged document: reuse its chunk rows without chunking it again
+                start, n_chunks = previous.documents[doc_hash]
+                chunks = [None] * n_chunks
+                chunk_rows = list(range(start, start + n_chunks))
+                chunk_hashes = previous.row_hashes[start : start + n_chunks]
+            else:
+                chunks = semsearch.semantic_chunk(
+                    text_block=doc["description"],
+                    max_chunk_size=DEFAULT_SEMANTIC_CHUNK_SIZE,
+                    overlap=DEFAULT_CHUNK_OVERLAP
+                )
+                chunk_hashes = [content_hash(chunk) for chunk in chunks]
+                chunk_rows = [-1 if previous is None else previous.row(h) for h in chunk_hashes]
 
+            document_rows.append((doc_hash, len(all_chunks), len(chunks)))
             all_chunks += chunks
+            old_rows += chunk_rows
+            row_hashes += chunk_hashes
 
             for chunk_idx in range(len(chunks)):
                 self.chunk_metadata.append(
@@ -44,16 +79,13 @@ class ChunkedSemanticSearch(semsearch.SemanticSearch):
                     }
                 )
 
-        encoded = self.encode(all_chunks)
-
-        self.chunk_embeddings = encoded
+        self.chunk_embeddings = self.assemble_embeddings(all_chunks, old_rows, previous)
+        del previous # drop the old mapping before its file is replaced
 
         if not os.path.exists(self._cache_path):
             os.makedirs(self._cache_path)
 
-        with open(self._embeddings_path, "wb") as embeddings_file:
-            np.save(embeddings_file, self.chunk_embeddings)
-
+        self.remove_derived_caches(self._embeddings_path)
         with open(self._metadata_path, "w") as metadata_file:
             json.dump(
                 {"chunks": self.chunk_metadata, "total_chunks": len(all_chunks)},
@@ -61,62 +93,404 @@ class ChunkedSemanticSearch(semsearch.SemanticSearch):
                 indent=2,
             )
 
+        manifest["rows"] = len(all_chunks)
+        save_embeddings(self._embeddings_path, self.chunk_embeddings, manifest, row_hashes, document_rows)
+        self.__index_chunks()
+
         return self.chunk_embeddings
 
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
-        if os.path.exists(self._embeddings_path) and os.path.exists(
-            self._metadata_path
-        ):
+    @traced("chunked.load")
+    def load_or_create_chunk_embeddings(self, documents: Sequence[dict]) -> np.ndarray:
+        chunk_embeddings = open_embeddings(self._embeddings_path, self.__chunks_manifest(documents))
 
-            self.documents = documents
-            for doc in self.documents:
-                self.document_map[doc["id"]] = doc
+        if chunk_embeddings is not None and os.path.exists(self._metadata_path):
 
-            with open(self._embeddings_path, "rb") as embeddings_file:
-                self.chunk_embeddings = np.load(embeddings_file)
+            self._set_documents(documents)
+
+            # Memory mapped: pages are read on first use and shared between processes
+            self.chunk_embeddings = chunk_embeddings
 
             with open(self._metadata_path, "r") as metadata_file:
                 self.chunk_metadata = json.load(metadata_file)["chunks"]
+            self.__index_chunks()
 
             return self.chunk_embeddings
         else:
             return self.build_chunk_embeddings(documents)
 
-    def search_chunks(self, query: str, limit: int = 10) -> list[dict]:
-        encoded_query = self.encode(query)
-        chunk_score_list = []
+    @traced("chunked.stream_build")
+    def stream_chunk_embeddings(self, movies_path: str, batch_size: int = EMBEDDING_BUILD_BATCH_SIZE, resume: bool = True) -> EmbeddingManifest:
+        """Build the chunk embedding cache from a JSON or JSONL file in memory that does not grow with the corpus.
 
-        for chunk_idx, chunk in enumerate(self.chunk_embeddings):
-            score = semsearch.cosine_similarity(encoded_query, chunk)
+        A first pass reads and chunks the documents one at a time to count
+        the rows and hash the corpus, streaming the chunk metadata and the
+        row and document hashes to staging files. A second pass chunks them
+        again and encodes `batch_size` chunks at a time into a preallocated
+        .npy, mapped with open_memmap only while a batch is written;
+        reading, encoding and writing overlap on separate threads.
+        Progress is checkpointed after every batch, so rerunning an
+        interrupted build over the same corpus resumes after the last
+        written batch unless `resume` is False. The cache is only replaced
+        once complete, and load_or_create_chunk_embeddings over the same
+        documents then loads it.
 
-            chunk_score_list.append(
-                    {
-                        "chunk_idx" : chunk_idx,
-                        "movie_idx" : self.chunk_metadata[chunk_idx]["movie_idx"],
-                        "score" : score,
-                    }
-            )
+        Unlike build_chunk_embeddings, rows of a previous cache are not reused.
+        """
+        params = (DEFAULT_SEMANTIC_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP)
+        staged_path = f"{self._embeddings_path}.partial"
+        checkpoint_path = f"{staged_path}.json"
+        metadata_path = f"{self._metadata_path}.partial"
+        rows_path = f"{staged_path}.rows"
+        documents_path = f"{staged_path}.documents"
+        os.makedirs(self._cache_path, exist_ok=True)
+
+        with span("chunked.stream_plan"):
+            corpus = CorpusHash(*params)
+            n_documents = 0
+            rows = 0
+            wrote_document = False # documents without chunks are listed too, so rows cannot tell
+            with open(metadata_path, "w") as metadata_file, open(rows_path, "w") as rows_file, open(documents_path, "w") as documents_file:
+                metadata_file.write('{"chunks": [')
+                for doc_idx, description, chunks in self._stream_chunks(movies_path):
+                    corpus.update(description)
+                    n_documents += 1
+                    if description == "":
+                        continue
+
+                    separator = "," if rows else ""
+                    doc_hash = content_hash(description, *params)
+                    documents_file.write(f"{"," if wrote_document else ""}{json.dumps([doc_hash, rows, len(chunks)])}")
+                    wrote_document = True
+                    for chunk_idx, chunk in enumerate(chunks):
+                        metadata_file.write(f'{separator}\n{{"movie_idx": {doc_idx}, "chunk_idx": {chunk_idx}, "total_chunks": {len(chunks)}}}')
+                        rows_file.write(f'{separator}"{content_hash(chunk)}"')
+                        separator = ","
+                    rows += len(chunks)
+                metadata_file.write(f'\n], "total_chunks": {rows}}}\n')
+
+        manifest = make_manifest(self.model_name, self.embedding_dimension, n_documents, rows, corpus.hexdigest(), params)
+
+        done = 0 # rows already encoded by an interrupted build of the same corpus
+        if resume and os.path.exists(checkpoint_path) and os.path.exists(staged_path):
+            with open(checkpoint_path, "r") as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if EmbeddingManifest(checkpoint["manifest"]).matches(manifest) and checkpoint["manifest"]["rows"] == rows:
+                done = checkpoint["rows"]
+        if done == 0:
+            np.lib.format.open_memmap(staged_path, mode="w+", dtype=np.float32, shape=(rows, manifest["dimension"]))
+
+        def write_batch(start: int, vectors: np.ndarray) -> None:
+            with span("chunked.stream_write"):
+                matrix = np.lib.format.open_memmap(staged_path, mode="r+")
+                matrix[start : start + len(vectors)] = vectors
+                matrix.flush()
+                del matrix # unmapped, so written pages do not pile up in memory
+                with open(f"{checkpoint_path}.tmp", "w") as checkpoint_file:
+                    json.dump({"manifest": manifest, "rows": start + len(vectors)}, checkpoint_file)
+                os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+        def remaining_chunks() -> Iterator[str]:
+            row = 0
+            for _, _, chunks in self._stream_chunks(movies_path):
+                for chunk in chunks:
+                    if row >= done:
+                        yield chunk
+                    row += 1
+
+        # Chunks are read on the pipeline's reader thread and batches written
+        # on the writer thread, both while the next batch is being encoded.
+        with self.encode_pipeline() as pipeline, ThreadPoolExecutor(1, thread_name_prefix="embedding-writer") as writer:
+            start = done
+            written = None
+            with span("chunked.stream_encode"):
+                for vectors in pipeline.encode_stream(remaining_chunks(), batch_size):
+                    if written is not None:
+                        written.result() # one batch in flight, so checkpoints stay in order
+                    written = writer.submit(write_batch, start, vectors)
+                    start += len(vectors)
+            if written is not None:
+                written.result()
+        self.encode_stats = pipeline.throughput()
+
+        # The old manifest goes before the metadata is replaced: a crash in
+        # between must leave no cache that still looks valid
+        invalidate_embeddings(self._embeddings_path)
+        self.remove_derived_caches(self._embeddings_path)
+        os.replace(metadata_path, self._metadata_path)
+        finish_staged_embeddings(self._embeddings_path, staged_path, manifest, rows_path, documents_path)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        self.rebuild_stats = {"rows": rows, "reused": 0, "encoded": rows - done, "dropped": 0, "resumed": done}
+        return manifest
+
+    def _stream_chunks(self, movies_path: str) -> Iterator[tuple[int, str, list[str]]]:
+        """(movie_idx, description, chunks) of every document in the file, chunked as it is read."""
+        for doc_idx, doc in enumerate(iter_documents(movies_path)):
+            chunks = []
+            if doc["description"] != "":
+                chunks = semsearch.semantic_chunk(
+                    text_block=doc["description"],
+                    max_chunk_size=DEFAULT_SEMANTIC_CHUNK_SIZE,
+                    overlap=DEFAULT_CHUNK_OVERLAP
+                )
+            yield doc_idx, doc["description"], chunks
+
+    def __chunks_manifest(self, documents: Sequence[dict], rows: int = 0) -> EmbeddingManifest:
+        descriptions = [doc["description"] for doc in documents]
+        return self.embeddings_manifest(descriptions, len(documents), rows, DEFAULT_SEMANTIC_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP)
+
+    def remove_derived_caches(self, embeddings_path: str) -> None:
+        super().remove_derived_caches(embeddings_path)
+        if os.path.exists(self._ann_path):
+            os.remove(self._ann_path)
+        self.ann_index = None
+
+    def __index_chunks(self) -> None:
+        """Quantize chunk rows if asked to and find where each movie's run of chunks starts."""
+        if self.quantization is None:
+            # Row norms are computed by the first search, so loading stays cheap
+            self._inverse_chunk_norms = None
+            self.quantized_chunk_embeddings = None
+        else:
+            self._inverse_chunk_norms = None
+            self.quantized_chunk_embeddings = self._load_or_create_quantized(self._embeddings_path, self.chunk_embeddings)
+        self._chunk_movie_idx = np.array([chunk["movie_idx"] for chunk in self.chunk_metadata], dtype=np.int64)
+        self._chunk_offsets = segment_offsets(self._chunk_movie_idx)
+        self.ann_index = None
+
+    def load_or_create_ann_index(self, n_lists: int | None = None) -> IVFIndex:
+        if self.ann_index is not None:
+            return self.ann_index
+
+        if os.path.exists(self._ann_path):
+            self.ann_index = IVFIndex.load(self._ann_path)
+            if self.ann_index.n_rows == len(self.chunk_embeddings) and n_lists in (None, self.ann_index.n_lists):
+                return self.ann_index
+
+        normalized = semsearch.normalize_rows(np.asarray(self.chunk_embeddings, dtype=np.float32))
+        self.ann_index = IVFIndex.build(normalized, n_lists)
+        self.ann_index.save(self._ann_path)
+
+        return self.ann_index
+
+    @traced("chunked.search", query=True)
+    def search_chunks(self, query: str, limit: int = 10, ann: bool = False, nprobe: int = IVF_DEFAULT_NPROBE, documents: bool = True) -> list[dict]:
+        """Best `limit` movies by their best chunk; with `documents` False the hits carry only id and score."""
+        encoded_query = self.embed_queries([query])[0]
+
+        return self.search_chunks_by_vector(encoded_query, limit, ann, nprobe, documents)
+
+    def score_movies(self, query_embedding: np.ndarray, ann: bool = False, nprobe: int = IVF_DEFAULT_NPROBE, candidates: int = QUANTIZATION_RERANK_MIN) -> tuple[np.ndarray, np.ndarray]:
+        """Best chunk score per movie, as (movie_idx, score) arrays.
 
-        mov_score_map = {}
-        for chunk in chunk_score_list:
-            if chunk["movie_idx"] not in mov_score_map.keys() or chunk["score"] > mov_score_map[chunk["movie_idx"]]:
-                mov_score_map[chunk["movie_idx"]] = chunk["score"]
+        With `ann` only the chunks in the IVF lists closest to the query are
+        scored, so movies without a chunk in those lists are left out. With
+        quantization and reranking, only the movies of the best `candidates`
+        chunks are kept.
+        """
+        if self._inverse_chunk_norms is None and self.quantized_chunk_embeddings is None:
+            with span("chunked.normalize"):
+                self._inverse_chunk_norms = semsearch.inverse_row_norms(self.chunk_embeddings)
 
-        sorted_items = sorted(mov_score_map.items(), key=lambda item: item[1], reverse=True)[:limit]
-        sorted_mov_score_map = dict(sorted_items)
+        query = semsearch.normalize_rows(query_embedding)
+        rows = None
+        if ann:
+            with span("chunked.ann_probe"):
+                rows = self.load_or_create_ann_index().candidates(query, nprobe)
+
+        scored_rows, chunk_scores = self._score_rows(
+            self.chunk_embeddings,
+            self._inverse_chunk_norms,
+            self.quantized_chunk_embeddings,
+            query,
+            candidates,
+            rows,
+        )
+        with span("chunked.pool"):
+            if scored_rows is None:
+                return pool_max(chunk_scores, self._chunk_movie_idx, self._chunk_offsets)
+            return pool_max(chunk_scores, self._chunk_movie_idx[scored_rows])
+
+    @traced("chunked.score_documents")
+    def score_documents(self, query_embedding: np.ndarray, movie_idx: np.ndarray) -> np.ndarray:
+        """Best chunk score of just the given movies (by position in `documents`), in the same order.
+
+        Only those movies' chunk rows are gathered and scored. Movies
+        without chunks score -inf.
+        """
+        if self._inverse_chunk_norms is None and self.quantized_chunk_embeddings is None:
+            self._inverse_chunk_norms = semsearch.inverse_row_norms(self.chunk_embeddings)
+
+        movie_idx = np.asarray(movie_idx, dtype=np.int64)
+        rows = self.chunk_rows(movie_idx)
+        scores = np.full(len(movie_idx), -np.inf, dtype=np.float32)
+        if len(rows) == 0:
+            return scores
+
+        scored_rows, chunk_scores = self._score_rows(
+            self.chunk_embeddings,
+            self._inverse_chunk_norms,
+            self.quantized_chunk_embeddings,
+            semsearch.normalize_rows(query_embedding),
+            len(rows), # rerank every gathered row, so quantized scores are exact
+            rows,
+        )
+        movies, movie_scores = pool_max(chunk_scores, self._chunk_movie_idx[rows if scored_rows is None else scored_rows])
+
+        positions = np.minimum(np.searchsorted(movies, movie_idx), len(movies) - 1)
+        found = movies[positions] == movie_idx
+        scores[found] = movie_scores[positions[found]]
+
+        return scores
+
+    def chunk_rows(self, movie_idx: np.ndarray) -> np.ndarray:
+        """Sorted chunk rows of the given movies."""
+        if self._chunk_offsets is None:
+            return np.flatnonzero(np.isin(self._chunk_movie_idx, movie_idx))
+
+        segment_movies = self._chunk_movie_idx[self._chunk_offsets]
+        segments = np.searchsorted(segment_movies, movie_idx)
+        in_range = segments < len(segment_movies)
+        segments = segments[in_range]
+        segments = np.unique(segments[segment_movies[segments] == movie_idx[in_range]])
+        if len(segments) == 0:
+            return segments
+
+        starts = self._chunk_offsets[segments]
+        ends = np.append(self._chunk_offsets, len(self._chunk_movie_idx))[segments + 1]
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts.tolist(), ends.tolist())])
+
+    def search_chunks_by_vector(self, query_embedding: np.ndarray, limit: int = 10, ann: bool = False, nprobe: int = IVF_DEFAULT_NPROBE, documents: bool = True) -> list[dict]:
+        movies, movie_scores = self.score_movies(query_embedding, ann, nprobe, rerank_candidates(limit))
+
+        return self._movie_results(movies, movie_scores, limit, documents)
+
+    def search_chunks_many(self, queries: list[str], limit: int = 10, ann: bool = False, nprobe: int = IVF_DEFAULT_NPROBE, batch_size: int = SEARCH_BATCH_SIZE, documents: bool = True) -> Iterator[list[dict]]:
+        """Results of every query, in order, yielded as each batch of queries is scored.
+
+        Each batch is encoded with one model call; exact float32 search
+        scores it against all chunks with one matrix-matrix product.
+        """
+        for batch in batched(queries, batch_size):
+            query_embeddings = np.asarray(self.embed_queries(list(batch)))
+            yield from self.search_chunks_many_by_vector(query_embeddings, limit, ann, nprobe, documents)
+
+    def search_chunks_many_by_vector(self, query_embeddings: np.ndarray, limit: int = 10, ann: bool = False, nprobe: int = IVF_DEFAULT_NPROBE, documents: bool = True) -> list[list[dict]]:
+        if ann or self.quantized_chunk_embeddings is not None:
+            # Candidate rows differ per query, so these are scored one by one
+            return [self.search_chunks_by_vector(query, limit, ann, nprobe, documents) for query in query_embeddings]
+
+        if self._inverse_chunk_norms is None:
+            self._inverse_chunk_norms = semsearch.inverse_row_norms(self.chunk_embeddings)
+
+        score_matrix = (semsearch.normalize_rows(query_embeddings) @ self.chunk_embeddings.T) * self._inverse_chunk_norms
+        return [
+            self._movie_results(*pool_max(chunk_scores, self._chunk_movie_idx, self._chunk_offsets), limit, documents)
+            for chunk_scores in score_matrix
+        ]
+
+    @traced("chunked.results")
+    def _movie_results(self, movies: np.ndarray, movie_scores: np.ndarray, limit: int, documents: bool = True) -> list[dict]:
+        best = semsearch.top_k_indices(movie_scores, limit)
+        if not documents:
+            # Just the hits: the caller fetches the documents of the page it keeps
+            return [
+                {"id": doc_id, "score": score}
+                for doc_id, score in zip(self.doc_ids[movies[best]].tolist(), movie_scores[best].tolist())
+            ]
 
         return_list = []
-        for movie_idx, score in sorted_mov_score_map.items():
-            doc = self.documents[movie_idx]
+        for i in best:
+            doc = self.documents[movies[i]]
             return_list.append(
                     {
                         "id" : doc["id"], #movie_idx
                         "title" : doc["title"],
                         "document" : doc["description"][:100],
-                        "score" : score,
+                        "score" : float(movie_scores[i]),
                         "metadata" : doc.get("metadata") or {},
                     }
             )
 
         return return_list
 
+    def ann_recall(self, queries: list[str], k: int = LIMIT, nprobes: list[int] = IVF_RECALL_NPROBES) -> dict[int, dict[str, float]]:
+        """recall@k and mean scoring latency of the IVF index against exact search, per nprobe."""
+        query_embeddings = self.encode(queries)
+
+        def run(ann : bool, nprobe : int) -> tuple[list[list[int]], float]:
+            start = time.perf_counter()
+            results = [
+                [r["id"] for r in self.search_chunks_by_vector(q, k, ann, nprobe, documents=False)]
+                for q in query_embeddings
+            ]
+            return results, (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+        self.load_or_create_ann_index()
+        exact, exact_ms = run(False, 0)
+
+        report = {0: {"recall": 1.0, "mean_ms": exact_ms}} # nprobe 0 : exact search
+        for nprobe in nprobes:
+            approximate, ann_ms = run(True, nprobe)
+            report[nprobe] = {"recall": recall_at_k(exact, approximate, k), "mean_ms": ann_ms}
+
+        return report
+
+    def quantization_report(self, queries: list[str], k: int = LIMIT, modes: tuple[str, ...] = QUANTIZATION_MODES) -> dict[str, dict[str, float]]:
+        """Size, recall@k and mean latency of every quantization mode against exact float32 search."""
+        query_embeddings = self.encode(queries)
+        vectors = np.asarray(self.chunk_embeddings, dtype=np.float32)
+        saved = (self.quantization, self.rerank, self._inverse_chunk_norms, self.quantized_chunk_embeddings)
+
+        def run() -> tuple[list[list[int]], float]:
+            start = time.perf_counter()
+            results = [[r["id"] for r in self.search_chunks_by_vector(q, k, documents=False)] for q in query_embeddings]
+            return results, (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+        try:
+            self.quantization, self._inverse_chunk_norms, self.quantized_chunk_embeddings = None, semsearch.inverse_row_norms(vectors), None
+            exact, exact_ms = run()
+            report = {"float32": {"bytes": vectors.nbytes, "compression": 1.0, "recall": 1.0, "recall_rerank": 1.0, "mean_ms": exact_ms, "mean_ms_rerank": exact_ms}}
+
+            self._inverse_chunk_norms = None
+            for mode in modes:
+                self.quantization = mode
+                self.quantized_chunk_embeddings = self._load_or_create_quantized(self._embeddings_path, vectors)
+                row = {"bytes": self.quantized_chunk_embeddings.nbytes}
+                row["compression"] = vectors.nbytes / max(row["bytes"], 1)
+                for rerank, suffix in ((False, ""), (True, "_rerank")):
+                    self.rerank = rerank
+                    approximate, ms = run()
+                    row[f"recall{suffix}"] = recall_at_k(exact, approximate, k)
+                    row[f"mean_ms{suffix}"] = ms
+                report[mode] = row
+        finally:
+            self.quantization, self.rerank, self._inverse_chunk_norms, self.quantized_chunk_embeddings = saved
+
+        return report
+
+
+def segment_offsets(chunk_movie_idx: np.ndarray) -> np.ndarray | None:
+    """Start of every movie's run of chunks, or None if a movie's chunks are not contiguous."""
+    if len(chunk_movie_idx) == 0:
+        return chunk_movie_idx
+    starts = np.flatnonzero(np.r_[True, chunk_movie_idx[1:] != chunk_movie_idx[:-1]])
+    if np.any(np.diff(chunk_movie_idx[starts]) <= 0):
+        return None
+    return starts
+
+
+def pool_max(chunk_scores: np.ndarray, chunk_movie_idx: np.ndarray, offsets: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Max-pool chunk scores into one score per movie."""
+    if offsets is None:
+        offsets = segment_offsets(chunk_movie_idx)
+    if len(chunk_scores) == 0:
+        return chunk_movie_idx, chunk_scores
+    if offsets is not None:
+        return chunk_movie_idx[offsets], np.maximum.reduceat(chunk_scores, offsets)
+
+    movies = np.unique(chunk_movie_idx)
+    movie_scores = np.full(len(movies), -np.inf, dtype=chunk_scores.dtype)
+    np.maximum.at(movie_scores, np.searchsorted(movies, chunk_movie_idx), chunk_scores)
+    return movies, movie_scores
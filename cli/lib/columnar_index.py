@@ -0,0 +1,229 @@
+import json
+import os
+import shutil
+from bisect import bisect_left
+from itertools import chain
+
+import numpy as np
+
+from constants import *
+
+# Every array lives in its own .npy so np.load(mmap_mode="r") can map it
+# without reading it; the OS page cache is then shared between processes.
+_ARRAYS = (
+    "term_bytes",  # uint8, all terms UTF-8 encoded and concatenated in sorted order
+    "term_offsets",  # int64, term_id : start in term_bytes (one extra end entry)
+    "posting_offsets",  # int64, term_id : start in posting_docs (one extra end entry)
+    "posting_docs",  # uint32, document ordinals, delta-encoded within each term
+    "posting_tfs",  # uint32, term frequency next to every posting
+    "doc_ids",  # int64, ordinal : doc_id
+    "doc_order",  # int64, ordinals sorted by doc_id, for doc_id lookups
+    "doc_lengths",  # uint32, ordinal : number of tokens
+)
+# Only written for an index with positions; the positions of a posting
+# start after those of the postings before it in the term, one per tf.
+_POSITION_ARRAYS = (
+    "position_term_offsets",  # int64, term_id : start in positions (one extra end entry)
+    "positions",  # smallest unsigned int that fits, token positions of every posting, delta-encoded within each posting
+)
+_META_FILE = "meta.json"
+
+
+class _TermDictionary:
+    """Sorted sequence of encoded terms, so bisect can binary search it in place."""
+
+    def __init__(self, term_bytes: np.ndarray, term_offsets: np.ndarray) -> None:
+        self._term_bytes = term_bytes
+        self._term_offsets = term_offsets
+
+    def __len__(self) -> int:
+        return len(self._term_offsets) - 1
+
+    def __getitem__(self, term_id: int) -> bytes:
+        start, end = self._term_offsets[term_id], self._term_offsets[term_id + 1]
+        return self._term_bytes[start:end].tobytes()
+
+
+class ColumnarIndex:
+    """Memory-mapped postings written by `write_columnar_index`.
+
+    Offers the same interface as DictPostings, so BM25Scorer can score
+    straight from the mapped arrays. Indexes written with positions also
+    answer `term_positions`.
+    """
+
+    deleted = frozenset()
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, _META_FILE), "r") as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta["version"] != COLUMNAR_INDEX_VERSION:
+            raise ValueError(f"Unsupported columnar index version: {self.meta["version"]}")
+
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        self.has_positions = self.meta.get("positions", False)
+        if self.has_positions:
+            for name in _POSITION_ARRAYS:
+                setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        self._terms = _TermDictionary(self.term_bytes, self.term_offsets)
+
+    def term_id(self, term: str) -> int:
+        key = term.encode("utf-8")
+        term_id = bisect_left(self._terms, key)
+        if term_id < len(self._terms) and self._terms[term_id] == key:
+            return term_id
+        return -1
+
+    def terms(self) -> list[str]:
+        return [self._terms[i].decode("utf-8") for i in range(len(self._terms))]
+
+    def ordinal(self, doc_id: int) -> int:
+        lo, hi = 0, len(self.doc_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.doc_ids[self.doc_order[mid]] < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.doc_order) and self.doc_ids[self.doc_order[lo]] == doc_id:
+            return int(self.doc_order[lo])
+        raise KeyError(doc_id)
+
+    def doc_freq(self, term: str) -> int:
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return 0
+        return int(self.posting_offsets[term_id + 1] - self.posting_offsets[term_id])
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        start, end = self.posting_offsets[term_id], self.posting_offsets[term_id + 1]
+        ordinals = np.cumsum(self.posting_docs[start:end], dtype=np.int64)
+        tfs = self.posting_tfs[start:end].astype(np.int64)
+
+        return ordinals, tfs
+
+    def term_positions(self, term: str, ordinals: list[int]) -> list[np.ndarray]:
+        """Positions of `term` in each of the given documents, by ordinal; empty where it does not occur."""
+        empty = np.empty(0, dtype=np.int64)
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return [empty] * len(ordinals)
+
+        start, end = self.posting_offsets[term_id], self.posting_offsets[term_id + 1]
+        term_ordinals = np.cumsum(self.posting_docs[start:end], dtype=np.int64)
+        position_offsets = np.empty(end - start + 1, dtype=np.int64)
+        position_offsets[0] = self.position_term_offsets[term_id]
+        np.cumsum(self.posting_tfs[start:end], out=position_offsets[1:])
+        position_offsets[1:] += position_offsets[0]
+
+        result = []
+        found = np.searchsorted(term_ordinals, ordinals).tolist()
+        for ordinal, i in zip(ordinals, found):
+            if i < len(term_ordinals) and term_ordinals[i] == ordinal:
+                result.append(np.cumsum(self.positions[position_offsets[i] : position_offsets[i + 1]], dtype=np.int64))
+            else:
+                result.append(empty)
+        return result
+
+    def size_mb(self) -> dict[str, float]:
+        """MB of the mapped postings and of the positions, to weigh what positions cost."""
+        sizes = {"postings_mb": sum(getattr(self, name).nbytes for name in _ARRAYS) / 2**20, "positions_mb": 0.0}
+        if self.has_positions:
+            sizes["positions_mb"] = sum(getattr(self, name).nbytes for name in _POSITION_ARRAYS) / 2**20
+        return sizes
+
+
+def write_columnar_index(path: str, postings, positions=None) -> None:
+    """Write any postings source (DictPostings or ColumnarIndex) in columnar form.
+
+    With `positions`, a DocumentPositions covering every document, the
+    token positions of every posting are written too.
+    """
+    terms = sorted(postings.terms(), key=lambda term: term.encode("utf-8"))
+
+    encoded_terms = [term.encode("utf-8") for term in terms]
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([len(t) for t in encoded_terms], out=term_offsets[1:])
+
+    posting_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    posting_docs = []
+    posting_tfs = []
+    doc_ids = np.asarray(postings.doc_ids, dtype=np.int64)
+    position_term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    position_deltas = []
+    for term_id, term in enumerate(terms):
+        ordinals, tfs = postings.postings(term)
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        posting_docs.append(np.diff(ordinals, prepend=0))
+        posting_tfs.append(np.asarray(tfs))
+        posting_offsets[term_id + 1] = posting_offsets[term_id] + len(ordinals)
+        if positions is not None:
+            deltas = _delta_encode_positions(positions.term_positions(term, doc_ids[ordinals].tolist()))
+            position_deltas.append(deltas)
+            position_term_offsets[term_id + 1] = position_term_offsets[term_id] + len(deltas)
+
+    arrays = {
+        "term_bytes": np.frombuffer(b"".join(encoded_terms), dtype=np.uint8),
+        "term_offsets": term_offsets,
+        "posting_offsets": posting_offsets,
+        "posting_docs": np.concatenate(posting_docs or [np.empty(0)]).astype(np.uint32),
+        "posting_tfs": np.concatenate(posting_tfs or [np.empty(0)]).astype(np.uint32),
+        "doc_ids": doc_ids,
+        "doc_order": np.argsort(doc_ids, kind="stable"),
+        "doc_lengths": np.asarray(postings.doc_lengths, dtype=np.uint32),
+    }
+    if positions is not None:
+        position_deltas = np.concatenate(position_deltas or [np.empty(0, dtype=np.int64)])
+        arrays["position_term_offsets"] = position_term_offsets
+        # Deltas within a description are small, often a byte each
+        arrays["positions"] = position_deltas.astype(np.min_scalar_type(int(position_deltas.max(initial=0))))
+
+    # The arrays can be views of the index being replaced, and other
+    # processes may have it mapped, so it is never rewritten in place.
+    staged_path = f"{path}.partial"
+    shutil.rmtree(staged_path, ignore_errors=True)
+    os.makedirs(staged_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(staged_path, f"{name}.npy"), array)
+
+    # Written last: a directory without meta.json is an unfinished index.
+    with open(os.path.join(staged_path, _META_FILE), "w") as meta_file:
+        json.dump(
+            {"version": COLUMNAR_INDEX_VERSION, "terms": len(terms), "documents": len(doc_ids), "positions": positions is not None},
+            meta_file,
+        )
+
+    replace_index_directory(staged_path, path)
+
+
+def replace_index_directory(staged_path: str, path: str) -> None:
+    """Swap a completely written directory in for the one at `path`, such as an index or a document store.
+
+    Open maps of the old files stay valid: they are unlinked, not truncated.
+    """
+    # A directory cannot be replaced while it has files, so the old one is moved aside first
+    shutil.rmtree(f"{path}.old", ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, f"{path}.old")
+    os.replace(staged_path, path)
+    shutil.rmtree(f"{path}.old", ignore_errors=True)
+
+
+def _delta_encode_positions(term_positions: list[list[int]]) -> np.ndarray:
+    """Positions of every posting of a term back to back, each posting delta-encoded from 0."""
+    lengths = np.fromiter(map(len, term_positions), dtype=np.int64, count=len(term_positions))
+    flat = np.fromiter(chain.from_iterable(term_positions), dtype=np.int64, count=int(lengths.sum()))
+    deltas = np.diff(flat, prepend=0)
+    starts = (np.cumsum(lengths) - lengths)[lengths > 0]
+    deltas[starts] = flat[starts]
+    return deltas
+
+
+def columnar_index_exists(path: str) -> bool:
+    return os.path.exists(os.path.join(path, _META_FILE))
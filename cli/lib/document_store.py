@@ -0,0 +1,212 @@
+import json
+import mmap
+import operator
+import os
+import shutil
+from array import array
+from collections.abc import Iterable, Iterator, Mapping, MutableMapping, Sequence
+
+import numpy as np
+
+from constants import *
+
+from .columnar_index import replace_index_directory
+from .document_stream import iter_documents
+
+# Documents are stored as UTF-8 JSON records back to back in one data file,
+# found through an offsets array; both are mapped, so a document is only
+# read and decoded when it is asked for.
+_DATA_FILE = "documents.bin"
+_ARRAYS = (
+    "offsets",  # int64, position : start in the data file (one extra end entry)
+    "doc_ids",  # int64, position : doc_id
+    "doc_order",  # int64, positions sorted by doc_id, for doc_id lookups
+)
+_META_FILE = "meta.json"
+
+
+class DocumentStore(Sequence):
+    """Memory-mapped documents written by `write_document_store`, in their original order.
+
+    Indexing by position gives the decoded document, like the list of
+    movies it replaces; `by_id` looks documents up by id instead.
+    """
+
+    def __init__(self, path : str) -> None:
+        self.path = path
+        with open(os.path.join(path, _META_FILE), "r") as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta["version"] != DOCUMENT_STORE_VERSION:
+            raise ValueError(f"Unsupported document store version: {self.meta["version"]}")
+
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        self._data = b""
+        if self.offsets[-1] > 0:
+            with open(os.path.join(path, _DATA_FILE), "rb") as data_file:
+                self._data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.by_id = _DocumentsById(self)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __getitem__(self, position : int) -> dict:
+        position = operator.index(position)
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(f"Document position out of range: {position}")
+        return json.loads(self._data[self.offsets[position] : self.offsets[position + 1]])
+
+    def __iter__(self) -> Iterator[dict]:
+        for position in range(len(self)):
+            yield self[position]
+
+    def position(self, doc_id : int) -> int:
+        lo, hi = 0, len(self.doc_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.doc_ids[self.doc_order[mid]] < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.doc_order) and self.doc_ids[self.doc_order[lo]] == doc_id:
+            return int(self.doc_order[lo])
+        raise KeyError(doc_id)
+
+    def fetch(self, doc_ids : Iterable[int], fields : tuple[str, ...] = DOCUMENT_STORE_RESULT_FIELDS) -> list[dict]:
+        """Just `fields` of the given documents, in order; only these documents are read."""
+        return [{field: document.get(field) for field in fields} for document in map(self.by_id.__getitem__, doc_ids)]
+
+
+class _DocumentsById(Mapping):
+    """doc_id : document view of a DocumentStore, in store order."""
+
+    def __init__(self, store : DocumentStore) -> None:
+        self._store = store
+
+    def __getitem__(self, doc_id : int) -> dict:
+        return self._store[self._store.position(doc_id)]
+
+    def __contains__(self, doc_id) -> bool:
+        try:
+            self._store.position(doc_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._store.doc_ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+
+class LiveDocuments(MutableMapping):
+    """doc_id : document over a read-only mapping, with writes kept in memory until the next save.
+
+    Updated documents keep their place; added ones follow the stored ones.
+    """
+
+    def __init__(self, base : Mapping) -> None:
+        self.base = base
+        self._changed = {} # doc_id : document added or updated since the base was written
+        self._deleted = set() # doc_ids of the base that were deleted
+
+    def __getitem__(self, doc_id : int) -> dict:
+        try:
+            return self._changed[doc_id]
+        except KeyError:
+            pass
+        if doc_id in self._deleted:
+            raise KeyError(doc_id)
+        return self.base[doc_id]
+
+    def __setitem__(self, doc_id : int, document : dict) -> None:
+        self._changed[doc_id] = document
+        self._deleted.discard(doc_id)
+
+    def __delitem__(self, doc_id : int) -> None:
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        self._changed.pop(doc_id, None)
+        if doc_id in self.base:
+            self._deleted.add(doc_id)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._changed or (doc_id not in self._deleted and doc_id in self.base)
+
+    def __iter__(self) -> Iterator[int]:
+        for doc_id in self.base:
+            if doc_id not in self._deleted:
+                yield doc_id
+        for doc_id in self._changed:
+            if doc_id not in self.base:
+                yield doc_id
+
+    def __len__(self) -> int:
+        added = sum(1 for doc_id in self._changed if doc_id not in self.base)
+        return len(self.base) - len(self._deleted) + added
+
+    @property
+    def modified(self) -> bool:
+        return bool(self._changed or self._deleted)
+
+
+def write_document_store(path : str, documents : Iterable[dict], source : dict | None = None) -> int:
+    """Write documents one at a time into a store at `path`, replacing any store there.
+
+    The store is written next to `path` and swapped in once complete, so
+    an open DocumentStore over the old one keeps working. `source` is kept
+    in the metadata to tell later which file the store mirrors. Returns
+    the number of documents.
+    """
+    staged_path = f"{path}.partial"
+    shutil.rmtree(staged_path, ignore_errors=True)
+    os.makedirs(staged_path)
+
+    offsets = array("q", [0])
+    doc_ids = array("q")
+    with open(os.path.join(staged_path, _DATA_FILE), "wb") as data_file:
+        for document in documents:
+            record = json.dumps(document, ensure_ascii=False).encode("utf-8")
+            data_file.write(record)
+            offsets.append(offsets[-1] + len(record))
+            doc_ids.append(document["id"])
+
+    doc_ids = np.frombuffer(doc_ids, dtype=np.int64)
+    doc_order = np.argsort(doc_ids, kind="stable")
+    if np.any(np.diff(doc_ids[doc_order]) == 0):
+        shutil.rmtree(staged_path, ignore_errors=True)
+        raise ValueError(f"Duplicate document ids in the documents for {path}")
+
+    np.save(os.path.join(staged_path, "offsets.npy"), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(staged_path, "doc_ids.npy"), doc_ids)
+    np.save(os.path.join(staged_path, "doc_order.npy"), doc_order)
+    with open(os.path.join(staged_path, _META_FILE), "w") as meta_file:
+        json.dump({"version": DOCUMENT_STORE_VERSION, "documents": len(doc_ids), "source": source}, meta_file)
+
+    replace_index_directory(staged_path, path)
+
+    return len(doc_ids)
+
+
+def document_store_exists(path : str) -> bool:
+    return os.path.exists(os.path.join(path, _META_FILE))
+
+
+def source_fingerprint(source_path : str) -> dict:
+    stat = os.stat(source_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_or_create_document_store(path : str, source_path : str) -> DocumentStore:
+    """The store at `path` mirroring the JSON or JSONL file `source_path`, rewritten when the file changed."""
+    source = source_fingerprint(source_path)
+    if document_store_exists(path):
+        store = DocumentStore(path)
+        if store.meta.get("source") == source:
+            return store
+
+    write_document_store(path, iter_documents(source_path), source)
+    return DocumentStore(path)
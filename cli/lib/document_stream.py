@@ -0,0 +1,71 @@
+import json
+from collections.abc import Iterator
+
+from constants import *
+
+
+def iter_documents(path : str, key : str = "movies", read_size : int = DOCUMENT_STREAM_READ_SIZE) -> Iterator[dict]:
+    """Documents of a JSONL file, or of the `key` array of a JSON file, one at a time.
+
+    The JSON file is read in `read_size` pieces and each element decoded as
+    soon as it is complete, so memory follows the largest document rather
+    than the file.
+    """
+    if path.endswith(".jsonl"):
+        with open(path, "r") as documents_file:
+            for line in documents_file:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    decoder = json.JSONDecoder()
+    with open(path, "r") as documents_file:
+        buffer = ""
+        eof = False
+
+        def fill() -> bool:
+            nonlocal buffer, eof
+            piece = documents_file.read(read_size)
+            eof = piece == ""
+            buffer += piece
+            return not eof
+
+        # Up to and including the "[" that opens the array
+        marker = f'"{key}"'
+        while (start := buffer.find(marker)) < 0:
+            if not fill():
+                raise ValueError(f"No \"{key}\" array in {path}")
+        pos = start + len(marker)
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n:":
+                pos += 1
+            if pos < len(buffer):
+                break
+            if not fill():
+                raise ValueError(f"No \"{key}\" array in {path}")
+        if buffer[pos] != "[":
+            raise ValueError(f"\"{key}\" in {path} is not an array")
+        pos += 1
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                buffer, pos = "", 0
+                if not fill():
+                    raise ValueError(f"Unterminated \"{key}\" array in {path}")
+                continue
+            if buffer[pos] == "]":
+                return
+
+            try:
+                document, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The document runs past the buffer: keep its start and read more
+                buffer, pos = buffer[pos:], 0
+                if not fill():
+                    raise
+                continue
+
+            yield document
+            pos = end
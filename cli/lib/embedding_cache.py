@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from constants import *
+
+
+class EmbeddingManifest(dict):
+    """What an embedding cache was built from, stored as JSON next to the .npy.
+
+    Keys: version, model_name, dimension, documents, rows, corpus_hash and
+    params (settings such as chunk sizes that shaped the encoded texts).
+    """
+
+    def matches(self, other: "EmbeddingManifest") -> bool:
+        return all(self.get(key) == other.get(key) for key in ("version", "model_name", "dimension", "documents", "corpus_hash", "params"))
+
+
+class CorpusHash:
+    """corpus_hash fed one text at a time, for builds that stream the corpus."""
+
+    def __init__(self, *params) -> None:
+        self._digest = hashlib.sha256(repr(params).encode("utf-8"))
+
+    def update(self, text: str) -> None:
+        self._digest.update(text.encode("utf-8"))
+        self._digest.update(b"\0")
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+
+def corpus_hash(texts: list[str], *params) -> str:
+    """Hash of the encoded texts (in order) and anything else that shaped them, e.g. chunk sizes."""
+    corpus = CorpusHash(*params)
+    for text in texts:
+        corpus.update(text)
+    return corpus.hexdigest()
+
+
+def content_hash(text: str, *params) -> str:
+    """Hash of one document or chunk, used to find rows that can be reused on rebuild."""
+    digest = hashlib.blake2b(repr(params).encode("utf-8"), digest_size=16)
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def manifest_path(embeddings_path: str) -> str:
+    root, _ = os.path.splitext(embeddings_path)
+    return f"{root}.manifest.json"
+
+
+def hashes_path(embeddings_path: str) -> str:
+    root, _ = os.path.splitext(embeddings_path)
+    return f"{root}.hashes.json"
+
+
+class PreviousEmbeddings:
+    """A valid earlier cache, whose rows can be copied instead of re-encoded."""
+
+    def __init__(self, embeddings: np.ndarray, row_hashes: list[str], documents: dict[str, tuple[int, int]]) -> None:
+        self.embeddings = embeddings  # memory mapped
+        self.row_hashes = row_hashes  # content hash of every row
+        self.documents = documents  # document hash : (first row, row count)
+        self._rows = {h: i for i, h in enumerate(row_hashes)}
+
+    def row(self, row_hash: str) -> int:
+        return self._rows.get(row_hash, -1)
+
+
+def make_manifest(model_name: str, dimension: int, documents: int, rows: int, corpus: str, params: list) -> EmbeddingManifest:
+    return EmbeddingManifest(
+        version=EMBEDDING_CACHE_VERSION,
+        model_name=model_name,
+        dimension=int(dimension),
+        documents=int(documents),
+        rows=int(rows),
+        corpus_hash=corpus,
+        params=list(params),
+    )
+
+
+def open_embeddings(embeddings_path: str, expected: EmbeddingManifest) -> np.ndarray | None:
+    """Memory-map a cached embedding matrix, or None if it is missing or was built from something else.
+
+    Only the manifest and the .npy header are read, so a stale cache is
+    caught without touching the vectors.
+    """
+    path = manifest_path(embeddings_path)
+    if not os.path.exists(embeddings_path) or not os.path.exists(path):
+        return None
+
+    with open(path, "r") as manifest_file:
+        manifest = EmbeddingManifest(json.load(manifest_file))
+    if not manifest.matches(expected):
+        return None
+
+    embeddings = np.load(embeddings_path, mmap_mode="r")
+    if embeddings.shape != (manifest["rows"], manifest["dimension"]):
+        return None
+
+    return embeddings
+
+
+def load_previous(embeddings_path: str, expected: EmbeddingManifest) -> PreviousEmbeddings | None:
+    """The cache at `embeddings_path` if it was built with the same model and settings, whatever the corpus."""
+    path = manifest_path(embeddings_path)
+    if not all(os.path.exists(p) for p in (embeddings_path, path, hashes_path(embeddings_path))):
+        return None
+
+    with open(path, "r") as manifest_file:
+        manifest = json.load(manifest_file)
+    with open(hashes_path(embeddings_path), "r") as hashes_file:
+        hashes = json.load(hashes_file)
+
+    if any(manifest.get(key) != expected.get(key) for key in ("version", "model_name", "dimension")):
+        return None
+    if hashes.get("corpus_hash") != manifest["corpus_hash"] or hashes.get("params") != expected.get("params"):
+        return None
+
+    embeddings = np.load(embeddings_path, mmap_mode="r")
+    if embeddings.shape != (len(hashes["rows"]), manifest["dimension"]):
+        return None
+
+    documents = {h: (start, count) for h, start, count in hashes["documents"]}
+    return PreviousEmbeddings(embeddings, hashes["rows"], documents)
+
+
+def save_embeddings(
+    embeddings_path: str,
+    embeddings: np.ndarray,
+    manifest: EmbeddingManifest,
+    row_hashes: list[str],
+    documents: list[tuple[str, int, int]],
+) -> None:
+    """Write the matrix, its row and document hashes, and then the manifest.
+
+    `documents` holds (document hash, first row, row count) for every
+    document that produced rows.
+    """
+    os.makedirs(os.path.dirname(embeddings_path), exist_ok=True)
+    invalidate_embeddings(embeddings_path)
+
+    with open(hashes_path(embeddings_path), "w") as hashes_file:
+        json.dump(
+            {
+                "corpus_hash": manifest["corpus_hash"],
+                "params": manifest.get("params"),
+                "rows": row_hashes,
+                "documents": documents,
+            },
+            hashes_file,
+        )
+
+    # Replace rather than overwrite, so readers that still map the old file keep valid pages
+    tmp_path = f"{embeddings_path}.tmp"
+    with open(tmp_path, "wb") as embeddings_file:
+        np.save(embeddings_file, embeddings)
+    os.replace(tmp_path, embeddings_path)
+
+    # Written last: an .npy without a manifest is never trusted.
+    with open(manifest_path(embeddings_path), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def finish_staged_embeddings(
+    embeddings_path: str,
+    staged_path: str,
+    manifest: EmbeddingManifest,
+    rows_path: str,
+    documents_path: str,
+) -> None:
+    """save_embeddings for a matrix already written to the .npy at `staged_path`.
+
+    The row and document hashes were staged as the comma-separated JSON
+    items of their lists, in `rows_path` and `documents_path`; they are
+    copied into the hashes file without being loaded. The staged files are
+    removed.
+    """
+    invalidate_embeddings(embeddings_path)
+
+    with open(hashes_path(embeddings_path), "w") as hashes_file:
+        hashes_file.write(f'{{"corpus_hash": {json.dumps(manifest["corpus_hash"])}, "params": {json.dumps(manifest.get("params"))}, "rows": [')
+        with open(rows_path, "r") as rows_file:
+            shutil.copyfileobj(rows_file, hashes_file)
+        hashes_file.write('], "documents": [')
+        with open(documents_path, "r") as documents_file:
+            shutil.copyfileobj(documents_file, hashes_file)
+        hashes_file.write("]}")
+    os.remove(rows_path)
+    os.remove(documents_path)
+
+    os.replace(staged_path, embeddings_path)
+
+    with open(manifest_path(embeddings_path), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def invalidate_embeddings(embeddings_path: str) -> None:
+    path = manifest_path(embeddings_path)
+    if os.path.exists(path):
+        os.remove(path)
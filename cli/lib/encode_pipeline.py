@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+
+import numpy as np
+
+from constants import *
+
+from .tracing import span
+
+
+class EncodePipeline:
+    """Encodes texts in batches of similar length, in this process or across a pool of encode processes.
+
+    Texts are sorted by length before batching, so each batch pads to
+    little more than its own longest text, and the vectors are put back
+    in input order. With `workers` above 0 the batches are spread over
+    that many processes, each holding its own copy of the model; the
+    pool starts on first use and lasts until `close`. `stats` counts the
+    texts, batches and seconds spent encoding, for chunks per second.
+    """
+
+    def __init__(self, load_model : Callable, model_name : str | None = None, batch_size : int = ENCODE_BATCH_SIZE, workers : int = ENCODE_WORKERS, sort_by_length : bool = True) -> None:
+        self._load_model = load_model # the model, only called when encoding here or when the pool needs it pickled
+        self.model_name = model_name # loaded by each pool worker instead of pickling the model
+        self.batch_size = batch_size
+        self.workers = workers
+        self.sort_by_length = sort_by_length
+        self.stats = {"texts": 0, "batches": 0, "encode_s": 0.0}
+        self._pool = None
+
+    def __enter__(self) -> "EncodePipeline":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            with span("encode.pool_start"):
+                # spawn: forking a process that already runs torch threads can deadlock
+                self._pool = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_encode_worker,
+                    initargs=(self.model_name, None if self.model_name else self._load_model(), self.workers),
+                )
+        return self._pool
+
+    def throughput(self) -> dict[str, float]:
+        """`stats` plus chunks encoded per second of encoding."""
+        return {**self.stats, "chunks_per_s": self.stats["texts"] / self.stats["encode_s"] if self.stats["encode_s"] else 0.0}
+
+    def encode(self, texts : list[str]) -> np.ndarray:
+        """Vectors of `texts`, in order."""
+        start = time.perf_counter()
+        batches = length_sorted_batches(texts, self.batch_size, self.sort_by_length)
+
+        if self.workers > 0 and len(batches) > 1:
+            pending = [self.pool.submit(_encode_worker, [texts[i] for i in batch], self.batch_size) for batch in batches]
+            vectors = (future.result() for future in pending)
+        else:
+            vectors = (self._encode_batch([texts[i] for i in batch]) for batch in batches)
+
+        embeddings = None
+        for batch, batch_vectors in zip(batches, vectors):
+            batch_vectors = np.asarray(batch_vectors)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch_vectors.shape[1]), dtype=batch_vectors.dtype)
+            embeddings[batch] = batch_vectors
+        if embeddings is None:
+            embeddings = np.asarray(self._encode_batch([]))
+
+        self.stats["texts"] += len(texts)
+        self.stats["batches"] += len(batches)
+        self.stats["encode_s"] += time.perf_counter() - start
+        return embeddings
+
+    def encode_stream(self, texts : Iterable[str], window : int = EMBEDDING_BUILD_BATCH_SIZE) -> Iterator[np.ndarray]:
+        """Vectors of every `window` texts, in order, as each window is encoded.
+
+        `texts` is consumed on a background thread, so reading and
+        chunking the next window overlap with encoding this one. Texts are
+        sorted by length within a window.
+        """
+        windows = Queue(maxsize=ENCODE_PREFETCH_WINDOWS)
+        failure = []
+
+        def produce() -> None:
+            try:
+                window_texts = []
+                for text in texts:
+                    window_texts.append(text)
+                    if len(window_texts) == window:
+                        windows.put(window_texts)
+                        window_texts = []
+                if window_texts:
+                    windows.put(window_texts)
+            except BaseException as e:
+                failure.append(e)
+            finally:
+                windows.put(None)
+
+        producer = threading.Thread(target=produce, name="encode-reader", daemon=True)
+        producer.start()
+        finished = False
+        try:
+            while (window_texts := windows.get()) is not None:
+                yield self.encode(window_texts)
+            finished = True
+        finally:
+            # Unblock the reader if the consumer stopped early
+            while not finished:
+                finished = windows.get() is None
+            producer.join()
+        if failure:
+            raise failure[0]
+
+    def _encode_batch(self, texts : list[str]) -> np.ndarray:
+        with span("encode.batch"):
+            return self._load_model().encode(texts, batch_size=max(len(texts), 1), show_progress_bar=False)
+
+
+def length_sorted_batches(texts : list[str], batch_size : int, sort_by_length : bool = True) -> list[np.ndarray]:
+    """Indices of `texts` in batches of up to `batch_size`, longest texts first.
+
+    Character length stands in for token length, as it does in
+    SentenceTransformer.encode; ties keep input order.
+    """
+    if sort_by_length:
+        order = np.argsort(-np.array([len(text) for text in texts], dtype=np.int64), kind="stable")
+    else:
+        order = np.arange(len(texts))
+    return [order[start : start + batch_size] for start in range(0, len(texts), batch_size)]
+
+
+_worker_model = None # model of an encode worker process
+
+
+def _init_encode_worker(model_name : str | None, model, workers : int) -> None:
+    global _worker_model
+    try:
+        import torch
+        # Split the cores between the workers instead of each one using all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    except ImportError:
+        pass
+
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name, device="cpu")
+    _worker_model = model
+
+
+def _encode_worker(texts : list[str], batch_size : int) -> np.ndarray:
+    return _worker_model.encode(texts, batch_size=batch_size, show_progress_bar=False)
@@ -1,73 +1,314 @@
-import os
+import asyncio
+import time
+from collections.abc import Iterator
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from itertools import batched
+
+import numpy as np
 
 from constants import *
 
-from .keyword_search import InvertedIndex
+from .ann_index import recall_at_k
+from .keyword_search import InvertedIndex, load_or_build_index
 from .chunked_sematic_search import ChunkedSemanticSearch
+from .quantization import rerank_candidates
+from .rank_fusion import RankedStream, rrf_fuse, streaming_rrf
+from .semantic_search import SemanticSearch, top_k_indices
+from .score_normalization import hybrid_score, normalize, normalize_dict
+from .tracing import span, traced
 
 class HybridSearch:
-    def __init__(self, documents):
+    """Weighted and rank-fused searches over BM25 and the semantic indexes.
+
+    The retrievers of one query run concurrently on a thread pool, which
+    pays off because the transformer forward pass and the NumPy scoring
+    release the GIL while BM25 walks its posting lists. Pass `executor` to
+    share a pool, or `workers=0` to run the retrievers one after the other.
+    """
+
+    def __init__(self, documents, semantic_search : ChunkedSemanticSearch | None = None, idx : InvertedIndex | None = None, document_search : SemanticSearch | None = None, executor : Executor | None = None, workers : int = HYBRID_WORKERS):
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
-        self.semantic_search.load_or_create_chunk_embeddings(documents)
+        self._owns_executor = executor is None and workers > 0
+        if self._owns_executor:
+            executor = ThreadPoolExecutor(workers, thread_name_prefix="hybrid-search")
+        self.executor = executor # None runs the retrievers in the calling thread
+        self._document_search = document_search # whole-document SemanticSearch, loaded when RRF first needs it
+        if semantic_search is None:
+            semantic_search = ChunkedSemanticSearch()
+            semantic_search.load_or_create_chunk_embeddings(documents)
+        self.semantic_search = semantic_search
+
+        if idx is None:
+            idx = load_or_build_index()
+        self.idx = idx
+
+        self._doc_ids = semantic_search.doc_ids # movie_idx : movie id
+        self._document_index = {doc_id: i for i, doc_id in enumerate(self._doc_ids.tolist())} # movie id : movie_idx
 
-        self.idx = InvertedIndex()
 
-        if not os.path.exists(self.idx.index_path):
-            self.idx.build()
-            self.idx.save()
+    @property
+    def document_search(self) -> SemanticSearch:
+        if self._document_search is None:
+            document_search = SemanticSearch(quantization=self.semantic_search.quantization, rerank=self.semantic_search.rerank)
+            document_search.load_or_create_embeddings(self.documents)
+            self._document_search = document_search
+        return self._document_search
 
+    def close(self) -> None:
+        """Shut down the thread pool, unless it was passed in by the caller."""
+        if self._owns_executor:
+            self.executor.shutdown()
+
+    def __enter__(self) -> "HybridSearch":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _submit(self, fn, *args) -> Future:
+        """fn(*args) on the thread pool, or right away when there is none."""
+        if self.executor is not None:
+            return self.executor.submit(fn, *args)
+
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
 
     def _bm25_search(self, query : str, limit : int) -> list[float]:
-        self.idx.load()
         return self.idx.bm25_search(query, limit)
 
-    def weighted_search(self, query : str, alpha: float, limit : int = LIMIT) -> list[float]:
+    def _weighted_retrievers(self, query : str, limit : int, ann : bool, nprobe : int) -> tuple[Future, Future]:
+        # The semantic side goes first: encoding the query is the slowest
+        # step, and BM25 runs alongside it.
+        semantic = self._submit(self.semantic_search.search_chunks, query, limit * 500, ann, nprobe, False)
+        bm25 = self._submit(self._bm25_search, query, limit * 500)
+        return bm25, semantic
+
+    @traced("hybrid.weighted_search", query=True)
+    def weighted_search(self, query : str, alpha: float, limit : int = LIMIT, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE) -> list[float]:
+        bm25, semantic = self._weighted_retrievers(query, limit, ann, nprobe)
+        with span("hybrid.wait"):
+            bm25_dic, semsearch_dic = bm25.result(), semantic.result()
+
         # id : score
-        bm25_dic = self._bm25_search(query, limit * 500)
-        semsearch_dic = self.semantic_search.search_chunks(query, limit * 500)
-        sem_score_dict = {d["id"]: d["score"] for d in semsearch_dic}
-        
-        bm25_dic_norm = normalize_dict(bm25_dic)
-        sem_score_dic_norm = normalize_dict(sem_score_dict)
-
-        comb_score_dic = {}
-        for movie_id, norm_score in bm25_dic_norm.items():
-            comb_score_dic[movie_id] = {"keyword_score" : norm_score, "semantic_score": 0}
-        for movie_id, norm_score in sem_score_dic_norm.items():
-            if movie_id not in comb_score_dic.keys():
-                comb_score_dic[movie_id] = {"keyword_score" : 0, "semantic_score": norm_score}
-                continue
-            comb_score_dic[movie_id]["semantic_score"] = norm_score
-
-        for movie_id in comb_score_dic.keys():
-            scores = comb_score_dic[movie_id]
-            scores["hybrid_score"] = hybrid_score(scores["keyword_score"], scores["semantic_score"], alpha)
-
-        comb_score_dic_sorted = dict(
-            sorted(comb_score_dic.items(), key=lambda item: item[1]["hybrid_score"], reverse=True)[:limit]
-        )
-
-        return comb_score_dic_sorted
-
-    def rrf_search(self, query, k, limit=10):
-        raise NotImplementedError("RRF hybrid search is not implemented yet.")
-
-def normalize(score_list : list[float]) -> list[float]:
-    max_score = max(score_list)
-    min_score = min(score_list)
+        return combine_scores(bm25_dic, semsearch_dic, alpha, limit)
+
+    async def weighted_search_async(self, query : str, alpha: float, limit : int = LIMIT, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE) -> dict[int, dict[str, float]]:
+        """weighted_search that awaits the retrievers instead of blocking the event loop."""
+        bm25, semantic = self._weighted_retrievers(query, limit, ann, nprobe)
+        bm25_dic, semsearch_dic = await asyncio.gather(asyncio.wrap_future(bm25), asyncio.wrap_future(semantic))
+
+        return combine_scores(bm25_dic, semsearch_dic, alpha, limit)
+
+    def weighted_search_many(self, queries : list[str], alpha: float, limit : int = LIMIT, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE, batch_size : int = SEARCH_BATCH_SIZE) -> Iterator[dict[int, dict[str, float]]]:
+        """weighted_search for every query, in order, yielded one batch of queries at a time."""
+        for batch in batched(queries, batch_size):
+            batch = list(batch)
+            semsearch_dics = self._submit(lambda: list(self.semantic_search.search_chunks_many(batch, limit * 500, ann, nprobe, batch_size, False)))
+            bm25_dics = self._submit(lambda: list(self.idx.bm25_search_many(batch, limit * 500)))
+            for bm25_dic, semsearch_dic in zip(bm25_dics.result(), semsearch_dics.result()):
+                yield combine_scores(bm25_dic, semsearch_dic, alpha, limit)
+
+    @traced("hybrid.pooled_search", query=True)
+    def pooled_search(self, query : str, alpha : float, limit : int = LIMIT, pool_size : int = HYBRID_POOL_SIZE, pool_from : str = HYBRID_POOL_FROM, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE) -> dict[int, dict[str, float]]:
+        """weighted_search over a candidate pool instead of two near-full rankings.
+
+        One retriever (`pool_from`) picks its best `pool_size` movies and
+        the other scores only those: chunk rows are gathered from the
+        embedding matrix, BM25 scores are looked up in the posting lists.
+        Scores are min-max normalized over the pool and fused in NumPy
+        arrays, so the cost follows the pool size rather than the corpus.
+        """
+        semantic_search = self.semantic_search
+        match pool_from:
+            case "semantic":
+                query_embedding = semantic_search.embed_queries([query])[0]
+                movies, semantic_scores = semantic_search.score_movies(query_embedding, ann, nprobe, rerank_candidates(pool_size))
+                best = top_k_indices(semantic_scores, pool_size)
+                movie_idx, semantic_scores = movies[best], semantic_scores[best]
+                keyword_scores = self.idx.bm25_scores(query, self._doc_ids[movie_idx].tolist())
+            case "keyword":
+                query_embedding = self._submit(semantic_search.embed_queries, [query]) # encoded while BM25 picks the pool
+                # Zero scores are only padding from the scorer, not matches
+                pool = [(doc_id, score) for doc_id, score in self.idx.bm25_search(query, pool_size).items() if score > 0 and doc_id in self._document_index]
+                movie_idx = np.array([self._document_index[doc_id] for doc_id, _ in pool], dtype=np.int64)
+                keyword_scores = np.array([score for _, score in pool])
+                semantic_scores = semantic_search.score_documents(query_embedding.result()[0], movie_idx)
+            case _:
+                raise ValueError(f"Unknown pool retriever: {pool_from}, expected one of {HYBRID_POOL_SOURCES}")
+
+        doc_ids = self._doc_ids[movie_idx].tolist()
+        return fuse_pool(doc_ids, keyword_scores, semantic_scores, alpha, limit)
+
+    def pool_recall(self, queries : list[str], alpha : float = DEFAULT_ALPHA, k : int = LIMIT, pool_sizes : list[int] = HYBRID_RECALL_POOL_SIZES, pool_from : str = HYBRID_POOL_FROM) -> dict[int, dict[str, float]]:
+        """recall@k and mean latency of pooled_search against weighted_search, per pool size."""
+        self.semantic_search.embed_queries(queries) # time retrieval, not the first encode
+
+        def run(search) -> tuple[list[list[int]], float]:
+            start = time.perf_counter()
+            results = [list(search(query)) for query in queries]
+            return results, (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+        full, full_ms = run(lambda query: self.weighted_search(query, alpha, k))
 
+        report = {0: {"recall": 1.0, "mean_ms": full_ms}} # pool 0 : current full weighted_search
+        for pool_size in pool_sizes:
+            pooled, pooled_ms = run(lambda query: self.pooled_search(query, alpha, k, pool_size, pool_from))
+            report[pool_size] = {"recall": recall_at_k(full, pooled, k), "mean_ms": pooled_ms}
+
+        return report
+
+    @traced("hybrid.rrf_search", query=True)
+    def rrf_search(self, query : str, k : int = RRF_K, limit : int = LIMIT, retrievers : list[str] = RRF_DEFAULT_RETRIEVERS, streaming : bool = True, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE) -> dict[int, dict[str, float]]:
+        """Reciprocal Rank Fusion of the rankings of `retrievers` ("keyword", "semantic", "chunked").
+
+        Streaming pulls each ranking a page at a time and stops once the
+        top `limit` is settled; otherwise the full rankings are fused at once.
+        The retrievers score the corpus concurrently, semantic ones first.
+        """
+        def ranking(name : str):
+            fetch, rank = self._ranked_ids(name, query, ann, nprobe)
+            stream = RankedStream(fetch, rank=rank)
+            return stream if streaming else stream.pull_all()
+
+        futures = {name: self._submit(ranking, name) for name in sorted(retrievers, key=lambda name: name == "keyword")}
+        with span("hybrid.wait"):
+            rankings = {name: futures[name].result() for name in retrievers}
+        with span("hybrid.fuse"):
+            if streaming:
+                return streaming_rrf(rankings, k, limit)
+            return rrf_fuse(rankings, k, limit)
+
+    def _ranked_ids(self, retriever : str, query : str, ann : bool, nprobe : int):
+        """(fetch, rank) for a RankedStream over the movie ids of one retriever.
+
+        Each retriever scores the corpus once; deeper pages only re-select
+        from those scores, and ranks are counted from them.
+        """
+        match retriever:
+            case "keyword":
+                scorer = self.idx._scorer
+                tokens = self.idx.tokenize(query)
+                ranking = [] # every matching doc id, best first, once a page needs more than the pruned top-k
+                matches = {} # ordinal : score of every matching document, once the pruned top-k is not enough
+
+                def full_scores() -> dict[int, float]:
+                    if not matches:
+                        # Zero scores are only padding from the scorer, not matches
+                        matches.update((ordinal, score) for ordinal, score in scorer.score(tokens).items() if score > 0)
+                    return matches
+
+                def fetch(n : int) -> list[int]:
+                    if not ranking and n <= RRF_PAGE_SIZE:
+                        return [doc_id for doc_id, score in scorer.top_k(tokens, n) if score > 0]
+                    if not ranking:
+                        scores = full_scores()
+                        best = sorted(scores, key=lambda ordinal: (-scores[ordinal], ordinal))
+                        ranking.extend(int(scorer.postings.doc_ids[ordinal]) for ordinal in best)
+                    return ranking[:n]
+
+                def rank(doc_ids : list[int]) -> list[int | None]:
+                    scores = full_scores()
+                    ordinals = np.fromiter(scores, dtype=np.int64, count=len(scores))
+                    values = np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+                    ranks = []
+                    for doc_id in doc_ids:
+                        try:
+                            ordinal = scorer.postings.ordinal(doc_id)
+                        except KeyError:
+                            ordinal = -1
+                        if ordinal not in scores:
+                            ranks.append(None)
+                            continue
+                        # Same order as fetch: higher score first, ties by lower ordinal
+                        score = scores[ordinal]
+                        ranks.append(1 + int((values > score).sum()) + int(((values == score) & (ordinals < ordinal)).sum()))
+                    return ranks
+
+                return fetch, rank
+            case "semantic":
+                document_search = self.document_search
+                rows, scores = document_search.score_documents_by_vector(document_search.embed_queries([query])[0])
+                positions = np.arange(len(scores)) if rows is None else rows
+            case "chunked":
+                semantic_search = self.semantic_search
+                positions, scores = semantic_search.score_movies(semantic_search.embed_queries([query])[0], ann, nprobe)
+            case _:
+                raise ValueError(f"Unknown retriever: {retriever}, expected one of {RRF_RETRIEVERS}")
+
+        doc_ids = self._doc_ids[positions]
+
+        def rank(ids : list[int]) -> list[int | None]:
+            ranks = []
+            for doc_id in ids:
+                found = np.flatnonzero(doc_ids == doc_id)
+                if len(found) == 0:
+                    ranks.append(None)
+                    continue
+                # Same order as top_k_indices: higher score first, ties by lower index
+                i = found[0]
+                ranks.append(1 + int((scores > scores[i]).sum()) + int((scores[:i] == scores[i]).sum()))
+            return ranks
+
+        return (lambda n: doc_ids[top_k_indices(scores, n)].tolist()), rank
+
+@traced("hybrid.fuse")
+def fuse_pool(doc_ids : list[int], keyword_scores : np.ndarray, semantic_scores : np.ndarray, alpha : float, limit : int) -> dict[int, dict[str, float]]:
+    """Weighted hybrid ranking of a candidate pool, from the raw scores of both retrievers."""
+    keyword_norm = normalize_scores(keyword_scores)
+    semantic_norm = normalize_scores(semantic_scores)
+    hybrid_scores = hybrid_score(keyword_norm, semantic_norm, alpha)
+
+    return {
+        doc_ids[i]: {
+            "keyword_score": float(keyword_norm[i]),
+            "semantic_score": float(semantic_norm[i]),
+            "hybrid_score": float(hybrid_scores[i]),
+        }
+        for i in top_k_indices(hybrid_scores, limit).tolist()
+    }
+
+def normalize_scores(scores : np.ndarray) -> np.ndarray:
+    """`normalize` over an array; -inf (no score at all) becomes the lowest score."""
+    scores = np.asarray(scores, dtype=np.float64)
+    finite = np.isfinite(scores)
+    if not finite.any():
+        return np.zeros(len(scores))
+    scores = np.where(finite, scores, scores[finite].min())
+
+    min_score = scores.min()
+    max_score = scores.max()
     if min_score == max_score:
-        return [1.0] * len(score_list)
+        return np.ones(len(scores))
+
+    return (scores - min_score) / (max_score - min_score)
+
+@traced("hybrid.fuse")
+def combine_scores(bm25_dic : dict[int, float], semsearch_dic : list[dict], alpha : float, limit : int) -> dict[int, dict[str, float]]:
+    """Normalize both sides and rank movies by their weighted hybrid score."""
+    sem_score_dict = {d["id"]: d["score"] for d in semsearch_dic}
+
+    bm25_dic_norm = normalize_dict(bm25_dic)
+    sem_score_dic_norm = normalize_dict(sem_score_dict)
 
-    norm_list = [(score - min_score) / (max_score - min_score) for score in score_list]
+    comb_score_dic = {}
+    for movie_id, norm_score in bm25_dic_norm.items():
+        comb_score_dic[movie_id] = {"keyword_score" : norm_score, "semantic_score": 0}
+    for movie_id, norm_score in sem_score_dic_norm.items():
+        if movie_id not in comb_score_dic.keys():
+            comb_score_dic[movie_id] = {"keyword_score" : 0, "semantic_score": norm_score}
+            continue
+        comb_score_dic[movie_id]["semantic_score"] = norm_score
 
-    return norm_list
+    for movie_id in comb_score_dic.keys():
+        scores = comb_score_dic[movie_id]
+        scores["hybrid_score"] = hybrid_score(scores["keyword_score"], scores["semantic_score"], alpha)
 
-def normalize_dict(score_dict: dict[int, float]) -> dict[int, float]:
-    scores = list(score_dict.values())
-    normed = normalize(scores)
-    return dict(zip(score_dict.keys(), normed))
+    comb_score_dic_sorted = dict(
+        sorted(comb_score_dic.items(), key=lambda item: item[1]["hybrid_score"], reverse=True)[:limit]
+    )
 
-def hybrid_score(bm25_score, semantic_score, alpha=0.5):
-    return alpha * bm25_score + (1 - alpha) * semantic_score
+    return comb_score_dic_sorted
@@ -5,79 +5,163 @@ import math
 import argparse
 import os
 import json
-import string
-from nltk.stem import PorterStemmer
+from bisect import bisect_left
 from collections import Counter
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from itertools import islice
+from typing import NamedTuple
+
+import numpy as np
 
 from constants import *
 
+from .analyzer import Analyzer
+from .bm25_scorer import BM25Scorer, DictPostings
+from .columnar_index import ColumnarIndex, columnar_index_exists, write_columnar_index
+from .document_store import DocumentStore, LiveDocuments, document_store_exists, write_document_store
+from .live_index import LiveSegments
+from .positional_index import DocumentPositions, intersect_postings, min_distance, phrase_match, proximity_boost, token_positions
+from .tracing import span, traced
+
 class InvertedIndex:
-    def __init__(self):
+    def __init__(self, movies_path : str | None = None, cache_path : str | None = None):
         self.index = {}
-        self.docmap = {}
+        self.docmap = {} # doc_id : movie, LiveDocuments over the document store once loaded
         self.term_frequencies = {} # doc_id : Counter objects
         self.doc_lengths = {} # doc_id : length of tokens
+        self._analyzer = None # Analyzer, read from the stopwords file on first use
+        self._live = None # LiveSegments over the DictPostings (build) or ColumnarIndex (load)
+        self._positions = None # DocumentPositions when the index records token positions
+        self.build_stats = None # blocks, terms, postings and memory of the last build_spimi
+        self.__scorer = None # BM25Scorer, recreated when the live segments change
         self._cur_path = os.path.dirname(__file__)
-        self._data_mov_path = os.path.join(self._cur_path, "..", "..", "data", "movies.json")
+        self._data_mov_path = movies_path or os.path.join(self._cur_path, "..", "..", "data", "movies.json")
         self._stopwords_path = os.path.join(self._cur_path, "..", "..", "data", "stopwords.txt")
-        self._cache_path = os.path.join(self._cur_path, "..", "..", "cache")
-        self.index_path = os.path.join(self._cache_path, "index.pkl")
-        self._docmap_path = os.path.join(self._cache_path, "docmap.pkl")
+        self._cache_path = cache_path or os.path.join(self._cur_path, "..", "..", "cache")
+        self.index_path = os.path.join(self._cache_path, "index")
+        self._pickled_index_path = os.path.join(self._cache_path, "index.pkl")
+        self._documents_path = os.path.join(self._cache_path, "documents")
+        self._docmap_path = os.path.join(self._cache_path, "docmap.pkl") # docmap of older versions
         self._term_frequencies_path = os.path.join(self._cache_path, "term_frequencies.pkl")
         self._doc_lengths_path = os.path.join(self._cache_path, "doc_lengths.pkl")
 
-    def __get_stopwords(self) -> list[str]:
+    @property
+    def analyzer(self) -> Analyzer:
+        if self._analyzer is None:
+            with span("keyword.analyzer_load"):
+                self._analyzer = Analyzer.from_stopwords_file(self._stopwords_path)
+        return self._analyzer
+
+    def __merge_shard(self, doc_ids : list[int], shard : "IndexShard") -> None:
+        # Adding in corpus order gives every dict and set the same insertion
+        # history as a serial build, so the saved index is byte-identical.
+        for token, token_doc_ids in shard.postings.items():
+            try:
+                self.index[token].update(token_doc_ids)
+            except KeyError:
+                self.index[token] = set()
+                self.index[token].update(token_doc_ids)
 
-        with open(self._stopwords_path, "r") as stop_words_file:
-            stop_words = stop_words_file.read()
-            stop_words = stop_words.splitlines()
+        for doc_id, term_frequencies, doc_length in zip(doc_ids, shard.term_frequencies, shard.doc_lengths):
+            self.term_frequencies[doc_id] = term_frequencies
+            self.doc_lengths[doc_id] = doc_length
 
-        return stop_words
+        if shard.positions is not None:
+            for doc_id, positions in zip(doc_ids, shard.positions):
+                self._positions.add(doc_id, positions)
 
-    def __add_document(self, doc_id : int, text : str, stop_words : list[str]) -> None:
+    @property
+    def _postings(self):
+        if self._live is None:
+            return None
+        return self._live.view()
 
-        cleaned_tokens = self.__tokenize(text, stop_words)
+    @property
+    def _scorer(self) -> BM25Scorer | None:
+        postings = self._postings
+        if postings is None:
+            return None
+        if self.__scorer is None or self.__scorer.postings is not postings:
+            # N, avgdl and df follow every add/update/delete
+            with span("keyword.scorer_init"):
+                self.__scorer = BM25Scorer(postings)
+        return self.__scorer
 
-        self.term_frequencies[doc_id] = Counter()
+    def add_document(self, movie : dict) -> None:
+        """Index a movie, replacing any movie with the same id; the next search sees it."""
 
-        for token in cleaned_tokens:
-            try:
-                self.index[token].add(doc_id)
-            except KeyError:
-                self.index[token] = {doc_id}
+        tokens = self.tokenize(f"{movie["title"]} {movie["description"]}")
+        self._live.add(movie["id"], Counter(tokens), len(tokens))
+        if self._positions is not None:
+            self._positions.add(movie["id"], token_positions(tokens))
+        self.docmap[movie["id"]] = movie
+
+        self.__merge_if_needed()
+
+    def update_document(self, movie : dict) -> None:
+
+        if movie["id"] not in self.docmap:
+            raise KeyError(f"No document with id {movie["id"]}")
 
-            self.term_frequencies[doc_id][token] += 1
+        self.add_document(movie)
 
-        self.doc_lengths[doc_id] = len(cleaned_tokens)
+    def delete_document(self, doc_id : int) -> None:
+
+        if doc_id not in self.docmap:
+            raise KeyError(f"No document with id {doc_id}")
+
+        self._live.delete(doc_id)
+        if self._positions is not None:
+            self._positions.discard(doc_id)
+        del self.docmap[doc_id]
+
+        self.__merge_if_needed()
+
+    def merge(self, wait : bool = True) -> None:
+        """Fold added, updated and deleted documents into the main segment."""
+
+        if wait:
+            self._live.wait()
+            self._live.merge()
+        else:
+            self._live.merge_in_background()
+
+    def __merge_if_needed(self) -> None:
+        if self._live.needs_merge():
+            self._live.merge_in_background()
 
     def get_tf(self, doc_id : int, term : str) -> int:
 
-        stop_words = self.__get_stopwords()
-        token = self.__tokenize(term, stop_words)
+        token = self.tokenize(term)
         if len(token) > 1:
             raise Exception(f"Expected one term, got multiple: {token}")
 
         token = token[0]
 
         try:
-            term_freq = self.term_frequencies[doc_id][token] 
+            ordinal = self._postings.ordinal(doc_id)
         except KeyError:
-            term_freq = 0
+            return 0
 
-        return term_freq
+        ordinals, tfs = self._postings.postings(token)
+        pos = bisect_left(ordinals, ordinal)
+        if pos < len(ordinals) and ordinals[pos] == ordinal:
+            return int(tfs[pos])
+
+        return 0
 
     def get_idf(self, term : str) -> float:
 
-        stop_words = self.__get_stopwords()
-        token = self.__tokenize(term, stop_words)
+        token = self.tokenize(term)
         if len(token) > 1:
             raise Exception(f"Expected one term, got multiple: {token}")
 
         token = token[0]
 
         total_doc_count = len(self.docmap)
-        term_match_doc_count = len(self.index[token])
+        term_match_doc_count = self._postings.doc_freq(token)
 
         return math.log((total_doc_count + 1) / (term_match_doc_count + 1))
 
@@ -90,15 +174,14 @@ class InvertedIndex:
 
     def get_bm25_idf(self, term: str) -> float:
 
-        stop_words = self.__get_stopwords()
-        token = self.__tokenize(term, stop_words)
+        token = self.tokenize(term)
         if len(token) > 1:
             raise Exception(f"Expected one term, got multiple: {token}")
 
         token = token[0]
         
         total_doc_count = len(self.docmap)
-        term_match_doc_count = len(self.index[token])
+        term_match_doc_count = self._postings.doc_freq(token)
 
         return math.log((total_doc_count - term_match_doc_count + 0.5) / (term_match_doc_count + 0.5) + 1)
 
@@ -106,8 +189,8 @@ class InvertedIndex:
 
         tf = self.get_tf(doc_id, term)
 
-        avg_doc_length = self.__get_avg_doc_length()
-        length_norm = 1 - b + b * (self.doc_lengths[doc_id]/ avg_doc_length)
+        doc_length = self._postings.doc_lengths[self._postings.ordinal(doc_id)]
+        length_norm = self._scorer.length_norm(int(doc_length), b)
 
         return (tf * (k1 + 1)) / (tf + k1 * length_norm)
 
@@ -118,10 +201,117 @@ class InvertedIndex:
 
         return bm25_tf * bm25_idf
 
-    def bm25_search(self, query : str, limit : int = 5):
+    @traced("keyword.bm25_search", query=True)
+    def bm25_search(self, query : str, limit : int = 5) -> dict[int, float]:
+
+        tokens = self.tokenize(query)
+        scorer = self._scorer
+
+        with span("keyword.score"):
+            return dict(scorer.top_k(tokens, limit))
+
+    def bm25_search_many(self, queries : list[str], limit : int = 5) -> Iterator[dict[int, float]]:
+        """BM25 top-k of every query, in order, against one snapshot of the index.
+
+        The queries are analyzed together, and each term's scores and block
+        maxima are computed once and reused by every query that contains it.
+        """
+
+        scorer = self._scorer
+        with span("keyword.tokenize"):
+            token_lists = self.analyzer.analyze_many(queries)
+        for tokens in token_lists:
+            with span("keyword.score"):
+                results = dict(scorer.top_k(tokens, limit))
+            yield results
+
+    @property
+    def has_positions(self) -> bool:
+        return self._positions is not None
+
+    @traced("keyword.phrase_search", query=True)
+    def phrase_search(self, query : str, limit : int = 5, slop : int = 0) -> dict[int, float]:
+        """BM25 top-k of the documents holding the query terms in order, at most `slop` other terms apart.
+
+        Posting lists are intersected and the candidates checked against
+        the stored positions; no document text is read.
+        """
+
+        tokens = self.tokenize(query)
+        if not tokens:
+            return {}
+        scorer = self._scorer
+        postings = scorer.postings
+
+        with span("keyword.phrase_intersect"):
+            ordinals = intersect_postings(postings, list(dict.fromkeys(tokens)))
+            doc_ids = [int(postings.doc_ids[ordinal]) for ordinal in ordinals.tolist()]
+
+        with span("keyword.phrase_positions"):
+            positions = self.__term_positions(tokens, doc_ids)
+            matches = [i for i in range(len(doc_ids)) if phrase_match([positions[token][i] for token in tokens], slop)]
+
+        with span("keyword.score"):
+            scores = scorer.score_ordinals(tokens, ordinals[matches])
+            best = sorted(zip(scores.tolist(), matches), key=lambda item: (-item[0], item[1]))[:limit]
+
+        return {doc_ids[i]: score for score, i in best}
+
+    @traced("keyword.bm25_proximity_search", query=True)
+    def bm25_proximity_search(self, query : str, limit : int = 5, weight : float = PROXIMITY_BOOST_WEIGHT) -> dict[int, float]:
+        """BM25 top-k with a boost for documents where two query terms occur close together.
+
+        The boost reranks the BM25 top PROXIMITY_RERANK_DEPTH (at least
+        `limit`), so a document outside them is not considered.
+        """
+
+        tokens = self.tokenize(query)
+        scorer = self._scorer
+
+        with span("keyword.score"):
+            candidates = scorer.top_k(tokens, max(limit, PROXIMITY_RERANK_DEPTH))
+
+        terms = list(dict.fromkeys(tokens))
+        if len(terms) < 2 or weight == 0:
+            return dict(candidates[:limit])
+
+        with span("keyword.proximity"):
+            doc_ids = [doc_id for doc_id, _ in candidates]
+            positions = self.__term_positions(terms, doc_ids)
+            boosted = []
+            for i, (doc_id, score) in enumerate(candidates):
+                distance = min_distance([positions[term][i] for term in terms])
+                if distance is not None:
+                    score += proximity_boost(distance, weight)
+                boosted.append((doc_id, score))
+            boosted.sort(key=lambda item: (-item[1], item[0]))
+
+        return dict(boosted[:limit])
+
+    def __term_positions(self, terms : list[str], doc_ids : list[int]) -> dict[str, list[list[int]]]:
+        if self._positions is None:
+            raise ValueError("The index has no positions, rebuild it with positions (keyword_search_cli.py build --positions)")
+        return {term: self._positions.term_positions(term, doc_ids) for term in dict.fromkeys(terms)}
+
+    @traced("keyword.bm25_scores")
+    def bm25_scores(self, query : str, doc_ids : list[int]) -> np.ndarray:
+        """BM25 scores of only the given documents, in the same order; documents not in the index score 0."""
+
+        scorer = self._scorer
+        postings = scorer.postings
+        ordinals = []
+        for doc_id in doc_ids:
+            try:
+                ordinals.append(postings.ordinal(doc_id))
+            except KeyError:
+                ordinals.append(-1)
+
+        return scorer.score_ordinals(self.tokenize(query), ordinals)
 
-        stop_words = self.__get_stopwords()
-        tokens = self.__tokenize(query, stop_words)
+    def bm25_search_exhaustive(self, query : str, limit : int = 5) -> dict[int, float]:
+        """Reference implementation scoring every document, kept for benchmarks."""
+
+        tokens = self.tokenize(query)
 
         scores = {} # doc_id : BM25 cost
         for token in tokens:
@@ -152,52 +342,100 @@ class InvertedIndex:
                         break
         """
 
-        if term in self.index:
-            doc_id_matches = self.index[term]
-        else:
-            doc_id_matches = set()
+        ordinals, _ = self._postings.postings(term)
+        doc_id_matches = [int(self._postings.doc_ids[ordinal]) for ordinal in ordinals]
 
         doc_id_matches = sorted(set(doc_id_matches), reverse=False) # Remove duplicates
 
         return doc_id_matches
 
-    def build(self) -> None:
+    @traced("keyword.build")
+    def build(self, workers : int = 1, positions : bool = False) -> None:
+        """Index movies.json, tokenizing shards of it in `workers` processes when above 1.
+
+        With `positions`, the token positions of every document are kept
+        too, for phrase and proximity queries.
+        """
 
         with open(self._data_mov_path, "r") as mov_file:
             movies = json.load(mov_file)
 
-        stop_words = self.__get_stopwords()
+        doc_ids = [movie["id"] for movie in movies["movies"]]
+        texts = [f"{movie["title"]} {movie["description"]}" for movie in movies["movies"]]
+        self._positions = DocumentPositions() if positions else None
+
+        if workers > 1:
+            n_shards = min(len(texts), workers * INDEX_BUILD_SHARDS_PER_WORKER)
+            bounds = [len(texts) * i // max(n_shards, 1) for i in range(n_shards + 1)]
+            shards = [(doc_ids[lo:hi], texts[lo:hi]) for lo, hi in zip(bounds, bounds[1:])]
+
+            with ProcessPoolExecutor(workers, initializer=_init_shard_worker, initargs=(self._stopwords_path,)) as executor:
+                # map() yields in submission order, so shards merge in corpus order
+                for (shard_doc_ids, _), shard in zip(shards, executor.map(partial(_index_shard_worker, positions=positions), shards)):
+                    self.__merge_shard(shard_doc_ids, shard)
+        else:
+            self.__merge_shard(doc_ids, index_shard(self.analyzer, doc_ids, texts, positions))
 
         for movie in movies["movies"]:
-            self.__add_document(movie["id"], f"{movie["title"]} {movie["description"]}", stop_words)
             self.docmap[movie["id"]] = movie # Doubble saving of id?
 
+        self.__init_scorer(self.__dict_postings())
+
+    def build_spimi(self, memory_budget_mb : float = SPIMI_MEMORY_BUDGET_MB) -> None:
+        """Build and save the index on disk in blocks of at most `memory_budget_mb`, then load it.
+
+        Gives the same index and document store as build() followed by save(), for
+        corpora too large to index in memory. Records what the build did
+        in `build_stats`.
+        """
+        from .spimi import build_spimi_index
+
+        self.build_stats = build_spimi_index(self.analyzer, self._data_mov_path, self.index_path, self._documents_path, memory_budget_mb)
+        self._positions = None
+        self.load()
+
     def save(self) -> None:
 
         if not os.path.exists(self._cache_path):
             os.makedirs(self._cache_path)
 
-        with open(self.index_path, "wb") as index_file:
-            pickle.dump(self.index, index_file)
+        self.merge()
+        write_columnar_index(self.index_path, self._postings, self._positions)
 
-        with open(self._docmap_path, "wb") as docmap_file:
-            pickle.dump(self.docmap, docmap_file)
+        if isinstance(self.docmap, LiveDocuments) and not self.docmap.modified:
+            return # the store already holds every document
+        write_document_store(self._documents_path, self.docmap.values())
 
-        with open(self._term_frequencies_path, "wb") as term_frequencies_file:
-            pickle.dump(self.term_frequencies, term_frequencies_file)
+    @traced("keyword.load")
+    def load(self) -> None:
+        """Open the columnar index and document store, falling back to the old pickle formats."""
+
+        if not columnar_index_exists(self.index_path):
+            self.load_pickles()
+            return
+
+        if document_store_exists(self._documents_path):
+            # Movies are read from the mapped store when a result shows them
+            self.docmap = LiveDocuments(DocumentStore(self._documents_path).by_id)
+        elif os.path.exists(self._docmap_path):
+            with open(self._docmap_path, "rb") as docmap_file:
+                self.docmap = pickle.load(docmap_file)
+        else:
+            raise FileNotFoundError(f"Load path not found: {self._documents_path}")
 
-        with open(self._doc_lengths_path, "wb") as doc_lengths_file:
-            pickle.dump(self.doc_lengths, doc_lengths_file)
+        index = ColumnarIndex(self.index_path)
+        self._positions = DocumentPositions(index) if index.has_positions else None
+        self.__init_scorer(index)
 
-    def load(self) -> None:
+    def load_pickles(self) -> None:
 
-        paths = [self._cache_path, self.index_path, self._docmap_path, self._term_frequencies_path, self._doc_lengths_path]
+        paths = [self._cache_path, self._pickled_index_path, self._docmap_path, self._term_frequencies_path, self._doc_lengths_path]
         for path in paths:
             if not os.path.exists(path):
                 raise FileNotFoundError(f"Load path not found: {path}")
         
        
-        with open(self.index_path, "rb") as index_file:
+        with open(self._pickled_index_path, "rb") as index_file:
             self.index = pickle.load(index_file)
 
         with open(self._docmap_path, "rb") as docmap_file:
@@ -209,20 +447,75 @@ class InvertedIndex:
         with open(self._doc_lengths_path, "rb") as doc_lengths_file:
             self.doc_lengths = pickle.load(doc_lengths_file)
 
-    def __get_avg_doc_length(self) -> float:
-        if len(self.doc_lengths) <= 0:
-            return 0.0
-        return sum(self.doc_lengths.values()) / len(self.doc_lengths)
+        self._positions = None
+        self.__init_scorer(self.__dict_postings())
+
+    def __dict_postings(self) -> DictPostings:
+        return DictPostings(self.index, self.term_frequencies, self.doc_lengths, list(self.docmap))
+
+    def __init_scorer(self, postings : DictPostings | ColumnarIndex) -> None:
+        self._live = LiveSegments(postings)
+        self.__scorer = BM25Scorer(postings)
+
+    @traced("keyword.tokenize")
+    def tokenize(self, text : str) -> list[str]:
+        return self.analyzer.analyze(text)
+
+
+def load_or_build_index(movies_path : str | None = None, cache_path : str | None = None) -> InvertedIndex:
+    idx = InvertedIndex(movies_path, cache_path)
+
+    if columnar_index_exists(idx.index_path):
+        idx.load()
+    else:
+        idx.build()
+        idx.save()
+
+    return idx
+
+
+class IndexShard(NamedTuple):
+    postings : dict[str, list[int]] # term : doc_ids containing it, in corpus order
+    term_frequencies : list[Counter] # per document of the shard
+    doc_lengths : list[int] # per document of the shard
+    positions : list[dict[str, list[int]]] | None = None # per document of the shard, when recorded
+
+
+def index_shard(analyzer : Analyzer, doc_ids : list[int], texts : list[str], positions : bool = False) -> IndexShard:
+    postings = {}
+    term_frequencies = []
+    doc_lengths = []
+    doc_positions = [] if positions else None
+
+    for doc_id, tokens in zip(doc_ids, analyzer.analyze_many(texts)):
+        counts = Counter(tokens)
+        for token in counts:
+            try:
+                postings[token].append(doc_id)
+            except KeyError:
+                postings[token] = [doc_id]
+        term_frequencies.append(counts)
+        doc_lengths.append(len(tokens))
+        if positions:
+            doc_positions.append(token_positions(tokens))
+
+    return IndexShard(postings, term_frequencies, doc_lengths, doc_positions)
+
+
+_shard_analyzer = None # Analyzer of a build worker process
+
 
-    def __tokenize(self, dirty_str : str, stop_words : list[str]) -> list[str]:
+def _init_shard_worker(stopwords_path : str) -> None:
+    global _shard_analyzer
+    _shard_analyzer = Analyzer.from_stopwords_file(stopwords_path)
 
-        cleaned_str = dirty_str.lower() # Case senesetive
-        cleaned_str = cleaned_str.translate(str.maketrans('', '', string.punctuation)) # Remove punctuations
-        cleaned_str = cleaned_str.split(" ") # Tokenization
 
-        cleaned_str = [word for word in cleaned_str if word not in stop_words] # Remove stop words
+def _index_shard_worker(shard : tuple[list[int], list[str]], positions : bool = False) -> IndexShard:
+    doc_ids, texts = shard
+    return index_shard(_shard_analyzer, doc_ids, texts, positions)
 
-        stemmer = PorterStemmer()
-        cleaned_str = [stemmer.stem(token) for token in cleaned_str] # Stem words
 
-        return cleaned_str
+def convert_pickles_to_columnar() -> None:
+    inverted_index = InvertedIndex()
+    inverted_index.load_pickles()
+    inverted_index.save()
@@ -0,0 +1,315 @@
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+import numpy as np
+
+from constants import *
+
+
+class DeltaSegment:
+    """In-memory segment for documents added or updated since the main segment was built.
+
+    Documents are only ever appended, so every posting list stays sorted
+    by local ordinal; deletions are tombstones kept by LiveSegments.
+    """
+
+    def __init__(self) -> None:
+        self.doc_ids = []  # local ordinal : doc_id
+        self.doc_lengths = []  # local ordinal : number of tokens
+        self._index = {}  # term : (local ordinals, tfs)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def add(self, doc_id: int, term_frequencies: Counter, doc_length: int) -> int:
+        ordinal = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(doc_length)
+        for term, tf in term_frequencies.items():
+            ordinals, tfs = self._index.setdefault(term, ([], []))
+            ordinals.append(ordinal)
+            tfs.append(tf)
+        return ordinal
+
+    def terms(self) -> list[str]:
+        return list(self._index)
+
+    def doc_freq(self, term: str) -> int:
+        return len(self._index.get(term, ((), ()))[0])
+
+    def postings(self, term: str) -> tuple[list[int], list[int]]:
+        return self._index.get(term, ([], []))
+
+
+class MemoryPostings:
+    """Posting arrays produced by merging segments; same interface as DictPostings."""
+
+    deleted = frozenset()
+
+    def __init__(self, doc_ids: np.ndarray, doc_lengths: np.ndarray, postings: dict[str, tuple[np.ndarray, np.ndarray]]) -> None:
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self._ordinals = {int(doc_id): i for i, doc_id in enumerate(doc_ids.tolist())}
+        self._postings = postings
+
+    def __contains__(self, doc_id: int) -> bool:
+        return doc_id in self._ordinals
+
+    def ordinal(self, doc_id: int) -> int:
+        return self._ordinals[doc_id]
+
+    def terms(self) -> list[str]:
+        return list(self._postings)
+
+    def doc_freq(self, term: str) -> int:
+        return len(self._postings.get(term, ((), ()))[0])
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        try:
+            return self._postings[term]
+        except KeyError:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+
+class SegmentedPostings:
+    """Read-only view over several segments, with ordinals numbered across them in order.
+
+    Tombstoned documents keep their ordinal but are left out of every
+    posting list and listed in `deleted`, so BM25Scorer can exclude them
+    from N and avgdl. The newest delta segment keeps taking documents
+    after the view is made, so each segment is cut to the size it had
+    then; `locate` must answer for that moment too.
+    """
+
+    def __init__(self, segments: list, tombstones: list[set[int]], locate) -> None:
+        self._segments = segments
+        self._locate = locate  # doc_id : (segment, local ordinal), KeyError if absent
+        sizes = [len(segment.doc_ids) for segment in segments]
+        self._sizes = sizes
+        self._offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self._offsets[1:])
+
+        self.doc_ids = np.concatenate([np.asarray(s.doc_ids[:n], dtype=np.int64) for s, n in zip(segments, sizes)])
+        self.doc_lengths = np.concatenate([np.asarray(s.doc_lengths[:n], dtype=np.int64) for s, n in zip(segments, sizes)])
+        self.deleted = frozenset(
+            int(self._offsets[i]) + local for i, deleted in enumerate(tombstones) for local in deleted
+        )
+        self._live = np.ones(len(self.doc_ids), dtype=bool)
+        self._live[list(self.deleted)] = False
+        self._postings = {}  # term : (ordinals, tfs), filled on first use
+
+    def ordinal(self, doc_id: int) -> int:
+        segment, local = self._locate(doc_id)
+        for i, s in enumerate(self._segments):
+            if s is segment and local < self._sizes[i]:
+                return int(self._offsets[i]) + local
+        raise KeyError(doc_id)
+
+    def terms(self) -> list[str]:
+        terms = set()
+        for segment in self._segments:
+            terms.update(segment.terms())
+        return list(terms)
+
+    def doc_freq(self, term: str) -> int:
+        return len(self.postings(term)[0])
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        try:
+            return self._postings[term]
+        except KeyError:
+            pass
+
+        ordinals, tfs = [], []
+        for segment, size, offset in zip(self._segments, self._sizes, self._offsets.tolist()):
+            segment_ordinals, segment_tfs = segment.postings(term)
+            # Postings are appended in ordinal order, so the ones added since the view come last
+            n = bisect_left(segment_ordinals, size)
+            ordinals.append(np.asarray(segment_ordinals[:n], dtype=np.int64) + offset)
+            tfs.append(np.asarray(segment_tfs[:n], dtype=np.int64))
+        ordinals, tfs = np.concatenate(ordinals), np.concatenate(tfs)
+
+        live = self._live[ordinals]
+        self._postings[term] = (ordinals[live], tfs[live])
+
+        return self._postings[term]
+
+
+class LiveSegments:
+    """Main segment plus delta segments, tombstones and a merge that folds them together.
+
+    Writers add whole documents to the newest delta segment and tombstone
+    the copy they replace. Readers take `view()`, an immutable snapshot, so
+    a merge running in a background thread never changes a search under
+    way. Documents that were not touched since the main segment was built
+    are found through the main segment itself, so nothing is copied on load.
+    """
+
+    def __init__(self, main) -> None:
+        self.segments = [main]
+        self.tombstones = [set()]  # per segment, local ordinals
+        self._moved = {}  # doc_id : (segment, local ordinal), or None once deleted
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._merge_thread = None
+        self._view = main
+
+    @property
+    def main(self):
+        return self.segments[0]
+
+    def delta_size(self) -> int:
+        return sum(len(segment.doc_ids) for segment in self.segments[1:])
+
+    def locate(self, doc_id: int) -> tuple[object, int]:
+        """(segment, local ordinal) of the live copy of `doc_id`; KeyError if there is none."""
+        return _locate(self._moved, self.main, doc_id)
+
+    def add(self, doc_id: int, term_frequencies: Counter, doc_length: int) -> None:
+        """Add a document, replacing any live copy with the same id."""
+        with self._lock:
+            self.__tombstone(doc_id)
+            if not self.segments[1:]:
+                self.segments.append(DeltaSegment())
+                self.tombstones.append(set())
+            delta = self.segments[-1]
+            self._moved[doc_id] = (delta, delta.add(doc_id, term_frequencies, doc_length))
+            self._view = None
+
+    def delete(self, doc_id: int) -> bool:
+        with self._lock:
+            deleted = self.__tombstone(doc_id)
+            self._moved[doc_id] = None
+            self._view = None
+        return deleted
+
+    def __tombstone(self, doc_id: int) -> bool:
+        try:
+            segment, local = self.locate(doc_id)
+        except KeyError:
+            return False
+        self.tombstones[self.segments.index(segment)].add(local)
+        return True
+
+    def view(self):
+        """Postings source for the current state: the main segment itself when there is nothing to overlay."""
+        view = self._view
+        if view is not None:
+            return view
+
+        with self._lock:
+            if self._view is None:
+                if len(self.segments) == 1 and not self.tombstones[0]:
+                    self._view = self.main
+                else:
+                    segments = list(self.segments)
+                    tombstones = [set(t) for t in self.tombstones]
+                    moved, main = dict(self._moved), self.main
+                    self._view = SegmentedPostings(segments, tombstones, lambda doc_id: _locate(moved, main, doc_id))
+            return self._view
+
+    def needs_merge(self) -> bool:
+        return self.delta_size() >= LIVE_INDEX_MERGE_MIN_DOCS or len(self.tombstones[0]) > LIVE_INDEX_MERGE_DELETED_RATIO * max(len(self.main.doc_ids), 1)
+
+    def merge_in_background(self) -> threading.Thread:
+        """Start a merge unless one is already running; returns its thread."""
+        with self._lock:
+            if self._merge_thread is None or not self._merge_thread.is_alive():
+                self._merge_thread = threading.Thread(target=self.merge, daemon=True)
+                self._merge_thread.start()
+            return self._merge_thread
+
+    def wait(self) -> None:
+        thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+
+    def merge(self) -> None:
+        """Fold every segment into a new main segment, keeping writes made while merging."""
+        with self._merge_lock:
+            with self._lock:
+                if len(self.segments) == 1 and not self.tombstones[0]:
+                    return
+                segments = list(self.segments)
+                tombstones = [set(t) for t in self.tombstones]
+                # New writes go to a fresh delta while the snapshot is merged
+                self.segments.append(DeltaSegment())
+                self.tombstones.append(set())
+
+            merged, remaps = merge_segments(segments, tombstones)
+
+            with self._lock:
+                n_merged = len(segments)
+                deleted = set()
+                for i, before in enumerate(tombstones):
+                    for local in self.tombstones[i] - before:
+                        deleted.add(int(remaps[i][local]))
+                deleted.discard(-1)
+
+                snapshot = {id(segment) for segment in segments}
+                moved = {}
+                for doc_id, location in self._moved.items():
+                    if location is None:
+                        if doc_id in merged:
+                            moved[doc_id] = None
+                    elif id(location[0]) not in snapshot:
+                        moved[doc_id] = location
+
+                self.segments = [merged] + self.segments[n_merged:]
+                self.tombstones = [deleted] + self.tombstones[n_merged:]
+                if len(self.segments) > 1 and not self.segments[-1].doc_ids and not self.tombstones[-1]:
+                    self.segments.pop()
+                    self.tombstones.pop()
+                self._moved = moved
+                self._view = None
+
+
+def _locate(moved: dict, main, doc_id: int) -> tuple[object, int]:
+    location = moved.get(doc_id, False)
+    if location is None:
+        raise KeyError(doc_id)
+    if location is False:
+        location = (main, main.ordinal(doc_id))
+    return location
+
+
+def merge_segments(segments: list, tombstones: list[set[int]]) -> tuple[MemoryPostings, list[np.ndarray]]:
+    """Merge segments into one, dropping tombstoned documents.
+
+    Live documents keep their relative order. Also returns, per segment,
+    the new ordinal of every local ordinal (-1 for dropped documents).
+    """
+    remaps = []
+    doc_ids = []
+    doc_lengths = []
+    next_ordinal = 0
+    for segment, deleted in zip(segments, tombstones):
+        live = np.ones(len(segment.doc_ids), dtype=bool)
+        live[list(deleted)] = False
+        remap = np.full(len(live), -1, dtype=np.int64)
+        remap[live] = np.arange(next_ordinal, next_ordinal + int(live.sum()))
+        next_ordinal += int(live.sum())
+        remaps.append(remap)
+        doc_ids.append(np.asarray(segment.doc_ids, dtype=np.int64)[live])
+        doc_lengths.append(np.asarray(segment.doc_lengths, dtype=np.int64)[live])
+
+    terms = set()
+    for segment in segments:
+        terms.update(segment.terms())
+
+    postings = {}
+    for term in terms:
+        ordinals, tfs = [], []
+        for segment, remap in zip(segments, remaps):
+            segment_ordinals, segment_tfs = segment.postings(term)
+            new_ordinals = remap[np.asarray(segment_ordinals, dtype=np.int64)]
+            live = new_ordinals >= 0
+            ordinals.append(new_ordinals[live])
+            tfs.append(np.asarray(segment_tfs, dtype=np.int64)[live])
+        ordinals = np.concatenate(ordinals)
+        if len(ordinals):
+            postings[term] = (ordinals, np.concatenate(tfs))
+
+    merged = MemoryPostings(np.concatenate(doc_ids), np.concatenate(doc_lengths), postings)
+    return merged, remaps
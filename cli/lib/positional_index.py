@@ -0,0 +1,114 @@
+import math
+from bisect import bisect_right
+from collections.abc import Sequence
+
+import numpy as np
+
+from constants import *
+
+from .columnar_index import ColumnarIndex
+
+
+class DocumentPositions:
+    """Token positions of every indexed document, looked up by doc_id.
+
+    Documents indexed in this process (by a build, or added and updated
+    since load) keep theirs in memory; all others are read from the
+    positions of the saved columnar index `saved`. Positions count
+    analyzed tokens, so a dropped stopword does not open a gap.
+    """
+
+    def __init__(self, saved : ColumnarIndex | None = None) -> None:
+        self.saved = saved
+        self._documents = {} # doc_id : {term : positions}, indexed since load
+
+    def add(self, doc_id : int, positions : dict[str, list[int]]) -> None:
+        self._documents[doc_id] = positions
+
+    def discard(self, doc_id : int) -> None:
+        self._documents.pop(doc_id, None)
+
+    def term_positions(self, term : str, doc_ids : Sequence[int]) -> list[list[int]]:
+        """Positions of `term` in each of the given documents, in order; empty where it does not occur."""
+        result = []
+        saved = [] # indices in doc_ids of documents read from the saved index
+        for i, doc_id in enumerate(doc_ids):
+            document = self._documents.get(doc_id)
+            if document is None:
+                saved.append(i)
+                result.append([])
+            else:
+                result.append(document.get(term, []))
+
+        if saved:
+            ordinals = [self.saved.ordinal(doc_ids[i]) for i in saved]
+            for i, positions in zip(saved, self.saved.term_positions(term, ordinals)):
+                result[i] = positions.tolist()
+
+        return result
+
+
+def token_positions(tokens : list[str]) -> dict[str, list[int]]:
+    """term : positions of the term in `tokens`, ascending."""
+    positions = {}
+    for position, token in enumerate(tokens):
+        try:
+            positions[token].append(position)
+        except KeyError:
+            positions[token] = [position]
+    return positions
+
+
+def intersect_postings(postings, terms : Sequence[str]) -> np.ndarray:
+    """Ordinals of the documents whose posting lists contain every term, ascending."""
+    lists = sorted((np.asarray(postings.postings(term)[0], dtype=np.int64) for term in terms), key=len)
+    if not lists:
+        return np.empty(0, dtype=np.int64)
+
+    # Shortest list first, so every step keeps at most as many ordinals as it
+    ordinals = lists[0]
+    for other in lists[1:]:
+        if len(ordinals) == 0:
+            break
+        ordinals = np.intersect1d(ordinals, other, assume_unique=True)
+    return ordinals
+
+
+def phrase_match(term_positions : Sequence[Sequence[int]], slop : int = 0) -> bool:
+    """Whether the terms occur in order with at most `slop` other tokens between the first and the last.
+
+    With a slop of 0 the terms must be adjacent: an exact phrase.
+    """
+    first, later = term_positions[0], term_positions[1:]
+    for start in first:
+        end = start
+        for positions in later:
+            i = bisect_right(positions, end)
+            if i == len(positions):
+                return False # later starts only push every term further right
+            end = positions[i]
+        if end - start - len(later) <= slop:
+            return True
+    return False
+
+
+def min_distance(term_positions : Sequence[Sequence[int]]) -> int | None:
+    """Smallest distance between occurrences of two different terms; None unless two of them occur."""
+    occurrences = sorted((position, term) for term, positions in enumerate(term_positions) for position in positions)
+
+    # The closest pair with different terms is always next to each other in position order
+    best = None
+    for (position, term), (next_position, next_term) in zip(occurrences, occurrences[1:]):
+        if term != next_term and (best is None or next_position - position < best):
+            best = next_position - position
+    return best
+
+
+def proximity_boost(distance : int, weight : float = PROXIMITY_BOOST_WEIGHT, alpha : float = PROXIMITY_BOOST_ALPHA) -> float:
+    """Score added for two query terms `distance` tokens apart, largest when adjacent.
+
+    log(alpha + exp(-gap)) from Tao & Zhai's MinDist proximity, less
+    log(alpha) so terms far apart add nothing, and scaled so adjacent
+    terms add exactly `weight`.
+    """
+    return weight * math.log1p(math.exp(-(distance - 1)) / alpha) / math.log1p(1 / alpha)
@@ -0,0 +1,155 @@
+import os
+
+import numpy as np
+
+from constants import *
+
+
+class QuantizedEmbeddings:
+    """Compressed copy of an embedding matrix for fast approximate cosine scoring.
+
+    Rows are scaled to unit length and then stored as one of:
+      float16 - half precision, 2 bytes per dimension
+      int8    - one byte per dimension with a per-dimension scale
+      pq      - product quantization, one byte per subspace
+
+    The original row norms are kept so `rescore` can compute exact cosine
+    scores from the full-precision matrix for a handful of candidate rows.
+    """
+
+    def __init__(self, mode: str, arrays: dict[str, np.ndarray]) -> None:
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode: {mode}, expected one of {QUANTIZATION_MODES}")
+        self.mode = mode
+        self.arrays = arrays
+        self.codes = arrays["codes"]
+        self.norms = arrays["norms"]
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, mode: str, seed: int = 0) -> "QuantizedEmbeddings":
+        norms = np.linalg.norm(vectors, axis=1).astype(np.float32)
+        safe_norms = np.where(norms == 0, 1, norms)[:, None]
+        unit = (vectors / safe_norms).astype(np.float32)
+
+        match mode:
+            case "float16":
+                arrays = {"codes": unit.astype(np.float16)}
+            case "int8":
+                scale = np.abs(unit).max(axis=0) / 127
+                scale[scale == 0] = 1
+                codes = np.clip(np.rint(unit / scale), -127, 127).astype(np.int8)
+                arrays = {"codes": codes, "scale": scale.astype(np.float32)}
+            case "pq":
+                arrays = _train_product_quantizer(unit, seed)
+            case _:
+                raise ValueError(f"Unknown quantization mode: {mode}, expected one of {QUANTIZATION_MODES}")
+
+        arrays["norms"] = norms
+        return cls(mode, arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "QuantizedEmbeddings":
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files if name != "mode"}
+            mode = str(data["mode"])
+        return cls(mode, arrays)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as quantized_file:
+            np.savez(quantized_file, mode=np.array(self.mode), **self.arrays)
+
+    def score(self, query: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """Approximate cosine scores of a unit-length query against all rows (or `rows`)."""
+        codes = self.codes if rows is None else self.codes[rows]
+        query = query.astype(np.float32)
+
+        if self.mode == "pq":
+            centroids = self.arrays["centroids"] # (subspaces, centroids, sub_dim)
+            subspaces, _, sub_dim = centroids.shape
+            sub_queries = _pad(query[None, :], subspaces * sub_dim).reshape(subspaces, sub_dim)
+            # lookup[m, c] = dot product of query subspace m with centroid c
+            lookup = np.einsum("mcd,md->mc", centroids, sub_queries)
+            return lookup[np.arange(subspaces), codes].sum(axis=1)
+
+        if self.mode == "int8":
+            query = query * self.arrays["scale"]
+
+        # Decode in batches so only a slice of the matrix is ever held as float32.
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), QUANTIZATION_SCORE_BATCH_SIZE):
+            batch = codes[start : start + QUANTIZATION_SCORE_BATCH_SIZE]
+            scores[start : start + len(batch)] = batch.astype(np.float32) @ query
+        return scores
+
+    def rescore(self, vectors: np.ndarray, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Exact cosine scores for `rows`, read from the full-precision `vectors`."""
+        norms = self.norms[rows]
+        norms = np.where(norms == 0, 1, norms)
+        return (np.asarray(vectors[rows], dtype=np.float32) @ query.astype(np.float32)) / norms
+
+
+def quantized_path(embeddings_path: str, mode: str) -> str:
+    root, _ = os.path.splitext(embeddings_path)
+    return f"{root}.{mode}.npz"
+
+
+def rerank_candidates(limit: int) -> int:
+    return max(QUANTIZATION_RERANK_MIN, limit * QUANTIZATION_RERANK_FACTOR)
+
+
+def _pad(vectors: np.ndarray, width: int) -> np.ndarray:
+    if vectors.shape[1] == width:
+        return vectors
+    return np.pad(vectors, ((0, 0), (0, width - vectors.shape[1])))
+
+
+def _train_product_quantizer(unit: np.ndarray, seed: int) -> dict[str, np.ndarray]:
+    n_rows, dim = unit.shape
+    subspaces = min(PQ_SUBSPACES, dim)
+    sub_dim = -(-dim // subspaces)
+    n_centroids = max(1, min(PQ_CENTROIDS, n_rows))
+    rng = np.random.default_rng(seed)
+
+    padded = _pad(unit, subspaces * sub_dim).reshape(n_rows, subspaces, sub_dim)
+    train = padded[rng.choice(n_rows, min(n_rows, PQ_TRAIN_POINTS), replace=False)]
+
+    centroids = np.empty((subspaces, n_centroids, sub_dim), dtype=np.float32)
+    codes = np.empty((n_rows, subspaces), dtype=np.uint8)
+    for m in range(subspaces):
+        centroids[m] = _kmeans(train[:, m, :], n_centroids, rng)
+        codes[:, m] = _nearest(padded[:, m, :], centroids[m])
+
+    return {"codes": codes, "centroids": centroids}
+
+
+def _kmeans(points: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = points[rng.choice(len(points), k, replace=False)].copy()
+    for _ in range(PQ_KMEANS_ITERATIONS):
+        assignment = _nearest(points, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        counts = np.bincount(assignment, minlength=k)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = points[rng.choice(len(points), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def _nearest(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    nearest = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), QUANTIZATION_SCORE_BATCH_SIZE):
+        batch = points[start : start + QUANTIZATION_SCORE_BATCH_SIZE]
+        # ||x - c||^2 without the ||x||^2 term, which is the same for every c
+        nearest[start : start + len(batch)] = np.argmin(centroid_norms - 2 * batch @ centroids.T, axis=1)
+    return nearest
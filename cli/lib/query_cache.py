@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from constants import *
+
+
+def normalize_query(text: str, lowercase: bool = False) -> str:
+    """Cache key text: trimmed, single-spaced and, for uncased models, lowercased."""
+    text = " ".join(text.split())
+    return text.lower() if lowercase else text
+
+
+def query_key(model_name: str, query: str) -> tuple[str, str]:
+    """Cache key of a query; case only folds for models in QUERY_CACHE_UNCASED_MODELS."""
+    return model_name, normalize_query(query, model_name in QUERY_CACHE_UNCASED_MODELS)
+
+
+class QueryEmbeddingCache:
+    """Query embeddings keyed by (model name, normalized query text).
+
+    A bounded in-memory LRU sits in front of an optional SQLite file, so
+    repeated queries skip the transformer forward pass both within a
+    process and across restarts. Safe to share between threads.
+    """
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, path: str | None = None) -> None:
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0 # served from memory
+        self.disk_hits = 0 # served from the persistent tier
+        self.misses = 0 # had to be encoded
+        self._entries = OrderedDict() # (model_name, text) : read-only float32 vector
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model_name TEXT, query TEXT, embedding BLOB, PRIMARY KEY (model_name, query))"
+            )
+            self._db.commit()
+
+    def get(self, model_name: str, query: str) -> np.ndarray | None:
+        key = query_key(model_name, query)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model_name = ? AND query = ?", key
+                ).fetchone()
+                if row is not None:
+                    embedding = self._remember(key, np.frombuffer(row[0], dtype=np.float32))
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, model_name: str, query: str, embedding: np.ndarray) -> np.ndarray:
+        key = query_key(model_name, query)
+        embedding = np.array(embedding, dtype=np.float32)
+        with self._lock:
+            embedding = self._remember(key, embedding)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)", (*key, embedding.tobytes())
+                )
+                self._db.commit()
+        return embedding
+
+    def get_or_encode(self, model_name: str, queries: list[str], encode) -> list[np.ndarray]:
+        """Embedding of every query, calling `encode` once with all the distinct misses."""
+        embeddings = [self.get(model_name, query) for query in queries]
+
+        missing = {}  # cache key : query to encode
+        for query, embedding in zip(queries, embeddings):
+            if embedding is None:
+                missing.setdefault(query_key(model_name, query), query)
+
+        if not missing:
+            return embeddings
+
+        encoded = {}
+        for (key, query), embedding in zip(missing.items(), encode(list(missing.values()))):
+            encoded[key] = self.put(model_name, query, embedding)
+
+        return [
+            encoded[query_key(model_name, query)] if embedding is None else embedding
+            for query, embedding in zip(queries, embeddings)
+        ]
+
+    def _remember(self, key: tuple[str, str], embedding: np.ndarray) -> np.ndarray:
+        embedding.flags.writeable = False # handed out to every caller, so keep it immutable
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return embedding
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "persistent": self._db is not None,
+            }
+
+    def clear(self) -> None:
+        """Forget every cached embedding, on disk too, and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM query_embeddings")
+                self._db.commit()
+
+
+_shared_cache = None
+_shared_persistent = QUERY_CACHE_PERSISTENT # whether the shared cache, once made, gets the SQLite file
+_shared_lock = threading.Lock()
+SHARED_QUERY_CACHE_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "cache", QUERY_CACHE_FILE)
+
+
+def shared_query_cache() -> QueryEmbeddingCache:
+    """The process-wide cache used by every semantic and hybrid search."""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            path = SHARED_QUERY_CACHE_PATH if _shared_persistent else None
+            _shared_cache = QueryEmbeddingCache(QUERY_CACHE_SIZE, path)
+        return _shared_cache
+
+
+def enable_persistent_query_cache() -> None:
+    """Give the shared cache its SQLite file (--persist-query-cache); call before the first search."""
+    global _shared_persistent
+    with _shared_lock:
+        _shared_persistent = True
@@ -0,0 +1,183 @@
+from collections.abc import Callable
+
+import numpy as np
+
+from constants import *
+
+
+class RankedStream:
+    """Doc ids of one retriever, best first, fetched in pages that double in size.
+
+    `fetch(n)` returns the best n doc ids (fewer once the retriever runs
+    out), so a stream only ranks as deep as the fusion actually reads.
+    `rank(doc_ids)`, when given, returns the exact rank of each id in the
+    full ranking (None where it is not ranked) without fetching it all.
+    """
+
+    def __init__(self, fetch: Callable[[int], list[int]], page_size: int = RRF_PAGE_SIZE, rank: Callable[[list[int]], list[int | None]] | None = None) -> None:
+        self._fetch = fetch
+        self._rank = rank
+        self._page_size = page_size
+        self.depth = 0 # ids handed out so far
+        self.exhausted = False
+
+    def pull(self) -> list[int]:
+        """The next page of ids, continuing from the last one pulled."""
+        if self.exhausted:
+            return []
+
+        wanted = self.depth + self._page_size
+        ids = list(self._fetch(wanted))
+        self.exhausted = len(ids) < wanted
+        page = ids[self.depth:]
+        self.depth = len(ids)
+        self._page_size *= 2
+
+        return page
+
+    def pull_all(self) -> list[int]:
+        """Every remaining id, with one fetch."""
+        if self.exhausted:
+            return []
+
+        ids = list(self._fetch(RRF_FETCH_ALL))
+        self.exhausted = True
+        page = ids[self.depth:]
+        self.depth = len(ids)
+
+        return page
+
+    def ranks(self, doc_ids: list[int]) -> list[int | None]:
+        """Exact 1-based rank of each id in the full ranking, None where it is not ranked."""
+        if self._rank is not None:
+            return self._rank(doc_ids)
+
+        ranking = {}
+        for rank, doc_id in enumerate(self._fetch(RRF_FETCH_ALL), start=1):
+            ranking.setdefault(doc_id, rank)
+        return [ranking.get(doc_id) for doc_id in doc_ids]
+
+
+def rrf_fuse(rankings: dict[str, list[int]], k: int = RRF_K, limit: int = LIMIT) -> dict[int, dict[str, float]]:
+    """Reciprocal Rank Fusion of complete rankings, with NumPy rank arrays.
+
+    Returns the best `limit` doc ids, as doc_id : {"rrf_score", "<name>_rank"
+    for every ranking (None where the doc is missing)}; ties go to the lower id.
+    """
+    names = list(rankings)
+    ids = [np.asarray(rankings[name], dtype=np.int64) for name in names]
+    if not any(len(ranked) for ranked in ids):
+        return {}
+
+    all_ids = np.concatenate(ids)
+    contributions = np.concatenate([1.0 / (k + np.arange(1, len(ranked) + 1)) for ranked in ids])
+    doc_ids, inverse = np.unique(all_ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=contributions, minlength=len(doc_ids))
+
+    order = np.lexsort((doc_ids, -scores))[:limit]
+    best = doc_ids[order]
+    ranks = {}
+    for name, ranked in zip(names, ids):
+        found = np.flatnonzero(np.isin(ranked, best))
+        ranks[name] = dict(zip(ranked[found].tolist(), (found + 1).tolist()))
+
+    return {
+        doc_id: {"rrf_score": float(score), **{f"{name}_rank": ranks[name].get(doc_id) for name in names}}
+        for doc_id, score in zip(best.tolist(), scores[order].tolist())
+    }
+
+
+def streaming_rrf(streams: dict[str, RankedStream], k: int = RRF_K, limit: int = LIMIT) -> dict[int, dict[str, float]]:
+    """Reciprocal Rank Fusion that stops pulling once the top-k cannot change.
+
+    After every round of pages, a document's score is known to lie
+    between what it has collected and that plus 1 / (k + depth + 1) for
+    every stream it has not appeared in yet; a document no stream has
+    returned can score at most the sum of those. Pulling stops when the
+    current top `limit` beat every other document's upper bound and are
+    already in their final order, so the ids and their order equal those of
+    `rrf_fuse` over the full rankings, including tie-breaking by lower doc id.
+
+    The returned scores and ranks are exact too: where a stream had not
+    reached a returned document yet, its rank is looked up with
+    `RankedStream.ranks`, so they equal those of `rrf_fuse`.
+    """
+    if limit <= 0:
+        return {}
+
+    names = list(streams)
+    slots = {} # doc_id : row in the arrays below
+    doc_ids = np.empty(0, dtype=np.int64)
+    ranks = np.empty((0, len(names)), dtype=np.int64) # 0 where a stream has not returned the doc
+
+    while True:
+        for column, name in enumerate(names):
+            start = streams[name].depth
+            page = streams[name].pull()
+            if not page:
+                continue
+
+            new = [doc_id for doc_id in dict.fromkeys(page) if doc_id not in slots]
+            if new:
+                slots.update(zip(new, range(len(doc_ids), len(doc_ids) + len(new))))
+                doc_ids = np.append(doc_ids, new)
+                ranks = np.vstack([ranks, np.zeros((len(new), len(names)), dtype=np.int64)])
+
+            rows = np.array([slots[doc_id] for doc_id in page])
+            ranks[rows, column] = np.arange(start + 1, start + len(page) + 1)
+
+        # Summed from the ranks in stream order, like rrf_fuse, so equal scores are bit-equal
+        scores = rrf_scores(ranks, k)
+
+        remaining = np.array([0.0 if streams[name].exhausted else 1.0 / (k + streams[name].depth + 1) for name in names])
+        if not remaining.any():
+            break
+        if len(doc_ids) < limit:
+            continue
+
+        upper = scores + (ranks == 0) @ remaining
+        order = np.lexsort((doc_ids, -scores))
+        top, rest = order[:limit], order[limit:]
+
+        # Sort keys are (score, -doc_id); any unseen doc id is >= 0, so
+        # (sum(remaining), 0) is at least the key of a document not seen yet.
+        if not key_greater(scores[top[-1]], doc_ids[top[-1]], remaining.sum(), 0):
+            continue
+        if len(rest) and not key_greater(scores[top[-1]], doc_ids[top[-1]], upper[rest], doc_ids[rest]).all():
+            continue
+        if key_greater(scores[top[:-1]], doc_ids[top[:-1]], upper[top[1:]], doc_ids[top[1:]]).all():
+            break
+
+    top = np.lexsort((doc_ids, -scores))[:limit]
+    for column, name in enumerate(names):
+        missing = top[ranks[top, column] == 0]
+        if len(missing) and not streams[name].exhausted:
+            ranks[missing, column] = [rank or 0 for rank in streams[name].ranks(doc_ids[missing].tolist())]
+
+    # Exact scores stay within the bounds the loop settled the order with
+    scores = rrf_scores(ranks, k)
+    top = top[np.lexsort((doc_ids[top], -scores[top]))]
+    return {
+        int(doc_ids[row]): {
+            "rrf_score": float(scores[row]),
+            **{f"{name}_rank": int(ranks[row, column]) or None for column, name in enumerate(names)},
+        }
+        for row in top
+    }
+
+
+def rrf_scores(ranks: np.ndarray, k: int = RRF_K) -> np.ndarray:
+    """RRF score of every row of a (docs, streams) rank matrix, 0 meaning not ranked.
+
+    Contributions are added one stream at a time, in column order, which
+    is the order rrf_fuse's bincount adds them in.
+    """
+    scores = np.zeros(len(ranks))
+    for column in ranks.T:
+        scores += np.where(column > 0, 1.0 / (k + np.maximum(column, 1)), 0.0)
+    return scores
+
+
+def key_greater(score, doc_id, other_score, other_doc_id):
+    """(score, -doc_id) > (other_score, -other_doc_id), elementwise."""
+    return (score > other_score) | ((score == other_score) & (doc_id < other_doc_id))
@@ -0,0 +1,21 @@
+def normalize(score_list : list[float]) -> list[float]:
+    if not score_list:
+        return []
+
+    max_score = max(score_list)
+    min_score = min(score_list)
+
+    if min_score == max_score:
+        return [1.0] * len(score_list)
+
+    norm_list = [(score - min_score) / (max_score - min_score) for score in score_list]
+
+    return norm_list
+
+def normalize_dict(score_dict: dict[int, float]) -> dict[int, float]:
+    scores = list(score_dict.values())
+    normed = normalize(scores)
+    return dict(zip(score_dict.keys(), normed))
+
+def hybrid_score(bm25_score, semantic_score, alpha=0.5):
+    return alpha * bm25_score + (1 - alpha) * semantic_score
@@ -0,0 +1,54 @@
+import http.client
+import json
+import socket
+
+from constants import *
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path : str, timeout : float) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class SearchClient:
+    """Sends searches to a running search server instead of loading anything locally.
+
+    `address` is "unix:/path/to/socket", "http://host:port" or "host:port".
+    """
+
+    def __init__(self, address : str, timeout : float = SEARCH_CLIENT_TIMEOUT) -> None:
+        self.address = address
+        self.timeout = timeout
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self.address.startswith("unix:"):
+            return _UnixHTTPConnection(self.address.removeprefix("unix:"), self.timeout)
+
+        host, _, port = self.address.removeprefix("http://").rstrip("/").partition(":")
+        return http.client.HTTPConnection(host, int(port or SEARCH_SERVER_PORT), timeout=self.timeout)
+
+    def _request(self, method : str, path : str, body : dict | None = None) -> dict:
+        connection = self._connection()
+        try:
+            payload = None if body is None else json.dumps(body)
+            connection.request(method, path, payload, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            reply = json.loads(response.read())
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise RuntimeError(f"Search server error ({response.status}): {reply.get("error")}")
+        return reply
+
+    def health(self) -> dict:
+        return self._request("GET", "/health")
+
+    def search(self, kind : str, query : str, limit : int = LIMIT, **options) -> list[dict]:
+        return self._request("POST", "/search", {"kind": kind, "query": query, "limit": limit, **options})["results"]
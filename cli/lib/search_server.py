@@ -0,0 +1,274 @@
+import json
+import os
+import socketserver
+import threading
+import traceback
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from constants import *
+
+SEARCH_KINDS = ("keyword", "semantic", "chunked", "hybrid")
+SEARCH_OPTIONS = ("limit", "alpha", "pool", "pool_from", "ann", "nprobe")
+
+
+class SearchService:
+    """Keeps the movies, indexes and model loaded and answers searches from many threads.
+
+    Each component is loaded on first use (or all at once by `preload`)
+    and then shared by every request; the hybrid search reuses the keyword
+    index and the chunked embeddings instead of loading its own copies,
+    and the movies stay on disk in a memory-mapped document store.
+    """
+
+    def __init__(self, movies_path : str, quantization : str | None = None, cache_path : str | None = None) -> None:
+        self.movies_path = movies_path
+        self.quantization = quantization
+        self.cache_path = cache_path or os.path.join(os.path.dirname(__file__), "..", "..", "cache")
+        self._components = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name : str, factory):
+        try:
+            return self._components[name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if name not in self._components:
+                self._components[name] = factory()
+            return self._components[name]
+
+    @property
+    def movies(self):
+        """DocumentStore mirroring the movie file, shared by the semantic searches; movies are read when shown."""
+        from .document_store import load_or_create_document_store
+        return self._get("movies", lambda: load_or_create_document_store(os.path.join(self.cache_path, "movies"), self.movies_path))
+
+    @property
+    def keyword(self):
+        from .keyword_search import load_or_build_index
+        return self._get("keyword", lambda: load_or_build_index(self.movies_path, self.cache_path))
+
+    @property
+    def semantic(self):
+        from .semantic_search import SemanticSearch
+        def load():
+            semantic_search = SemanticSearch(quantization=self.quantization, cache_path=self.cache_path)
+            semantic_search.load_or_create_embeddings(self.movies)
+            return semantic_search
+        return self._get("semantic", load)
+
+    @property
+    def chunked(self):
+        from .chunked_sematic_search import ChunkedSemanticSearch
+        def load():
+            chunked_semantic_search = ChunkedSemanticSearch(quantization=self.quantization, cache_path=self.cache_path)
+            chunked_semantic_search.load_or_create_chunk_embeddings(self.movies)
+            return chunked_semantic_search
+        return self._get("chunked", load)
+
+    @property
+    def hybrid(self):
+        from .hybrid_search import HybridSearch
+        return self._get("hybrid", lambda: HybridSearch(self.movies, self.chunked, self.keyword))
+
+    def loaded(self) -> list[str]:
+        return list(self._components)
+
+    def query_cache_stats(self) -> dict[str, int]:
+        from .query_cache import shared_query_cache
+        return shared_query_cache().stats()
+
+    def preload(self) -> None:
+        for name in SEARCH_KINDS:
+            getattr(self, name)
+        # The models are built on first encode, which would otherwise be the first query
+        self.semantic.model
+        self.chunked.model
+
+    def search(self, kind : str, query : str, limit : int = LIMIT, **options) -> list[dict]:
+        """Run one search; results are JSON-ready dicts, best first."""
+        match kind:
+            case "keyword":
+                return keyword_results(self.keyword, self.keyword.bm25_search(query, limit))
+            case "semantic":
+                return self.semantic.search(query, limit)
+            case "chunked":
+                return self.chunked.search_chunks(
+                    query, limit, options.get("ann", False), options.get("nprobe", IVF_DEFAULT_NPROBE)
+                )
+            case "hybrid":
+                hybrid = self.hybrid
+                if options.get("pool") is not None:
+                    sorted_scores = hybrid.pooled_search(
+                        query,
+                        options.get("alpha", DEFAULT_ALPHA),
+                        limit,
+                        options["pool"],
+                        options.get("pool_from", HYBRID_POOL_FROM),
+                        options.get("ann", False),
+                        options.get("nprobe", IVF_DEFAULT_NPROBE),
+                    )
+                else:
+                    sorted_scores = hybrid.weighted_search(
+                        query,
+                        options.get("alpha", DEFAULT_ALPHA),
+                        limit,
+                        options.get("ann", False),
+                        options.get("nprobe", IVF_DEFAULT_NPROBE),
+                    )
+                return hybrid_results(hybrid.semantic_search.document_map, sorted_scores)
+            case _:
+                raise ValueError(f"Unknown search kind: {kind}, expected one of {SEARCH_KINDS}")
+
+    def search_many(self, kind : str, queries : list[str], limit : int = LIMIT, **options) -> Iterator[list[dict]]:
+        """Like `search` for every query, in order; results are yielded as each batch finishes."""
+        match kind:
+            case "keyword":
+                idx = self.keyword
+                for scores in idx.bm25_search_many(queries, limit):
+                    yield keyword_results(idx, scores)
+            case "semantic":
+                yield from self.semantic.search_many(queries, limit)
+            case "chunked":
+                yield from self.chunked.search_chunks_many(
+                    queries, limit, options.get("ann", False), options.get("nprobe", IVF_DEFAULT_NPROBE)
+                )
+            case "hybrid":
+                hybrid = self.hybrid
+                document_map = hybrid.semantic_search.document_map
+                for sorted_scores in hybrid.weighted_search_many(
+                    queries,
+                    options.get("alpha", DEFAULT_ALPHA),
+                    limit,
+                    options.get("ann", False),
+                    options.get("nprobe", IVF_DEFAULT_NPROBE),
+                ):
+                    yield hybrid_results(document_map, sorted_scores)
+            case _:
+                raise ValueError(f"Unknown search kind: {kind}, expected one of {SEARCH_KINDS}")
+
+
+def keyword_results(idx, scores : dict[int, float]) -> list[dict]:
+    return [
+        {"id": doc_id, "title": idx.docmap[doc_id]["title"], "score": score}
+        for doc_id, score in scores.items()
+    ]
+
+
+def hybrid_results(document_map : dict[int, dict], sorted_scores : dict[int, dict[str, float]]) -> list[dict]:
+    return [
+        {
+            "id": movie_id,
+            "title": document_map[movie_id]["title"],
+            "description": document_map[movie_id]["description"],
+            **scores,
+        }
+        for movie_id, scores in sorted_scores.items()
+    ]
+
+
+def parse_search_request(request) -> tuple[str, str, dict]:
+    """(kind, query, options) of a /search body; ValueError or TypeError if it is malformed."""
+    if not isinstance(request, dict):
+        raise TypeError("The request must be a JSON object")
+    options = dict(request)
+    kind = options.pop("kind", None)
+    if kind not in SEARCH_KINDS:
+        raise ValueError(f"Unknown search kind: {kind}, expected one of {SEARCH_KINDS}")
+    query = options.pop("query", None)
+    if not isinstance(query, str):
+        raise TypeError(f"query must be a string, got {type(query).__name__}")
+    unknown = sorted(set(options) - set(SEARCH_OPTIONS))
+    if unknown:
+        raise ValueError(f"Unknown search options: {unknown}, expected some of {SEARCH_OPTIONS}")
+
+    for name in ("limit", "nprobe"):
+        if name in options and not _is_int(options[name]):
+            raise TypeError(f"{name} must be an integer, got {type(options[name]).__name__}")
+    if options.get("pool") is not None:
+        if not _is_int(options["pool"]):
+            raise TypeError(f"pool must be an integer or null, got {type(options["pool"]).__name__}")
+        if options["pool"] <= 0:
+            raise ValueError(f"pool must be positive, got {options["pool"]}")
+    if "nprobe" in options and options["nprobe"] <= 0:
+        raise ValueError(f"nprobe must be positive, got {options["nprobe"]}")
+    if "alpha" in options and (not isinstance(options["alpha"], (int, float)) or isinstance(options["alpha"], bool)):
+        raise TypeError(f"alpha must be a number, got {type(options["alpha"]).__name__}")
+    if "ann" in options and not isinstance(options["ann"], bool):
+        raise TypeError(f"ann must be a boolean, got {type(options["ann"]).__name__}")
+    if "pool_from" in options and options["pool_from"] not in HYBRID_POOL_SOURCES:
+        raise ValueError(f"Unknown pool source: {options["pool_from"]}, expected one of {HYBRID_POOL_SOURCES}")
+    return kind, query, options
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class _SearchRequestHandler(BaseHTTPRequestHandler):
+    """POST /search with {"kind", "query", "limit", ...options}; GET /health."""
+
+    service : SearchService = None # set on the per-server subclass
+
+    def do_GET(self) -> None:
+        if self.path != "/health":
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+            return
+        self._reply(200, {"status": "ok", "loaded": self.service.loaded(), "query_cache": self.service.query_cache_stats()})
+
+    def do_POST(self) -> None:
+        if self.path != "/search":
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            kind, query, options = parse_search_request(request)
+        except (KeyError, TypeError, ValueError) as e:
+            self._reply(400, {"error": f"{type(e).__name__}: {e}"})
+            return
+
+        try:
+            results = self.service.search(kind, query, **options)
+        except Exception as e:
+            # Anything failing past validation is the server's fault, and the client still gets a reply
+            self.log_error("Search failed: %s", traceback.format_exc())
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+
+        self._reply(200, {"results": results})
+
+    def _reply(self, status : int, body : dict) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self) -> str:
+        # Unix socket peers have no (host, port) address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service : SearchService, host : str = SEARCH_SERVER_HOST, port : int = SEARCH_SERVER_PORT, socket_path : str | None = None):
+    """HTTP server over localhost TCP, or over a Unix socket when `socket_path` is given."""
+    handler = type("SearchRequestHandler", (_SearchRequestHandler,), {"service": service})
+
+    if socket_path is None:
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        return server
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path) # left over from a server that did not shut down cleanly
+    return _ThreadingUnixHTTPServer(socket_path, handler)
@@ -2,28 +2,95 @@
 
 import os
 import re
+import threading
+from collections.abc import Iterator, Mapping, Sequence
+from itertools import batched
 
 import numpy as np
 from constants import *
-from sentence_transformers import SentenceTransformer
+
+from .embedding_cache import (
+    EmbeddingManifest,
+    PreviousEmbeddings,
+    content_hash,
+    corpus_hash,
+    invalidate_embeddings,
+    load_previous,
+    make_manifest,
+    open_embeddings,
+    save_embeddings,
+)
+from .encode_pipeline import EncodePipeline
+from .quantization import QuantizedEmbeddings, quantized_path, rerank_candidates
+from .query_cache import QueryEmbeddingCache, shared_query_cache
+from .tracing import span, traced
 
 
 class SemanticSearch:
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
-        # Load the model (downloads automatically the first time)
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name="all-MiniLM-L6-v2", quantization: str | None = None, rerank: bool = True, query_cache: QueryEmbeddingCache | None = None, model=None, cache_path: str | None = None):
+        self.model_name = model_name
+        self._model = model # SentenceTransformer, constructed on first use unless one is passed in
+        self._model_by_name = model is None # encode workers can load the model themselves instead of unpickling it
+        self._model_lock = threading.Lock()
         self.embeddings = None
-        self.documents = None
-        self.document_map = {}
+        self._inverse_norms = None # 1 / length of every row of self.embeddings, 0 for all-zero rows
+        self.quantization = quantization # None, or one of QUANTIZATION_MODES
+        self.rerank = rerank # re-score quantized candidates against full-precision rows
+        self.quantized_embeddings = None
+        self.query_cache = query_cache if query_cache is not None else shared_query_cache()
+        self.rebuild_stats = None # rows reused/encoded/dropped by the last build
+        self.encode_batch_size = ENCODE_BATCH_SIZE
+        self.encode_workers = ENCODE_WORKERS
+        self.encode_stats = None # texts, batches and chunks per second of the last build's encoding
+        self.documents = None # list of movies or DocumentStore, by movie_idx
+        self.doc_ids = None # movie_idx : movie id
+        self._document_map = None
 
         self._cur_path = os.path.dirname(__file__)
         self._top_path = os.path.join(self._cur_path, "..", "..")
-        self._cache_path = os.path.join(self._top_path, "cache")
+        self._cache_path = cache_path or os.path.join(self._top_path, "cache")
         self._embeddings_path = os.path.join(self._cache_path, "movie_embeddings.npy")
 
+    @property
+    def model(self):
+        """The SentenceTransformer, loaded (and downloaded the first time) on first use.
+
+        torch and sentence-transformers are only imported here, so commands
+        that never encode anything start without them.
+        """
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    with span("semantic.model_load"):
+                        from sentence_transformers import SentenceTransformer
+                        self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    @property
+    def document_map(self) -> Mapping[int, dict]:
+        """Documents by movie id; read from the store on access when `documents` is a DocumentStore."""
+        if self._document_map is None:
+            by_id = getattr(self.documents, "by_id", None)
+            self._document_map = by_id if by_id is not None else {doc["id"]: doc for doc in self.documents}
+        return self._document_map
+
+    def _set_documents(self, documents: Sequence[dict]) -> None:
+        self.documents = documents
+        self._document_map = None
+        ids = getattr(documents, "doc_ids", None)
+        self.doc_ids = np.asarray(ids if ids is not None else [doc["id"] for doc in documents], dtype=np.int64)
+
+    @property
+    def embedding_dimension(self) -> int:
+        try:
+            return MODEL_DIMENSIONS[self.model_name]
+        except KeyError:
+            return self.model.get_sentence_embedding_dimension()
+
+    @traced("semantic.search", query=True)
     def search(
         self, query: str, limit: int = LIMIT
-    ) -> list[tuple[float, dict[int, str, str]]]:
+    ) -> list[dict[str, float | str]]:
         if self.embeddings is None:
             raise ValueError(
                 "No embeddings loaded. Call `load_or_create_embeddings` first."
@@ -31,75 +98,258 @@ class SemanticSearch:
 
         embedded_query = self.generate_embedding(query)
 
-        simmilarity_list = []
-        for i, embedded_doc in enumerate(self.embeddings):
-            cos_sim = cosine_similarity(embedded_doc, embedded_query)
+        return self.search_by_vector(embedded_query, limit)
+
+    def search_by_vector(
+        self, query_embedding: np.ndarray, limit: int = LIMIT
+    ) -> list[dict[str, float | str]]:
+        rows, scores = self.score_documents_by_vector(query_embedding, rerank_candidates(limit))
+
+        return self._document_results(rows, scores, limit)
+
+    def score_documents_by_vector(
+        self, query_embedding: np.ndarray, candidates: int = QUANTIZATION_RERANK_MIN
+    ) -> tuple[np.ndarray | None, np.ndarray]:
+        """Cosine score of every document (or of the reranked candidates), as (rows or None, scores)."""
+        if self._inverse_norms is None and self.quantized_embeddings is None:
+            with span("semantic.normalize"):
+                self._inverse_norms = inverse_row_norms(self.embeddings)
+
+        return self._score_rows(
+            self.embeddings,
+            self._inverse_norms,
+            self.quantized_embeddings,
+            normalize_rows(query_embedding),
+            candidates,
+        )
+
+    def search_many(
+        self, queries: list[str], limit: int = LIMIT, batch_size: int = SEARCH_BATCH_SIZE
+    ) -> Iterator[list[dict[str, float | str]]]:
+        """Results of every query, in order, yielded as each batch of queries is scored.
+
+        Each batch is encoded with one model call and scored with one
+        matrix-matrix product.
+        """
+        if self.embeddings is None:
+            raise ValueError(
+                "No embeddings loaded. Call `load_or_create_embeddings` first."
+            )
 
-            simmilarity_list.append((cos_sim, self.documents[i]))
+        for batch in batched(queries, batch_size):
+            yield from self.search_many_by_vector(np.asarray(self.embed_queries(list(batch))), limit)
 
-        simmilarity_list.sort(key=lambda x: x[0], reverse=True)
+    def search_many_by_vector(
+        self, query_embeddings: np.ndarray, limit: int = LIMIT
+    ) -> list[list[dict[str, float | str]]]:
+        if self.quantized_embeddings is not None:
+            return [self.search_by_vector(query, limit) for query in query_embeddings]
 
+        if self._inverse_norms is None:
+            self._inverse_norms = inverse_row_norms(self.embeddings)
+
+        score_matrix = (normalize_rows(query_embeddings) @ self.embeddings.T) * self._inverse_norms
+        return [self._document_results(None, scores, limit) for scores in score_matrix]
+
+    @traced("semantic.results")
+    def _document_results(
+        self, rows: np.ndarray | None, scores: np.ndarray, limit: int
+    ) -> list[dict[str, float | str]]:
         result_dic = []
-        for i in range(limit):
+        for i in top_k_indices(scores, limit):
+            doc = self.documents[i if rows is None else rows[i]]
             result_dic.append(
                 {
-                    "score": simmilarity_list[i][0],
-                    "title": simmilarity_list[i][1]["title"],
-                    "description": simmilarity_list[i][1]["description"],
+                    "score": float(scores[i]),
+                    "title": doc["title"],
+                    "description": doc["description"],
                 }
             )
 
         return result_dic
 
+    @traced("vector.score")
+    def _score_rows(
+        self,
+        vectors: np.ndarray,
+        inverse_norms: np.ndarray | None,
+        quantized: QuantizedEmbeddings | None,
+        query: np.ndarray,
+        candidates: int,
+        rows: np.ndarray | None = None,
+    ) -> tuple[np.ndarray | None, np.ndarray]:
+        """Cosine scores for all rows (or `rows`), as (scored rows or None, scores).
+
+        With quantization the compressed codes are scored first; when
+        reranking, only the best `candidates` rows are kept and re-scored
+        against the full-precision vectors. Unquantized rows are scored
+        straight from `vectors`, which may be mapped, and divided by their
+        norms afterwards, so no normalized copy of the matrix is kept.
+        """
+        if quantized is None:
+            if rows is None:
+                return rows, (vectors @ query) * inverse_norms
+            return rows, (vectors[rows] @ query) * inverse_norms[rows]
+
+        scores = quantized.score(query, rows)
+        if not self.rerank:
+            return rows, scores
+
+        best = top_k_indices(scores, candidates)
+        best_rows = np.sort(best if rows is None else rows[best])
+        return best_rows, quantized.rescore(vectors, query, best_rows)
+
+    def _load_or_create_quantized(self, embeddings_path: str, vectors: np.ndarray) -> QuantizedEmbeddings:
+        path = quantized_path(embeddings_path, self.quantization)
+        if os.path.exists(path):
+            quantized = QuantizedEmbeddings.load(path)
+            if quantized.mode == self.quantization and quantized.n_rows == len(vectors):
+                return quantized
+
+        quantized = QuantizedEmbeddings.build(np.asarray(vectors), self.quantization)
+        quantized.save(path)
+
+        return quantized
+
+    @traced("semantic.build")
     def build_embeddings(
-        self, documents: list[dict[int, list[int | str]]]
+        self, documents: Sequence[dict]
     ) -> list[float]:
-        self.documents = documents
-        doc_list = []
-        for doc in self.documents:
-            self.document_map[doc["id"]] = doc
-            doc_list.append(f"{doc['title']}: {doc['description']}")
+        self._set_documents(documents)
+        doc_list = self.__document_texts(documents)
 
-        encoded = self.encode(doc_list)
+        manifest = self.embeddings_manifest(doc_list, len(documents), len(doc_list))
+        previous = load_previous(self._embeddings_path, manifest)
 
-        self.embeddings = encoded
+        # One row per document, so the document hash is also the row hash
+        row_hashes = [content_hash(text) for text in doc_list]
+        old_rows = [-1 if previous is None else previous.row(h) for h in row_hashes]
 
-        if not os.path.exists(self._cache_path):
-            os.makedirs(self._cache_path)
+        self.embeddings = self.assemble_embeddings(doc_list, old_rows, previous)
+        del previous # drop the old mapping before its file is replaced
 
-        with open(self._embeddings_path, "wb") as embeddings_file:
-            np.save(embeddings_file, self.embeddings)
+        self.remove_derived_caches(self._embeddings_path)
+        save_embeddings(
+            self._embeddings_path,
+            self.embeddings,
+            manifest,
+            row_hashes,
+            [(h, i, 1) for i, h in enumerate(row_hashes)],
+        )
+
+        self.__index_embeddings()
 
         return self.embeddings
 
+    @traced("semantic.load")
     def load_or_create_embeddings(
-        self, documents: list[dict[int, list[int | str]]]
+        self, documents: Sequence[dict]
     ) -> list[float]:
+        expected = self.embeddings_manifest(self.__document_texts(documents), len(documents))
+        embeddings = open_embeddings(self._embeddings_path, expected)
 
-        if os.path.exists(self._embeddings_path):
+        if embeddings is not None:
 
-            self.documents = documents
+            self._set_documents(documents)
 
-            with open(self._embeddings_path, "rb") as embeddings_file:
-                self.embeddings = np.load(embeddings_file)
+            # Memory mapped: pages are read on first use and shared between processes
+            self.embeddings = embeddings
+            self.__index_embeddings()
 
             return self.embeddings
         else:
             return self.build_embeddings(documents)
 
-    def encode(self, text: list[str]) -> list[float]:
-        encoded_text = self.model.encode(text, show_progress_bar=True)
+    def embeddings_manifest(self, texts: list[str], documents: int, rows: int = 0, *params) -> EmbeddingManifest:
+        return make_manifest(
+            self.model_name,
+            self.embedding_dimension,
+            documents,
+            rows,
+            corpus_hash(texts, *params),
+            params,
+        )
+
+    def assemble_embeddings(
+        self, texts: list[str | None], old_rows: list[int], previous: PreviousEmbeddings | None
+    ) -> np.ndarray:
+        """Embedding matrix for `texts`, copying row `old_rows[i]` of the previous cache where it is >= 0.
+
+        Only the texts without an old row are encoded (their entry in
+        `texts` must not be None). Records what happened in `rebuild_stats`.
+        """
+        missing = [i for i, row in enumerate(old_rows) if row < 0]
+        reused = len(old_rows) - len(missing)
+        self.rebuild_stats = {
+            "rows": len(old_rows),
+            "reused": reused,
+            "encoded": len(missing),
+            "dropped": 0 if previous is None else len(previous.row_hashes) - len(set(old_rows) - {-1}),
+        }
+
+        if reused == 0:
+            return self.encode(texts)
+
+        embeddings = np.empty((len(old_rows), previous.embeddings.shape[1]), dtype=previous.embeddings.dtype)
+        kept = np.flatnonzero(np.asarray(old_rows) >= 0)
+        embeddings[kept] = previous.embeddings[np.asarray(old_rows)[kept]]
+        if missing:
+            embeddings[missing] = self.encode([texts[i] for i in missing])
+
+        return embeddings
+
+    def remove_derived_caches(self, embeddings_path: str) -> None:
+        """Drop the manifest and every cache computed from an embedding matrix that is about to be replaced."""
+        invalidate_embeddings(embeddings_path)
+        for mode in QUANTIZATION_MODES:
+            path = quantized_path(embeddings_path, mode)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __document_texts(self, documents: Sequence[dict]) -> list[str]:
+        return [f"{doc['title']}: {doc['description']}" for doc in documents]
+
+    def __index_embeddings(self) -> None:
+        if self.quantization is None:
+            # Row norms are computed by the first search, so loading stays cheap
+            self._inverse_norms = None
+            self.quantized_embeddings = None
+        else:
+            self._inverse_norms = None
+            self.quantized_embeddings = self._load_or_create_quantized(self._embeddings_path, self.embeddings)
+
+    def encode(self, text: list[str]) -> np.ndarray:
+        """Embeddings of many texts, in order, through a length-sorted EncodePipeline."""
+        with self.encode_pipeline() as pipeline:
+            encoded_text = pipeline.encode(text)
+        self.encode_stats = pipeline.throughput()
 
         return encoded_text
 
+    def encode_pipeline(self) -> EncodePipeline:
+        return EncodePipeline(
+            lambda: self.model,
+            self.model_name if self._model_by_name else None,
+            self.encode_batch_size,
+            self.encode_workers,
+        )
+
     def generate_embedding(self, text: str) -> list[float]:
         clean_text = text.strip()
         if clean_text == "":
             raise ValueError("The input text is empty")
 
-        embedding = self.encode(text)
+        return self.embed_queries([text])[0]
+
+    @traced("semantic.encode")
+    def embed_queries(self, queries: list[str]) -> list[np.ndarray]:
+        """Query embeddings through the query cache; only unseen queries are encoded, in one batch."""
+        return self.query_cache.get_or_encode(self.model_name, queries, self._encode_queries)
 
-        return embedding
+    def _encode_queries(self, texts: list[str]) -> np.ndarray:
+        model = self.model
+        with span("semantic.model_encode"):
+            return model.encode(texts, show_progress_bar=False)
 
 
 def verify_model() -> None:
@@ -119,6 +369,32 @@ def cosine_similarity(vec1: list[float], vec2: list[float]) -> float:
     return dot_product / (norm1 * norm2)
 
 
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale rows (or a single vector) to unit length; all-zero rows stay zero."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def inverse_row_norms(matrix: np.ndarray) -> np.ndarray:
+    """1 / length of every row, 0 for all-zero rows, without a temporary copy of the matrix."""
+    norms = np.sqrt(np.einsum("ij,ij->i", matrix, matrix))
+    return np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+
+
+def top_k_indices(scores: np.ndarray, limit: int) -> np.ndarray:
+    """Indices of the `limit` highest scores, best first, ties by lower index."""
+    limit = min(limit, len(scores))
+    if limit <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    kth_score = scores[np.argpartition(-scores, limit - 1)[:limit]].min()
+    candidates = np.flatnonzero(scores >= kth_score)
+    order = np.lexsort((candidates, -scores[candidates]))
+
+    return candidates[order[:limit]]
+
+
 def semantic_chunk(
     text_block: str,
     max_chunk_size: int = DEFAULT_SEMANTIC_CHUNK_SIZE,
@@ -0,0 +1,259 @@
+import heapq
+import json
+import os
+import shutil
+from array import array
+from collections import Counter
+from collections.abc import Iterator
+from itertools import batched
+
+import numpy as np
+
+from constants import *
+
+from .analyzer import Analyzer
+from .columnar_index import replace_index_directory
+from .document_store import write_document_store
+from .document_stream import iter_documents
+from .tracing import peak_rss_mb, span, traced
+
+
+@traced("keyword.spimi_build")
+def build_spimi_index(
+    analyzer : Analyzer,
+    movies_path : str,
+    index_path : str,
+    documents_path : str,
+    memory_budget_mb : float = SPIMI_MEMORY_BUDGET_MB,
+) -> dict:
+    """Write the columnar index and document store of a movie file without holding the corpus in memory.
+
+    Single-pass in-memory indexing: documents are read and analyzed one
+    batch at a time into a block of posting lists, and whenever the block's
+    estimated size reaches `memory_budget_mb` it is written to disk as
+    sorted arrays and dropped. The blocks are then k-way merged term by
+    term into the arrays write_columnar_index produces for the same corpus,
+    and the document store is written during the same pass over the file.
+    Only the per-document ids and lengths (12 bytes a document) stay in
+    memory until the end.
+
+    Returns what the build did, including the largest block held and the
+    peak RSS of the process.
+    """
+    blocks_path = f"{index_path}.blocks"
+    shutil.rmtree(blocks_path, ignore_errors=True)
+    os.makedirs(blocks_path)
+    budget = memory_budget_mb * 2**20
+
+    doc_ids = array("q") # ordinal : doc_id
+    doc_lengths = array("I") # ordinal : number of tokens
+    blocks = [] # paths of the flushed blocks, in ordinal order
+    stats = {"documents": 0, "blocks": 0, "peak_block_mb": 0.0}
+
+    block = {} # term : (ordinals, tfs)
+    block_postings = 0
+
+    def flush() -> None:
+        nonlocal block, block_postings
+        stats["peak_block_mb"] = max(stats["peak_block_mb"], estimated_size(block, block_postings) / 2**20)
+        if block:
+            path = os.path.join(blocks_path, f"{len(blocks):06d}")
+            with span("keyword.spimi_flush"):
+                _write_block(path, block)
+            blocks.append(path)
+        block, block_postings = {}, 0
+
+    def indexed_documents() -> Iterator[dict]:
+        # Drives the pass over the file: every movie is indexed right before
+        # the document store writes it.
+        nonlocal block_postings
+        for movies in batched(iter_documents(movies_path), SPIMI_ANALYZE_BATCH):
+            with span("keyword.tokenize"):
+                token_lists = analyzer.analyze_many([f"{movie["title"]} {movie["description"]}" for movie in movies])
+
+            for movie, tokens in zip(movies, token_lists):
+                ordinal = len(doc_ids)
+                doc_ids.append(movie["id"])
+                doc_lengths.append(len(tokens))
+                for token, tf in Counter(tokens).items():
+                    try:
+                        ordinals, tfs = block[token]
+                    except KeyError:
+                        ordinals, tfs = block[token] = (array("I"), array("I"))
+                    ordinals.append(ordinal)
+                    tfs.append(tf)
+                    block_postings += 1
+                yield movie
+
+            if estimated_size(block, block_postings) >= budget:
+                flush()
+
+    try:
+        # Rejects duplicate ids before the index is touched
+        write_document_store(documents_path, indexed_documents())
+    except ValueError:
+        shutil.rmtree(blocks_path, ignore_errors=True)
+        raise
+    flush()
+
+    doc_ids = np.frombuffer(doc_ids, dtype=np.int64)
+    doc_order = np.argsort(doc_ids, kind="stable")
+    # Merged next to the live index and swapped in, as write_columnar_index does
+    staged_path = f"{index_path}.partial"
+    shutil.rmtree(staged_path, ignore_errors=True)
+    os.makedirs(staged_path)
+    with span("keyword.spimi_merge"):
+        n_terms, n_postings = _merge_blocks(blocks, staged_path)
+    np.save(os.path.join(staged_path, "doc_ids.npy"), doc_ids)
+    np.save(os.path.join(staged_path, "doc_order.npy"), doc_order)
+    np.save(os.path.join(staged_path, "doc_lengths.npy"), np.frombuffer(doc_lengths, dtype=np.uint32))
+    shutil.rmtree(blocks_path, ignore_errors=True)
+
+    # Written last: a directory without meta.json is an unfinished index.
+    with open(os.path.join(staged_path, "meta.json"), "w") as meta_file:
+        json.dump({"version": COLUMNAR_INDEX_VERSION, "terms": n_terms, "documents": len(doc_ids), "positions": False}, meta_file)
+    replace_index_directory(staged_path, index_path)
+
+    stats.update(documents=len(doc_ids), blocks=len(blocks), terms=n_terms, postings=n_postings, peak_rss_mb=peak_rss_mb())
+    return stats
+
+
+def estimated_size(block : dict, postings : int) -> int:
+    """Bytes a block of posting lists takes: two 4-byte arrays per posting, plus per-term overhead."""
+    return postings * 8 + len(block) * SPIMI_TERM_OVERHEAD_BYTES
+
+
+def _write_block(path : str, block : dict) -> None:
+    """One block as sorted term arrays with absolute ordinals, in the layout the merge maps."""
+    terms = sorted((term.encode("utf-8"), term) for term in block)
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([len(encoded) for encoded, _ in terms], out=term_offsets[1:])
+    posting_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([len(block[term][0]) for _, term in terms], out=posting_offsets[1:])
+
+    os.makedirs(path)
+    np.save(os.path.join(path, "term_bytes.npy"), np.frombuffer(b"".join(encoded for encoded, _ in terms), dtype=np.uint8))
+    np.save(os.path.join(path, "term_offsets.npy"), term_offsets)
+    np.save(os.path.join(path, "posting_offsets.npy"), posting_offsets)
+    for column, name in enumerate(("ordinals", "tfs")):
+        values = np.empty(posting_offsets[-1], dtype=np.uint32)
+        for (_, term), start, end in zip(terms, posting_offsets[:-1].tolist(), posting_offsets[1:].tolist()):
+            values[start:end] = block[term][column]
+        np.save(os.path.join(path, f"{name}.npy"), values)
+
+
+class _Block:
+    """A flushed block, memory mapped and read one term at a time during the merge."""
+
+    def __init__(self, path : str) -> None:
+        for name in ("term_bytes", "term_offsets", "posting_offsets", "ordinals", "tfs"):
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        self.n_terms = len(self.term_offsets) - 1
+
+    def term(self, term_id : int) -> bytes:
+        return self.term_bytes[self.term_offsets[term_id] : self.term_offsets[term_id + 1]].tobytes()
+
+
+def _merge_blocks(block_paths : list[str], index_path : str) -> tuple[int, int]:
+    """K-way merge of the blocks into the term and posting arrays of a columnar index."""
+    blocks = [_Block(path) for path in block_paths]
+    writers = {
+        "term_bytes": _NpyAppender(os.path.join(index_path, "term_bytes.npy"), np.uint8),
+        "term_offsets": _NpyAppender(os.path.join(index_path, "term_offsets.npy"), np.int64),
+        "posting_offsets": _NpyAppender(os.path.join(index_path, "posting_offsets.npy"), np.int64),
+        "posting_docs": _NpyAppender(os.path.join(index_path, "posting_docs.npy"), np.uint32),
+        "posting_tfs": _NpyAppender(os.path.join(index_path, "posting_tfs.npy"), np.uint32),
+    }
+
+    heap = [(block.term(0), i, 0) for i, block in enumerate(blocks) if block.n_terms] # (term, block, term_id)
+    heapq.heapify(heap)
+
+    n_terms = 0
+    term_end = 0
+    posting_end = 0
+    pending_terms = [] # encoded terms not written yet
+    pending_ordinals = [] # per pending term, its ordinals from every block
+    pending_tfs = []
+    pending_postings = 0
+
+    def write_pending() -> None:
+        nonlocal pending_terms, pending_ordinals, pending_tfs, pending_postings
+        if not pending_terms:
+            return
+        lengths = np.array([len(ordinals) for ordinals in pending_ordinals], dtype=np.int64)
+        ordinals = np.concatenate(pending_ordinals).astype(np.int64)
+        # Delta-encoded within each term: the first posting of a term keeps its ordinal
+        deltas = np.diff(ordinals, prepend=0)
+        starts = np.cumsum(lengths) - lengths
+        deltas[starts] = ordinals[starts]
+
+        writers["term_bytes"].append(np.frombuffer(b"".join(pending_terms), dtype=np.uint8))
+        writers["posting_docs"].append(deltas)
+        writers["posting_tfs"].append(np.concatenate(pending_tfs))
+        pending_terms, pending_ordinals, pending_tfs, pending_postings = [], [], [], 0
+
+    writers["term_offsets"].append(np.zeros(1))
+    writers["posting_offsets"].append(np.zeros(1))
+    term_offsets = array("q")
+    posting_offsets = array("q")
+    while heap:
+        term = heap[0][0]
+        ordinals = []
+        tfs = []
+        while heap and heap[0][0] == term:
+            # Blocks hold increasing ordinal ranges, and ties pop in block order
+            _, i, term_id = heapq.heappop(heap)
+            block = blocks[i]
+            start, end = block.posting_offsets[term_id], block.posting_offsets[term_id + 1]
+            ordinals.append(block.ordinals[start:end])
+            tfs.append(block.tfs[start:end])
+            if term_id + 1 < block.n_terms:
+                heapq.heappush(heap, (block.term(term_id + 1), i, term_id + 1))
+
+        ordinals = np.concatenate(ordinals)
+        n_terms += 1
+        term_end += len(term)
+        posting_end += len(ordinals)
+        term_offsets.append(term_end)
+        posting_offsets.append(posting_end)
+        pending_terms.append(term)
+        pending_ordinals.append(ordinals)
+        pending_tfs.append(np.concatenate(tfs))
+        pending_postings += len(ordinals)
+        if pending_postings >= SPIMI_MERGE_BUFFER:
+            write_pending()
+            writers["term_offsets"].append(np.frombuffer(term_offsets, dtype=np.int64))
+            writers["posting_offsets"].append(np.frombuffer(posting_offsets, dtype=np.int64))
+            term_offsets, posting_offsets = array("q"), array("q")
+
+    write_pending()
+    writers["term_offsets"].append(np.frombuffer(term_offsets, dtype=np.int64))
+    writers["posting_offsets"].append(np.frombuffer(posting_offsets, dtype=np.int64))
+    for writer in writers.values():
+        writer.finish()
+
+    return n_terms, posting_end
+
+
+class _NpyAppender:
+    """A 1-d .npy written in pieces of unknown total length: raw data first, the header once the length is known."""
+
+    def __init__(self, path : str, dtype) -> None:
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._raw_path = f"{path}.raw"
+        self._raw = open(self._raw_path, "wb")
+
+    def append(self, values : np.ndarray) -> None:
+        values = np.asarray(values).astype(self.dtype, copy=False)
+        self._raw.write(values.tobytes())
+        self.length += len(values)
+
+    def finish(self) -> None:
+        self._raw.close()
+        with open(self.path, "wb") as npy_file, open(self._raw_path, "rb") as raw_file:
+            header = {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (self.length,)}
+            np.lib.format.write_array_header_1_0(npy_file, header)
+            shutil.copyfileobj(raw_file, npy_file)
+        os.remove(self._raw_path)
@@ -0,0 +1,133 @@
+import json
+import zlib
+from collections.abc import Iterator
+
+import numpy as np
+
+from constants import *
+
+_CONSONANTS = "bcdfghjklmnprstvwz"
+_VOWELS = "aeiou"
+
+
+def synthetic_vocabulary(size : int = SYNTHETIC_VOCABULARY_SIZE, seed : int = SYNTHETIC_SEED) -> list[str]:
+    """`size` distinct pronounceable pseudo-words, most frequent first."""
+    rng = np.random.default_rng([seed, 0])
+    syllables = [c + v for c in _CONSONANTS for v in _VOWELS] + [c + v + "n" for c in _CONSONANTS for v in _VOWELS]
+
+    words = {}
+    while len(words) < size:
+        lengths = rng.integers(2, 5, size=size)
+        picks = rng.integers(0, len(syllables), size=(size, 4))
+        for length, row in zip(lengths.tolist(), picks.tolist()):
+            words.setdefault("".join(syllables[i] for i in row[:length]), None)
+            if len(words) == size:
+                break
+
+    return list(words)
+
+
+def generate_movies(n_docs : int, seed : int = SYNTHETIC_SEED, vocabulary : list[str] | None = None) -> Iterator[dict]:
+    """Movies shaped like data/movies.json (id, title, description), the same for a given seed.
+
+    Description words follow a Zipf distribution over the vocabulary, so
+    posting lists have the long tail of real text. Movies come in seeded
+    blocks of SYNTHETIC_BLOCK_SIZE: the first n movies of a larger corpus
+    are exactly the corpus of size n.
+    """
+    if vocabulary is None:
+        vocabulary = synthetic_vocabulary(seed=seed)
+    ranks = np.arange(1, len(vocabulary) + 1)
+    cdf = np.cumsum(ranks ** -SYNTHETIC_ZIPF_EXPONENT)
+    cdf /= cdf[-1]
+
+    for block_start in range(0, n_docs, SYNTHETIC_BLOCK_SIZE):
+        rng = np.random.default_rng([seed, 1, block_start // SYNTHETIC_BLOCK_SIZE])
+        block_size = min(SYNTHETIC_BLOCK_SIZE, n_docs - block_start)
+
+        n_sentences = rng.integers(SYNTHETIC_SENTENCES[0], SYNTHETIC_SENTENCES[1] + 1, size=block_size)
+        sentence_words = rng.integers(SYNTHETIC_SENTENCE_WORDS[0], SYNTHETIC_SENTENCE_WORDS[1] + 1, size=int(n_sentences.sum()))
+        word_ids = np.searchsorted(cdf, rng.random(int(sentence_words.sum())), side="right")
+        words = [vocabulary[i] for i in np.minimum(word_ids, len(vocabulary) - 1).tolist()]
+        title_lengths = rng.integers(SYNTHETIC_TITLE_WORDS[0], SYNTHETIC_TITLE_WORDS[1] + 1, size=block_size)
+        title_ids = rng.integers(0, len(vocabulary), size=(block_size, SYNTHETIC_TITLE_WORDS[1]))
+
+        sentence = 0
+        word = 0
+        for i in range(block_size):
+            sentences = []
+            for length in sentence_words[sentence : sentence + n_sentences[i]].tolist():
+                text = " ".join(words[word : word + length])
+                sentences.append(f"{text[0].upper()}{text[1:]}.")
+                word += length
+            sentence += int(n_sentences[i])
+
+            title = " ".join(vocabulary[j].capitalize() for j in title_ids[i, : title_lengths[i]].tolist())
+            yield {"id": block_start + i + 1, "title": title, "description": " ".join(sentences)}
+
+
+def write_movies(path : str, n_docs : int, seed : int = SYNTHETIC_SEED) -> int:
+    """Write a synthetic {"movies": [...]} file one movie at a time; returns its size in bytes."""
+    with open(path, "w") as mov_file:
+        mov_file.write('{"movies": [')
+        for i, movie in enumerate(generate_movies(n_docs, seed)):
+            mov_file.write(",\n" if i else "\n")
+            mov_file.write(json.dumps(movie))
+        mov_file.write("\n]}\n")
+        return mov_file.tell()
+
+
+def synthetic_queries(n_queries : int, seed : int = SYNTHETIC_SEED, vocabulary : list[str] | None = None) -> list[str]:
+    """1 to 3 word queries over words common enough to match, rare enough to discriminate."""
+    if vocabulary is None:
+        vocabulary = synthetic_vocabulary(seed=seed)
+    rng = np.random.default_rng([seed, 2])
+    lo, hi = min(50, len(vocabulary) - 1), min(5000, len(vocabulary))
+
+    queries = []
+    for length in rng.integers(1, 4, size=n_queries).tolist():
+        queries.append(" ".join(vocabulary[i] for i in rng.integers(lo, hi, size=length).tolist()))
+
+    return queries
+
+
+class StubEncoder:
+    """Offline stand-in for the SentenceTransformer, for benchmarks and runs without network.
+
+    A text embeds as the normalized sum of one fixed random direction per
+    word (words hashed into STUB_ENCODER_BUCKETS buckets), so the same text
+    always gets the same vector and texts sharing words score as similar.
+    """
+
+    def __init__(self, dimension : int = STUB_ENCODER_DIMENSION, buckets : int = STUB_ENCODER_BUCKETS, seed : int = SYNTHETIC_SEED) -> None:
+        self.dimension = dimension
+        self.buckets = buckets
+        self.max_seq_length = 256
+        self._directions = np.random.default_rng([seed, 3]).standard_normal((buckets, dimension)).astype(np.float32)
+        self._word_buckets = {} # word : bucket
+        self._punctuation = str.maketrans({c: " " for c in ".,;:!?\"'()"})
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, sentences : str | list[str], show_progress_bar : bool = False, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        word_buckets = self._word_buckets
+        for row, text in enumerate(texts):
+            buckets = []
+            for word in text.lower().translate(self._punctuation).split():
+                try:
+                    buckets.append(word_buckets[word])
+                except KeyError:
+                    word_buckets[word] = zlib.crc32(word.encode()) % self.buckets
+                    buckets.append(word_buckets[word])
+            if buckets:
+                embeddings[row] = self._directions[buckets].sum(axis=0)
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms > 0, norms, 1)
+
+        return embeddings[0] if single else embeddings
@@ -0,0 +1,233 @@
+import functools
+import io
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+from constants import *
+
+_NO_SPAN = nullcontext()
+_trace = None # Trace while tracing is enabled
+
+
+class Trace:
+    """Timings of every span entered since tracing was enabled, from any thread.
+
+    Spans are aggregated per stage name as they close; the individual spans
+    are kept too, up to PROFILE_MAX_SPANS. With `capture` ("cprofile" or
+    "tracemalloc") the first query span runs under that profiler.
+    """
+
+    def __init__(self, capture : str | None = None) -> None:
+        if capture is not None and capture not in PROFILE_CAPTURE_MODES:
+            raise ValueError(f"Unknown capture mode: {capture}, expected one of {PROFILE_CAPTURE_MODES}")
+        self.started = time.perf_counter()
+        self.stages = {} # name : {"calls", "total_ms", "max_ms"}, in order of first use
+        self.spans = [] # {"name", "thread", "depth", "start_ms", "duration_ms"}
+        self.capture_mode = capture # cleared once the capture has started
+        self.capture = None # report of the captured query span
+        self._lock = threading.Lock()
+        self._local = threading.local() # span depth per thread
+
+    def record(self, name : str, depth : int, start : float, end : float) -> None:
+        duration_ms = (end - start) * 1000
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0}
+            stage["calls"] += 1
+            stage["total_ms"] += duration_ms
+            stage["max_ms"] = max(stage["max_ms"], duration_ms)
+            if len(self.spans) < PROFILE_MAX_SPANS:
+                self.spans.append({
+                    "name": name,
+                    "thread": threading.current_thread().name,
+                    "depth": depth,
+                    "start_ms": (start - self.started) * 1000,
+                    "duration_ms": duration_ms,
+                })
+
+    def _start_capture(self) -> "_Capture | None":
+        with self._lock:
+            if self.capture_mode is None:
+                return None
+            capture = _Capture(self.capture_mode)
+            self.capture_mode = None
+        capture.start()
+        return capture
+
+    def report(self) -> dict:
+        """JSON-ready breakdown: wall time, per-stage totals, the spans and any capture."""
+        with self._lock:
+            return {
+                "wall_ms": (time.perf_counter() - self.started) * 1000,
+                "stages": {
+                    name: {**stage, "mean_ms": stage["total_ms"] / stage["calls"]}
+                    for name, stage in self.stages.items()
+                },
+                "spans": list(self.spans),
+                "capture": self.capture,
+            }
+
+
+class _Span:
+    __slots__ = ("_trace", "_name", "_query", "_depth", "_start", "_capture")
+
+    def __init__(self, trace : Trace, name : str, query : bool) -> None:
+        self._trace = trace
+        self._name = name
+        self._query = query
+
+    def __enter__(self) -> "_Span":
+        trace = self._trace
+        self._capture = trace._start_capture() if self._query and trace.capture_mode is not None else None
+        self._depth = getattr(trace._local, "depth", 0)
+        trace._local.depth = self._depth + 1
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        end = time.perf_counter()
+        trace = self._trace
+        trace._local.depth = self._depth
+        if self._capture is not None:
+            trace.capture = self._capture.stop(self._name)
+        trace.record(self._name, self._depth, self._start, end)
+        return False
+
+
+class _Capture:
+    """cProfile or tracemalloc running around one query span; both are imported only when used."""
+
+    def __init__(self, mode : str) -> None:
+        self.mode = mode
+        self._profiler = None
+
+    def start(self) -> None:
+        if self.mode == "cprofile":
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            import tracemalloc
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+    def stop(self, span_name : str) -> dict:
+        if self.mode == "cprofile":
+            import pstats
+            self._profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(self._profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_CAPTURE_TOP)
+            return {"mode": self.mode, "span": span_name, "report": stream.getvalue()}
+
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        top = snapshot.statistics("lineno")[:PROFILE_CAPTURE_TOP]
+        return {
+            "mode": self.mode,
+            "span": span_name,
+            "peak_kb": peak / 1024,
+            "top": [{"where": str(stat.traceback), "size_kb": stat.size / 1024, "count": stat.count} for stat in top],
+        }
+
+
+def span(name : str, query : bool = False):
+    """Context manager timing one stage; a shared no-op while tracing is off.
+
+    `query` marks the outermost span of a search, the one a capture wraps.
+    """
+    trace = _trace
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, query)
+
+
+def traced(name : str, query : bool = False):
+    """Decorator running the whole function inside span(name)."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = _trace
+            if trace is None:
+                return fn(*args, **kwargs)
+            with _Span(trace, name, query):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def enable(capture : str | None = None) -> Trace:
+    """Start a new trace, replacing any current one."""
+    global _trace
+    _trace = Trace(capture)
+    return _trace
+
+
+def disable() -> Trace | None:
+    """Stop tracing; returns the finished trace."""
+    global _trace
+    trace, _trace = _trace, None
+    return trace
+
+
+def current() -> Trace | None:
+    return _trace
+
+
+def peak_rss_mb() -> float:
+    """High-water resident set size of this process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10 # bytes on macOS, KiB elsewhere
+
+
+def format_report(report : dict) -> str:
+    """Per-stage table, slowest total first, followed by any capture."""
+    wall_ms = report["wall_ms"]
+    lines = [f"{"stage":<28} {"calls":>7} {"total ms":>11} {"mean ms":>10} {"max ms":>10} {"wall":>7}"]
+    for name, stage in sorted(report["stages"].items(), key=lambda item: item[1]["total_ms"], reverse=True):
+        share = stage["total_ms"] / wall_ms * 100 if wall_ms > 0 else 0.0
+        lines.append(f"{name:<28} {stage["calls"]:>7} {stage["total_ms"]:>11.3f} {stage["mean_ms"]:>10.3f} {stage["max_ms"]:>10.3f} {share:>6.1f}%")
+    lines.append(f"{"wall":<28} {"":>7} {wall_ms:>11.3f}")
+
+    capture = report["capture"]
+    if capture is not None and capture["mode"] == "cprofile":
+        lines += ["", f"cProfile of {capture["span"]}:", capture["report"].rstrip()]
+    elif capture is not None:
+        lines += ["", f"tracemalloc of {capture["span"]}: peak {capture["peak_kb"]:.1f} KiB"]
+        lines += [f"  {entry["size_kb"]:10.1f} KiB {entry["count"]:>8} blocks  {entry["where"]}" for entry in capture["top"]]
+
+    return "\n".join(lines)
+
+
+def add_profile_arguments(parser) -> None:
+    """The --profile options every CLI takes, before its subcommand."""
+    parser.add_argument('--profile', action="store_true", help="Optional: print the time spent in each search stage to stderr.")
+    parser.add_argument('--profile-json', type=str, default=None, help="Optional: write the stage breakdown and spans as JSON to this file, - for stderr.")
+    parser.add_argument('--profile-capture', choices=PROFILE_CAPTURE_MODES, default=None, help="Optional: run the first query under cProfile or tracemalloc.")
+
+
+def start_profile(args) -> Trace | None:
+    if not (args.profile or args.profile_json or args.profile_capture):
+        return None
+    return enable(args.profile_capture)
+
+
+def finish_profile(trace : Trace | None, args) -> None:
+    """Stop tracing and print and/or write what the command's stages cost."""
+    if trace is None:
+        return
+    disable()
+    report = trace.report()
+
+    if args.profile or args.profile_capture:
+        print(format_report(report), file=sys.stderr)
+    if args.profile_json == "-":
+        print(json.dumps(report, indent=2), file=sys.stderr)
+    elif args.profile_json:
+        with open(args.profile_json, "w") as profile_file:
+            json.dump(report, profile_file, indent=2)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+from lib.search_client import SearchClient
+from lib.search_server import SearchService, make_server
+from constants import *
+from lib.tracing import add_profile_arguments, finish_profile, start_profile
+
+def serve_command(host : str, port : int, socket_path : str | None, quantization : str | None, lazy : bool) -> None:
+    cur_path = os.path.dirname(__file__)
+    movie_path = os.path.join(cur_path, "..", "data", "movies.json")
+
+    service = SearchService(movie_path, quantization)
+    if not lazy:
+        print("Loading indexes and model...")
+        service.preload()
+
+    server = make_server(service, host, port, socket_path)
+    address = f"unix:{socket_path}" if socket_path else f"http://{host}:{port}"
+    print(f"Serving searches on {address} (use --server {address} with the search CLIs)")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+def health_command(address : str) -> None:
+    health = SearchClient(address).health()
+
+    print(f"Status: {health["status"]}, loaded: {", ".join(health["loaded"]) or "nothing yet"}")
+    cache = health["query_cache"]
+    print(f"Query cache: {cache["size"]}/{cache["max_size"]} entries, {cache["hits"]} hits, {cache["disk_hits"]} disk hits, {cache["misses"]} misses")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search Server CLI")
+    add_profile_arguments(parser)
+    parser.add_argument('--persist-query-cache', action="store_true", help=f"Optional: keep query embeddings in cache/{QUERY_CACHE_FILE} across runs")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    serve_parser = subparsers.add_parser("serve", help="Load the indexes and model once and answer searches over HTTP")
+    serve_parser.add_argument('--host', type=str, default=SEARCH_SERVER_HOST, help="Optional: address to listen on")
+    serve_parser.add_argument('--port', type=int, default=SEARCH_SERVER_PORT, help="Optional: TCP port to listen on")
+    serve_parser.add_argument('--socket', type=str, default=None, help="Optional: listen on this Unix socket instead of TCP")
+    serve_parser.add_argument('--quantization', choices=QUANTIZATION_MODES, default=None, help="Optional: score compressed embeddings")
+    serve_parser.add_argument('--lazy', action="store_true", help="Optional: load each index on its first search instead of at start")
+
+    health_parser = subparsers.add_parser("health", help="Check that a server is up and what it has loaded")
+    health_parser.add_argument('--server', type=str, default=f"{SEARCH_SERVER_HOST}:{SEARCH_SERVER_PORT}", help="Server address, host:port or unix:/path")
+
+    args = parser.parse_args()
+    trace = start_profile(args)
+    if args.persist_query_cache:
+        from lib.query_cache import enable_persistent_query_cache
+
+        enable_persistent_query_cache()
+
+    match args.command:
+        case "serve":
+            serve_command(args.host, args.port, args.socket, args.quantization, args.lazy)
+        case "health":
+            health_command(args.server)
+        case _:
+            parser.print_help()
+
+    finish_profile(trace, args)
+
+
+if __name__ == "__main__":
+    main()
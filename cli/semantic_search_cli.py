@@ -3,9 +3,11 @@
 import argparse
 import lib.semantic_search as semsearch
 import lib.chunked_sematic_search as chunked_semsearch
+from lib.query_cache import SHARED_QUERY_CACHE_PATH, enable_persistent_query_cache, shared_query_cache
 import os
 import json
 from constants import *
+from lib.tracing import add_profile_arguments, finish_profile, start_profile
 import re
 
 def verify_command() -> None:
@@ -40,8 +42,14 @@ def embed_query_text(query : str):
     print(f"First 5 dimensions: {embedding[:5]}")
     print(f"Shape: {embedding.shape}")
 
-def search(query : str, limit : int  = LIMIT) -> None:
-    semantic_search = semsearch.SemanticSearch()
+def search(query : str, limit : int  = LIMIT, quantization : str | None = None, rerank : bool = True, server : str | None = None) -> None:
+    if server is not None:
+        from lib.search_client import SearchClient
+
+        print_search_results(SearchClient(server).search("semantic", query, limit))
+        return
+
+    semantic_search = semsearch.SemanticSearch(quantization=quantization, rerank=rerank)
     cur_path = os.path.dirname(__file__)
     movie_path = os.path.join(cur_path, "..", "data", "movies.json") 
 
@@ -52,6 +60,9 @@ def search(query : str, limit : int  = LIMIT) -> None:
 
     doc_dic = semantic_search.search(query, limit)
 
+    print_search_results(doc_dic)
+
+def print_search_results(doc_dic : list[dict]) -> None:
     for i, doc in enumerate(doc_dic): 
         print(f"{i+1}. {doc["title"]} (score: {doc["score"]:.4f})")
         print(f"   {doc["description"][:100]}...")
@@ -73,10 +84,21 @@ def chunk(text_block : str, chunk_size : int = CHUNK_SIZE, overlap : int = 0) ->
 
     return chunks
 
-def embed_chunks():
+def embed_chunks(stream : bool = False, movie_path : str | None = None, batch_size : int = EMBEDDING_BUILD_BATCH_SIZE, resume : bool = True, encode_batch_size : int = ENCODE_BATCH_SIZE, encode_workers : int = ENCODE_WORKERS):
     chunked_semantic_search = chunked_semsearch.ChunkedSemanticSearch()
+    chunked_semantic_search.encode_batch_size = encode_batch_size
+    chunked_semantic_search.encode_workers = encode_workers
     cur_path = os.path.dirname(__file__)
-    movie_path = os.path.join(cur_path, "..", "data", "movies.json") 
+    movie_path = movie_path or os.path.join(cur_path, "..", "data", "movies.json")
+
+    if stream:
+        chunked_semantic_search.stream_chunk_embeddings(movie_path, batch_size, resume)
+        stats = chunked_semantic_search.rebuild_stats
+        print(f"Generated {stats["rows"]} chunked embeddings")
+        if stats["resumed"]:
+            print(f"Resumed after {stats["resumed"]} rows, encoded {stats["encoded"]}")
+        print_encode_stats(chunked_semantic_search.encode_stats)
+        return
 
     with open(movie_path, "r") as mov_file:
         movies = json.load(mov_file)
@@ -84,9 +106,24 @@ def embed_chunks():
     embeddings = chunked_semantic_search.load_or_create_chunk_embeddings(movies["movies"])
 
     print(f"Generated {len(embeddings)} chunked embeddings")
+    stats = chunked_semantic_search.rebuild_stats
+    if stats is not None:
+        print(f"Reused {stats["reused"]}, encoded {stats["encoded"]}, dropped {stats["dropped"]} chunk rows")
+    print_encode_stats(chunked_semantic_search.encode_stats)
 
-def search_chunked(query : str, limit : int = LIMIT):
-    chunked_semantic_search = chunked_semsearch.ChunkedSemanticSearch()
+def print_encode_stats(stats : dict | None) -> None:
+    if stats is None or not stats["texts"]:
+        return
+    print(f"Encoded {stats["texts"]} chunks in {stats["batches"]} batches: {stats["chunks_per_s"]:.1f} chunks/s")
+
+def search_chunked(query : str, limit : int = LIMIT, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE, quantization : str | None = None, rerank : bool = True, server : str | None = None):
+    if server is not None:
+        from lib.search_client import SearchClient
+
+        print_chunked_results(SearchClient(server).search("chunked", query, limit, ann=ann, nprobe=nprobe))
+        return
+
+    chunked_semantic_search = chunked_semsearch.ChunkedSemanticSearch(quantization=quantization, rerank=rerank)
     cur_path = os.path.dirname(__file__)
     movie_path = os.path.join(cur_path, "..", "data", "movies.json") 
 
@@ -95,15 +132,83 @@ def search_chunked(query : str, limit : int = LIMIT):
 
     embeddings = chunked_semantic_search.load_or_create_chunk_embeddings(movies["movies"])
 
-    sorted_results = chunked_semantic_search.search_chunks(query, limit)
+    sorted_results = chunked_semantic_search.search_chunks(query, limit, ann, nprobe)
+
+    print_chunked_results(sorted_results)
 
+def print_chunked_results(sorted_results : list[dict]) -> None:
     for i, movie in enumerate(sorted_results):
         print(f"\n{i + 1}. {movie["title"]} (score: {movie["score"]:.4f})")
         print(f"   {movie["document"]}...")
 
+def ann_recall(k : int = LIMIT, n_queries : int = IVF_RECALL_QUERIES, nprobes : list[int] = IVF_RECALL_NPROBES) -> None:
+    chunked_semantic_search = chunked_semsearch.ChunkedSemanticSearch()
+    cur_path = os.path.dirname(__file__)
+    movie_path = os.path.join(cur_path, "..", "data", "movies.json") 
+
+    with open(movie_path, "r") as mov_file:
+        movies = json.load(mov_file)
+
+    chunked_semantic_search.load_or_create_chunk_embeddings(movies["movies"])
+
+    # Movie titles make a cheap, repeatable query set
+    step = max(1, len(movies["movies"]) // n_queries)
+    queries = [movie["title"] for movie in movies["movies"][::step][:n_queries]]
+
+    report = chunked_semantic_search.ann_recall(queries, k, nprobes)
+    ann_index = chunked_semantic_search.ann_index
+
+    print(f"IVF index: {ann_index.n_lists} lists over {ann_index.n_rows} chunks, {len(queries)} queries")
+    for nprobe, stats in report.items():
+        name = "exact" if nprobe == 0 else f"nprobe={nprobe}"
+        print(f"{name:<12} recall@{k}: {stats["recall"]:.3f}  mean: {stats["mean_ms"]:.3f} ms")
+
+def quantization_report(k : int = LIMIT, n_queries : int = IVF_RECALL_QUERIES) -> None:
+    chunked_semantic_search = chunked_semsearch.ChunkedSemanticSearch()
+    cur_path = os.path.dirname(__file__)
+    movie_path = os.path.join(cur_path, "..", "data", "movies.json") 
+
+    with open(movie_path, "r") as mov_file:
+        movies = json.load(mov_file)
+
+    chunked_semantic_search.load_or_create_chunk_embeddings(movies["movies"])
+
+    step = max(1, len(movies["movies"]) // n_queries)
+    queries = [movie["title"] for movie in movies["movies"][::step][:n_queries]]
+
+    report = chunked_semantic_search.quantization_report(queries, k)
+
+    print(f"{len(chunked_semantic_search.chunk_embeddings)} chunks, {len(queries)} queries")
+    for mode, stats in report.items():
+        print(
+            f"{mode:<8} {stats["bytes"] / 2**20:8.2f} MiB ({stats["compression"]:5.1f}x)"
+            f"  recall@{k}: {stats["recall"]:.3f} ({stats["mean_ms"]:.3f} ms)"
+            f"  reranked: {stats["recall_rerank"]:.3f} ({stats["mean_ms_rerank"]:.3f} ms)"
+        )
+
+def batch_search(input_path : str, output_path : str, kind : str = "semantic", limit : int = LIMIT, ann : bool = False, nprobe : int = IVF_DEFAULT_NPROBE, quantization : str | None = None) -> None:
+    cur_path = os.path.dirname(__file__)
+    movie_path = os.path.join(cur_path, "..", "data", "movies.json")
+
+    from lib.batch_queries import batch_command
+    from lib.search_server import SearchService
+
+    service = SearchService(movie_path, quantization)
+    batch_command(input_path, output_path, lambda queries: service.search_many(kind, queries, limit, ann=ann, nprobe=nprobe))
+
+def clear_query_cache() -> None:
+    query_cache = shared_query_cache()
+    query_cache.clear()
+    removed = query_cache.path is None and os.path.exists(SHARED_QUERY_CACHE_PATH)
+    if removed:
+        os.remove(SHARED_QUERY_CACHE_PATH) # written by an earlier run with --persist-query-cache
+
+    print(f"Cleared the query embedding cache{" and its file" if query_cache.path or removed else ""}")
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
+    add_profile_arguments(parser)
+    parser.add_argument('--persist-query-cache', action="store_true", help=f"Optional: keep query embeddings in cache/{QUERY_CACHE_FILE} across runs")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     verify_parser = subparsers.add_parser("verify", help="Test if the model works")
@@ -125,6 +230,9 @@ def main():
         default=LIMIT,
         help="Specify the maximum number of items to print (e.g., --limit 10)"
     )
+    search_parser.add_argument('--quantization', choices=QUANTIZATION_MODES, default=None, help="Score compressed embeddings instead of float32")
+    search_parser.add_argument('--no-rerank', dest="rerank", action="store_false", help="Skip re-scoring quantized candidates with the full-precision embeddings")
+    search_parser.add_argument('--server', type=str, default=None, help="Send the search to a running search server (host:port or unix:/path)")
 
     chunk_parser = subparsers.add_parser("chunk", help="Command that accepts a positional query string argument. It should call your embed_query_text function with the provided query.")
     chunk_parser.add_argument("text_block", type=str, help="String to chunk")
@@ -159,6 +267,12 @@ def main():
     )
 
     embed_chunks_parser = subparsers.add_parser("embed_chunks", help="Loads or builds the embeddings for the movie file register to search through")
+    embed_chunks_parser.add_argument('--stream', action="store_true", help="Optional: rebuild reading, encoding and writing a batch at a time, with flat memory use; resumes an interrupted streaming build.")
+    embed_chunks_parser.add_argument('--movies', type=str, default=None, help="Optional: JSON or JSONL movie file to build from with --stream, instead of data/movies.json.")
+    embed_chunks_parser.add_argument('--batch-size', type=int, default=EMBEDDING_BUILD_BATCH_SIZE, help="Optional: chunks read, encoded and checkpointed together with --stream.")
+    embed_chunks_parser.add_argument('--restart', dest="resume", action="store_false", help="Optional: ignore the progress of an interrupted --stream build.")
+    embed_chunks_parser.add_argument('--encode-batch-size', type=int, default=ENCODE_BATCH_SIZE, help="Optional: length-sorted chunks per model call.")
+    embed_chunks_parser.add_argument('--encode-workers', type=int, default=ENCODE_WORKERS, help="Optional: processes encoding in parallel, each with its own model; 0 encodes in this process.")
 
     search_chunked_parser = subparsers.add_parser("search_chunked", help="Command that accepts a positional query string argument. It should call your embed_query_text function with the provided query.")
     search_chunked_parser.add_argument("query", type=str, help="String to be embedded and query over the database")
@@ -169,9 +283,37 @@ def main():
         default=LIMIT,
         help="Specify the maximum number of items to print (e.g., --limit 10)"
     )
+    search_chunked_parser.add_argument('--ann', action="store_true", help="Search the approximate IVF index instead of every chunk")
+    search_chunked_parser.add_argument('--nprobe', type=int, default=IVF_DEFAULT_NPROBE, help="Number of IVF lists to search with --ann, higher is slower but more accurate")
+    search_chunked_parser.add_argument('--quantization', choices=QUANTIZATION_MODES, default=None, help="Score compressed chunk embeddings instead of float32")
+    search_chunked_parser.add_argument('--no-rerank', dest="rerank", action="store_false", help="Skip re-scoring quantized candidates with the full-precision embeddings")
+    search_chunked_parser.add_argument('--server', type=str, default=None, help="Send the search to a running search server (host:port or unix:/path)")
+
+    ann_recall_parser = subparsers.add_parser("ann_recall", help="Measure recall@k and latency of the IVF index against exact search")
+    ann_recall_parser.add_argument('--k', type=int, default=LIMIT, help="Number of results compared per query")
+    ann_recall_parser.add_argument('--queries', type=int, default=IVF_RECALL_QUERIES, help="Number of movie titles used as queries")
+    ann_recall_parser.add_argument('--nprobe', type=int, nargs="+", default=IVF_RECALL_NPROBES, help="nprobe values to measure")
+
+
+    quantization_report_parser = subparsers.add_parser("quantization_report", help="Compare size, recall@k and latency of the quantized chunk embeddings")
+    quantization_report_parser.add_argument('--k', type=int, default=LIMIT, help="Number of results compared per query")
+    quantization_report_parser.add_argument('--queries', type=int, default=IVF_RECALL_QUERIES, help="Number of movie titles used as queries")
+
+    batch_parser = subparsers.add_parser("batch", help="Answer many queries from a JSONL file with batched encoding and scoring, writing JSONL results")
+    batch_parser.add_argument('--input', type=str, default="-", help="JSONL file of queries, \"-\" for stdin")
+    batch_parser.add_argument('--output', type=str, default="-", help="JSONL file for the results, \"-\" for stdout")
+    batch_parser.add_argument('--chunked', dest="kind", action="store_const", const="chunked", default="semantic", help="Search the chunk embeddings instead of whole movies")
+    batch_parser.add_argument('--limit', type=int, default=LIMIT, help="Number of results per query")
+    batch_parser.add_argument('--ann', action="store_true", help="Use the approximate IVF index, only with --chunked")
+    batch_parser.add_argument('--nprobe', type=int, default=IVF_DEFAULT_NPROBE, help="Number of IVF lists to search with --ann")
+    batch_parser.add_argument('--quantization', choices=QUANTIZATION_MODES, default=None, help="Score compressed embeddings instead of float32")
 
+    subparsers.add_parser("clear_query_cache", help="Forget every cached query embedding, on disk too")
 
     args = parser.parse_args()
+    trace = start_profile(args)
+    if args.persist_query_cache:
+        enable_persistent_query_cache()
 
     match args.command:
         case "verify":
@@ -183,29 +325,44 @@ def main():
         case "embedquery":
             embed_query_text(args.query)
         case "search":
-            search(args.query, args.limit)
+            search(args.query, args.limit, args.quantization, args.rerank, args.server)
         case "chunk":
             chunks = chunk(args.text_block, args.chunk_size, args.overlap)
 
             print(f"Chunking {len(args.text_block)} characters")
-            for i, chunk in enumerate(chunks):
-                print(f"{i+1}. {chunk}")
+            for i, chunk_text in enumerate(chunks):
+                print(f"{i+1}. {chunk_text}")
 
         case "semantic_chunk":
             chunks = semsearch.semantic_chunk(args.text_block, args.max_chunk_size, args.overlap)
 
             print(f"Semantically chunking {len(args.text_block)} characters")
-            for i, chunk in enumerate(chunks):
-                print(f"{i+1}. {chunk}")
+            for i, chunk_text in enumerate(chunks):
+                print(f"{i+1}. {chunk_text}")
 
         case "embed_chunks":
-            embed_chunks()
+            embed_chunks(args.stream, args.movies, args.batch_size, args.resume, args.encode_batch_size, args.encode_workers)
 
         case "search_chunked":
-            search_chunked(args.query, args.limit)
+            search_chunked(args.query, args.limit, args.ann, args.nprobe, args.quantization, args.rerank, args.server)
+
+        case "ann_recall":
+            ann_recall(args.k, args.queries, args.nprobe)
+
+        case "quantization_report":
+            quantization_report(args.k, args.queries)
+
+        case "batch":
+            batch_search(args.input, args.output, args.kind, args.limit, args.ann, args.nprobe, args.quantization)
+
+        case "clear_query_cache":
+            clear_query_cache()
 
         case _:
             parser.print_help()
 
+    finish_profile(trace, args)
+
+
 if __name__ == "__main__":
     main()